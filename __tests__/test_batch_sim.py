@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from src.batch_sim import BatchSim, PASSENGER_COLUMNS, _row_searchsorted
+from src.bus import Bus
+from src.sim import Sim
+from src.log import ColumnarLog
+from analysis.preprocessing import preprocess, make_passenger_df
+
+
+def test_init_bad_inputs():
+    with pytest.raises(ValueError):
+        BatchSim(0, 5)
+    with pytest.raises(ValueError):
+        BatchSim(5, 0)
+
+
+def test_row_searchsorted():
+    a = np.array([[1.0, 3.0, 5.0, 0.0], [2.0, 2.0, 0.0, 0.0]])
+    v = np.array([[0.0, 3.0, 6.0], [2.0, 2.5, 9.0]])
+
+    # entries past each row's length are ignored
+    assert _row_searchsorted(a, v, np.array([3, 2])).tolist() == [[0, 1, 3], [0, 2, 2]]
+
+
+def test_replications_are_consistent():
+    sim = BatchSim(5, 4, seed=1)
+    sim.run(4*60)
+    df = sim.passenger_df()
+
+    assert list(df.columns) == list(PASSENGER_COLUMNS)
+    assert set(df["replication"]) == set(range(4))
+    assert (df["wait_duration"] >= 0).all()
+    assert (df["transit_duration"] > df["wait_duration"]).all()
+    assert df["stops_traveling"].between(1, 7).all()
+
+    # every passenger who arrived is on a bus, got off one, waiting or walked away
+    on_board = sim.n_riders.sum(axis=1)
+    waiting = sim.queue_len.sum(axis=1)
+    got_off = df.groupby("replication").size().to_numpy()
+    assert (sim.n_arrived == on_board + waiting + got_off + sim.n_abandoned).all()
+    assert (sim.n_riders <= Bus.BUS_MAX_CAPACITY).all()
+
+
+def test_seeded_runs_are_reproducible():
+    dfs = []
+    for _ in range(2):
+        sim = BatchSim(3, 2, seed=7)
+        sim.run(2*60)
+        dfs.append(sim.passenger_df())
+    assert dfs[0].equals(dfs[1])
+
+
+def test_matches_object_engine():
+    n_buses, n_replications, duration = 5, 16, 4*60
+
+    batch = BatchSim(n_buses, n_replications, seed=0)
+    batch.run(duration)
+    batch_kpis = batch.passenger_df().groupby("replication").agg(
+        n=("wait_duration", "size"), wait=("wait_duration", "mean"), transit=("transit_duration", "mean")
+    )
+
+    object_kpis = []
+    for seed in range(n_replications):
+        log = ColumnarLog()
+        Sim(n_buses, log=log, seed=seed, dwell_mode="aggregate").run(stop_time=duration)
+        passengers = make_passenger_df(preprocess(log.to_dataframe()))
+        object_kpis.append((len(passengers), passengers["wait_duration"].mean(), passengers["transit_duration"].mean()))
+    object_kpis = np.array(object_kpis)
+
+    # the per-replication KPIs of the two engines are indistinguishable
+    for i, kpi in enumerate(["n", "wait", "transit"]):
+        assert stats.ttest_ind(batch_kpis[kpi], object_kpis[:, i], equal_var=False).pvalue > 0.001, kpi
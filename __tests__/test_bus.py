@@ -1,4 +1,7 @@
-from src.actions import BUS_MOVE, PASSENGER_DISEMBARK
+from pytest import raises
+
+from src.actions import BUS_MOVE, BUS_DWELL, PASSENGER_DISEMBARK, PASSENGER_EMBARK, PASSENGER_JOIN_QUEUE, \
+    PASSENGER_ABANDON_QUEUE
 from src.event_manager import EventManager
 from src.log import VoidLog, InMemoryLog
 from src.bus import Bus
@@ -32,12 +35,17 @@ def test_move():
 
     # mock bus
     bus = Bus(sim, stop)
-    bus.passengers.append(passenger)
+    bus.add_passenger(passenger)
+    assert bus.alighting() == []
+
+    # the passengers on board can only be changed through the bus
+    with raises(AttributeError):
+        bus.passengers.append(passenger)
 
     bus.move()
     sim.run(1000)
 
-    assert passenger.stops_remaining == 0
+    assert bus.alighting() == [passenger]
     assert parked
     assert departed
 
@@ -47,11 +55,13 @@ def test_disembark():
     stop = Stop(ev)
     bus = Bus(ev, stop)
 
-    bus.passengers = [Passenger(ev, stop) for _ in range(5)]
-    for i, p in enumerate(bus.passengers):
+    # riders are seated by the stop they get off at, so they need to know it before boarding
+    riders = [Passenger(ev, stop) for _ in range(5)]
+    for i, p in enumerate(riders):
         p.id = i
         p.stops_remaining = i % 3
         p.has_embarked = True  # prevent early departures
+    bus.passengers = riders
 
     # run initialization for passengers
     ev.run(10)
@@ -85,13 +95,141 @@ def test_embark():
     for p in stop.passengers_waiting:
         p.has_embarked = True
 
-    bus.passengers = [Passenger(ev, stop) for _ in range(125)]
+    riders = [Passenger(ev, stop) for _ in range(125)]
 
-    for p in stop.passengers_waiting + bus.passengers:
+    for p in stop.passengers_waiting + riders:
         p.stops_remaining = float("inf")
+    bus.passengers = riders
 
     bus.embark()
     ev.run(1000)
 
     assert len(bus.passengers) == 130
     assert len(stop.passengers_waiting) == 5
+
+
+def test_aggregate_dwell(monkeypatch):
+    # nobody runs out of patience while the bus fills up
+    monkeypatch.setattr(Passenger, "PATIENCE", float("inf"))
+
+    log = InMemoryLog()
+    ev = EventManager(log)
+    stop = Stop(ev)
+    stop.next = stop
+    bus = Bus(ev, stop, dwell_mode="aggregate")
+
+    riders = [Passenger(ev, stop) for _ in range(6)]
+    for i, p in enumerate(riders):
+        p.has_embarked = True
+        p.stops_remaining = i % 2
+    bus.passengers = list(riders)
+
+    waiting = [Passenger(ev, stop) for _ in range(Bus.BUS_MAX_CAPACITY)]
+    for p in waiting:
+        stop.passengers_waiting.appendleft(p)
+        p.stops_remaining = float("inf")
+
+    bus.disembark()
+
+    # everyone alighted and boarded without a single heap operation, only the dwell itself is queued
+    dwell = [entry[2] for entry in ev.queue if entry[2].action == BUS_DWELL]
+    assert len(dwell) == 1
+    assert list(bus.passengers) == riders[1::2] + waiting[:Bus.BUS_MAX_CAPACITY - 3]
+    assert len(stop.passengers_waiting) == 3
+
+    # every passenger's embark or disembark was logged with both of its records, one after the other
+    disembarks = [r for r in log.log if r.action == PASSENGER_DISEMBARK]
+    embarks = [r for r in log.log if r.action == PASSENGER_EMBARK]
+    assert [r.object_id for r in disembarks[::2]] == [p.id for p in riders[0::2]]
+    assert len(embarks) == 2*(Bus.BUS_MAX_CAPACITY - 3)
+    for records in [disembarks, embarks]:
+        starts, finishes = records[::2], records[1::2]
+        for start, finish in zip(starts, finishes):
+            assert start.id == finish.id
+            assert start.status == "DISPATCHED" and finish.status == "FINISHED"
+            assert start.time <= finish.time
+        for finish, next_start in zip(finishes, starts[1:]):
+            assert finish.time == next_start.time
+
+    # the bus moves on once the dwell is over
+    ev.run(max_events=1)
+    assert [(r.action, r.status) for r in log.log if r.object_type == "Bus" and r.object_id == bus.id] == [
+        (BUS_DWELL, "DISPATCHED"), (BUS_MOVE, "DISPATCHED"), (BUS_DWELL, "FINISHED")
+    ]
+
+
+def test_aggregate_dwell_impatience():
+    log = InMemoryLog()
+    ev = EventManager(log)
+    stop = Stop(ev)
+    stop.next = stop
+    bus = Bus(ev, stop, dwell_mode="aggregate")
+    bus.passengers = [Passenger(ev, stop, stops_traveling=100) for _ in range(20)]
+
+    # the second in line gives up before the first has finished boarding
+    waiting = [Passenger(ev, stop, arrival_time=-Passenger.PATIENCE + (0.5 if i == 1 else 10)) for i in range(4)]
+    for p in waiting:
+        stop.passengers_waiting.appendleft(p)
+    bus.disembark()
+
+    # they stay in line until their own timer runs out, the others board past them
+    assert list(stop.passengers_waiting) == [waiting[1]]
+    assert bus.n_passengers == 23
+
+    # each boarding passenger stops waiting when their turn to board comes
+    embarks = {r.object_id: r.time for r in log.log if r.action == PASSENGER_EMBARK and r.status == "DISPATCHED"}
+    cancels = {r.object_id: r.time for r in log.log if r.action == PASSENGER_JOIN_QUEUE and r.status == "CANCELLED"}
+    assert cancels == embarks and len(set(cancels.values())) == 3
+
+    ev.run(stop_time=1)
+    assert not stop.passengers_waiting
+    assert [r.time for r in log.log if r.action == PASSENGER_ABANDON_QUEUE and r.object_id == waiting[1].id
+            and r.status == "DISPATCHED"] == [0.5]
+
+
+def test_aggregate_dwell_validation():
+    with raises(ValueError):
+        Bus(EventManager(VoidLog()), None, dwell_mode="nope")
+
+
+def test_riders_bucketed_by_destination():
+    ev = EventManager(VoidLog())
+    stop = Stop(ev)
+    bus = Bus(ev, stop)
+
+    # riders who boarded at different stops and get off at the same one leave in the order they boarded
+    first, second, third = [Passenger(ev, stop) for _ in range(3)]
+    first.stops_remaining, second.stops_remaining, third.stops_remaining = 2, 3, 1
+    bus.passengers = [first, second]
+    bus._stops_visited += 1
+    bus._seat(third)
+
+    assert bus.n_passengers == 3
+    assert bus.alighting() == []
+    bus._stops_visited += 1
+    assert bus.alighting() == [first, third]
+    assert bus.passengers == (first, third, second)
+
+
+def test_follows_route():
+    ev = EventManager(VoidLog())
+    visits = []
+
+    class stop:
+        def __init__(self, name):
+            self.name = name
+
+        def depart(self):
+            pass
+
+        def park(self, bus):
+            visits.append(self.name)
+            bus.move()
+
+    # stops on several routes don't know where each bus goes next, the bus keeps its own place on its route
+    a, b, c = stop("a"), stop("b"), stop("c")
+    bus = Bus(ev, b, route=[a, b, c])
+    bus.move()
+    ev.run(max_events=4)
+
+    assert visits == ["c", "a", "b", "c"]
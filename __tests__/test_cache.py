@@ -0,0 +1,67 @@
+import os
+
+import pandas as pd
+
+import analysis.cache as cache_module
+from analysis.cache import ResultCache, cell_key
+from src.passenger import Passenger
+
+
+def test_put_get(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cell_key(n_buses=2, seed=1)
+    assert key not in cache and cache.get(key) is None
+
+    events = pd.DataFrame({"event_id": [0, 1], "time": [0.0, 1.5]})
+    cache.put(key, {"n_buses": 2, "seed": 1}, {"wait": {"mean": 1.5}}, events)
+    assert key in cache and len(cache) == 1
+    assert cache.get(key) == {"wait": {"mean": 1.5}}
+    pd.testing.assert_frame_equal(cache.get_events(key), events)
+    assert list(cache.entries()["n_buses"]) == [2]
+
+    # entries survive a restart, and so do the times they were last read once flushed
+    cache.get(key)
+    cache.flush()
+    reopened = ResultCache(str(tmp_path))
+    assert reopened.manifest[key]["last_used"] == cache.manifest[key]["last_used"]
+    assert reopened.get(key) == {"wait": {"mean": 1.5}}
+
+    reopened.remove(key)
+    assert key not in reopened and not os.path.exists(tmp_path / key)
+
+
+def test_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    keys = [cell_key(seed=i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, {"seed": i}, {"x": i})
+    entry_size = cache.manifest[keys[0]]["size"]
+
+    # the least recently used entry goes first, reads count as use
+    cache.manifest[keys[0]]["last_used"] += 100
+    cache.max_bytes = 3 * entry_size
+    cache.put(cell_key(seed=3), {"seed": 3}, {"x": 3})
+    assert keys[1] not in cache and keys[0] in cache and keys[2] in cache
+    assert cache.size <= cache.max_bytes
+    assert not os.path.exists(tmp_path / keys[1])
+
+
+def test_invalidation(tmp_path, monkeypatch):
+    key = cell_key(n_buses=2, seed=1)
+
+    # the key covers the model constants and the model code
+    monkeypatch.setattr(Passenger, "PATIENCE", Passenger.PATIENCE + 1)
+    assert cell_key(n_buses=2, seed=1) != key
+    monkeypatch.undo()
+    monkeypatch.setattr(cache_module, "MODEL_VERSION", "changed")
+    assert cell_key(n_buses=2, seed=1) != key
+
+    # entries written by another version of the model are stale
+    cache = ResultCache(str(tmp_path))
+    cache.put(key, {"n_buses": 2}, {"x": 1})
+    monkeypatch.undo()
+    fresh = cell_key(n_buses=3)
+    cache.put(fresh, {"n_buses": 3}, {"x": 2})
+    assert list(cache.entries().sort_values("n_buses")["stale"]) == [True, False]
+    assert cache.prune() == 1
+    assert key not in cache and fresh in cache
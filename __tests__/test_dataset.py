@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+
+from src.log import CSVLog, LogFilter
+from src.sim import Sim
+from src.actions import BUS_MOVE
+from analysis.dataset import Dataset
+from analysis.preprocessing import preprocess, make_passenger_df
+
+
+def _sweep(path, n_buses, n_runs, seed):
+    """Writes logs named like those of analysis.runner"""
+    os.makedirs(path)
+    for bus_i in n_buses:
+        for run_i in range(n_runs):
+            log = CSVLog(path=path, msg=f"{bus_i}_{run_i}")
+            Sim(bus_i, log=LogFilter(log, keep=lambda r: r.action != BUS_MOVE), seed=seed + run_i).run(stop_time=60)
+
+
+def test_dataset(tmp_path):
+    sweep = str(tmp_path / "sweep")
+    _sweep(sweep, [2, 3], 2, seed=1)
+
+    store = Dataset(str(tmp_path / "store"))
+    assert store.ingest(sweep, chunksize=100) == [(2, 0), (2, 1), (3, 0), (3, 1)]
+    assert store.partitions == [(2, 0), (2, 1), (3, 0), (3, 1)]
+    # nothing changed, nothing to do
+    assert store.ingest(sweep) == []
+
+    # the events read back like the csv log, whatever the chunk size they were written with
+    f_name = [name for name in sorted(os.listdir(sweep)) if name.startswith("log_3_1_")][0]
+    raw = pd.read_csv(os.path.join(sweep, f_name))
+    events = store.load("events", n_buses=[3], run_ids=[1])
+    assert list(events["event_id"]) == list(raw["event_id"])
+    assert list(events["action"]) == list(raw["action"])
+
+    # only the requested columns and partitions are read, derived tables are computed from the events
+    passengers = store.load("passengers", columns=["object_id", "wait_duration"], n_buses=[2])
+    assert list(passengers.columns) == ["object_id", "wait_duration", "n_buses", "run_id"]
+    assert set(passengers["n_buses"]) == {2} and set(passengers["run_id"]) == {0, 1}
+    expected = make_passenger_df(preprocess(pd.read_csv(
+        os.path.join(sweep, [name for name in sorted(os.listdir(sweep)) if name.startswith("log_2_0_")][0]))))
+    assert list(passengers[passengers["run_id"] == 0]["wait_duration"]) == list(expected["wait_duration"])
+    store.load("passengers")
+    assert store.prune_cache() == 0
+
+    # a rerun replaces a partition, the tables derived from the old log are stale
+    rerun = str(tmp_path / "rerun")
+    _sweep(rerun, [3], 1, seed=5)
+    assert store.ingest(rerun) == [(3, 0)]
+    assert store.prune_cache() == 2
+    assert len(store.load("passengers", n_buses=[3], run_ids=[0])) > 0
+
+    # the manifest is kept on disk
+    assert Dataset(str(tmp_path / "store")).partitions == store.partitions
@@ -49,3 +49,128 @@ def test_firing_order_loaded_dynamically():
 
     sim.run(1000)
     assert sim.time == 10
+
+
+def test_ties_fire_in_dispatch_order():
+    ev = EventManager(VoidLog())
+    calls = []
+
+    for i in range(10):
+        ev.dispatch(None, "", 5, lambda i=i: calls.append(i))
+    ev.run()
+
+    assert calls == list(range(10))
+    assert ev.time == 5
+
+
+def test_callback_args_and_logging():
+    log = InMemoryLog()
+    ev = EventManager(log)
+    calls = []
+
+    def cb(a, b):
+        calls.append((a, b))
+        return a + b
+
+    ev.dispatch("obj", "ACTION", 1, cb, data="start", args=(1, 2))
+    ev.dispatch("obj", "ACTION", 2)
+    ev.run()
+
+    assert calls == [(1, 2)]
+    assert [(r.time, r.status, r.data) for r in log.log] == [
+        (0, "DISPATCHED", "start"), (0, "DISPATCHED", None), (1, "FINISHED", 3), (2, "FINISHED", None)
+    ]
+
+
+def test_disabled_log_gets_no_records():
+    class CountingLog(VoidLog):
+        n = 0
+
+        def record(self, *args):
+            CountingLog.n += 1
+
+    ev = EventManager(CountingLog())
+    ev.dispatch(None, "", 1)
+    ev.run()
+    assert CountingLog.n == 0
+
+
+def test_cancel():
+    log = InMemoryLog()
+    ev = EventManager(log)
+    calls = []
+
+    handles = [ev.dispatch(None, "", i, calls.append, args=(i,)) for i in range(10)]
+    ev.cancel(handles[3])
+    ev.cancel(handles[3])
+    ev.run(max_events=5)
+
+    # cancelled events are skipped, and don't count towards max_events
+    assert calls == [0, 1, 2, 4, 5]
+    assert [r.status for r in log.log if r.id == handles[3].id] == ["DISPATCHED", "CANCELLED"]
+
+    # cancelling a finished event does nothing
+    ev.cancel(handles[0])
+    ev.run()
+    assert calls == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert len([r for r in log.log if r.status == "CANCELLED"]) == 1
+
+
+def test_compaction():
+    ev = EventManager(VoidLog())
+    handles = [ev.dispatch(None, "", 1) for _ in range(2*EventManager.COMPACT_MIN_CANCELLED)]
+    for handle in handles[:EventManager.COMPACT_MIN_CANCELLED + 1]:
+        ev.cancel(handle)
+
+    # cancelled events were dropped from the heap once they were the majority
+    assert len(ev.queue) == EventManager.COMPACT_MIN_CANCELLED - 1
+    assert ev._n_cancelled == 0
+
+
+def test_profiling():
+    log = InMemoryLog()
+    ev = EventManager(log)
+    profiler = ev.profile()
+    with raises(ValueError):
+        ev.profile()
+
+    def chain(n):
+        if n > 0:
+            ev.dispatch(None, "CHAIN", 1, chain, args=(n - 1,))
+
+    ev.dispatch(None, "CHAIN", 1, chain, args=(2,))
+    cancelled = ev.dispatch(None, "TIMER", 10)
+    ev.cancel(cancelled)
+    ev.run()
+
+    # counters per action, and the log still gets every record
+    chain_stats = profiler.actions["CHAIN"]
+    assert (chain_stats.dispatched, chain_stats.finished, chain_stats.executed) == (3, 3, 3)
+    assert sum(chain_stats.histogram) == 3
+    assert profiler.actions["TIMER"].cancelled == 1
+    assert profiler.n_events == 3
+    assert profiler.n_records == len(log.log) == 8
+    assert profiler.peak_heap == 2
+    assert profiler.wall_time >= profiler.callback_time >= 0
+    assert ev.log is log
+
+    assert list(profiler.to_dataframe()["action"].sort_values()) == ["CHAIN", "TIMER"]
+    assert '"CHAIN"' in profiler.to_json()
+
+    # once profiling stops, the log is back to normal and nothing else is counted
+    assert ev.stop_profiling() is profiler
+    ev.dispatch(None, "CHAIN", 1)
+    ev.run()
+    assert chain_stats.dispatched == 3
+    assert len(log.log) == 10
+
+
+def test_profiling_disabled_log():
+    ev = EventManager(VoidLog())
+    profiler = ev.profile()
+    ev.dispatch(None, "A", 1)
+    ev.run()
+
+    # events are counted even though the log throws its records away
+    assert profiler.actions["A"].dispatched == profiler.actions["A"].finished == 1
+    assert profiler.n_records == 0
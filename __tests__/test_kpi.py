@@ -0,0 +1,87 @@
+import numpy as np
+from pytest import raises, approx
+
+from src.kpi import RunningStats, P2Quantile, KPILog
+from src.log import InMemoryLog, ColumnarLog
+from src.sim import Sim
+from src.actions import PASSENGER_ABANDON_QUEUE, PASSENGER_JOIN_QUEUE
+from analysis.preprocessing import preprocess, make_passenger_df
+
+
+def test_running_stats():
+    xs = np.random.default_rng(0).normal(5, 2, 1000)
+    stats = RunningStats()
+    for x in xs:
+        stats.add(x)
+
+    assert stats.count == 1000
+    assert stats.mean == approx(xs.mean())
+    assert stats.variance == approx(xs.var(ddof=1))
+    assert (stats.min, stats.max) == (xs.min(), xs.max())
+
+
+def test_p2_quantile():
+    xs = np.random.default_rng(0).exponential(3, 20000)
+    for p in [0.1, 0.5, 0.9, 0.99]:
+        q = P2Quantile(p)
+        for x in xs:
+            q.add(x)
+        assert q.value == approx(np.quantile(xs, p), rel=0.05)
+
+    q = P2Quantile(0.5)
+    assert np.isnan(q.value)
+    for x in [3, 1, 2]:
+        q.add(x)
+    assert q.value == 2
+
+    with raises(ValueError):
+        P2Quantile(1)
+
+
+def test_kpi_log_matches_passenger_df():
+    in_memory = InMemoryLog()
+    Sim(4, log=in_memory, seed=3).run(stop_time=12*60)
+
+    kpi = KPILog()
+    columnar = ColumnarLog()
+    for record in in_memory.log:
+        kpi.write(record)
+        columnar.write(record)
+
+    passengers = make_passenger_df(preprocess(columnar.to_dataframe()))
+    summary = kpi.summary()
+
+    assert summary.n_passengers == len(passengers) > 0
+    assert summary.wait.mean == approx(passengers["wait_duration"].mean())
+    assert summary.transit.mean == approx(passengers["transit_duration"].mean())
+    assert summary.wait_transit_ratio.variance == approx(passengers["wait_transit_ratio"].var())
+    assert summary.n_abandoned == len([r for r in in_memory.log
+                                       if r.action == PASSENGER_ABANDON_QUEUE and r.status == "DISPATCHED"])
+
+    # every stop had a queue at some point, and the average is below the peak
+    assert len(summary.queue_length) == Sim.n_stops
+    for stop_id, mean in summary.queue_length.items():
+        assert 0 <= mean <= summary.max_queue_length[stop_id]
+
+    # only passengers still in the system are remembered
+    assert len(kpi._waiting) + len(kpi._boarding) + len(kpi._riding) < summary.n_passengers
+
+
+def test_kpi_log_max_queue_length_burnin():
+    class Passenger:
+        def __init__(self, id):
+            self.id = id
+
+    kpi = KPILog(burnin=10)
+    # stop 0 peaks at 5 during the burn-in and carries 1 out of it, stop 1 holds 3 from the burn-in on
+    for i in range(5):
+        kpi.record(i, 1 + i, Passenger(i), PASSENGER_JOIN_QUEUE, "DISPATCHED", 0)
+    for i in range(4):
+        kpi.record(i, 6 + i, Passenger(i), PASSENGER_ABANDON_QUEUE, "DISPATCHED")
+    for i in range(5, 8):
+        kpi.record(i, 1, Passenger(i), PASSENGER_JOIN_QUEUE, "DISPATCHED", 1)
+    kpi.record(8, 12, Passenger(8), PASSENGER_JOIN_QUEUE, "DISPATCHED", 0)
+    kpi.record(4, 15, Passenger(4), PASSENGER_ABANDON_QUEUE, "DISPATCHED")
+
+    assert kpi.summary().max_queue_length == {0: 2, 1: 3}
+    assert kpi.summary().queue_length[0] == approx((1*2 + 2*3) / 5)
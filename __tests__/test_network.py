@@ -0,0 +1,53 @@
+import numpy as np
+from pytest import raises
+
+from src.network import Network
+from src.stop import ARRIVAL_RATES
+
+
+def test_init():
+    network = Network([[0, 1, 2], [2, 3]])
+    assert network.n_stops == 4
+    assert network.routes == [[0, 1, 2], [2, 3]]
+    assert (network.demand == np.array(ARRIVAL_RATES)).all()
+
+    demand = np.ones((6, 24))
+    assert Network([[0, 1]], demand).n_stops == 6
+
+
+def test_init_bad_inputs():
+    with raises(ValueError):
+        Network([])
+    with raises(ValueError):
+        Network([[0, 1], []])
+    with raises(ValueError):
+        Network([[-1, 0]])
+    with raises(ValueError):
+        Network([[0, 1]], np.ones((2, 12)))
+    with raises(ValueError):
+        Network([[0, 1]], -np.ones((2, 24)))
+    with raises(ValueError):
+        Network([[0, 5]], np.ones((2, 24)))
+
+
+def test_loop():
+    assert Network.loop(3).routes == [[0, 1, 2]]
+    with raises(ValueError):
+        Network.loop(0)
+
+
+def test_random():
+    network = Network.random(50, 4, 10, seed=1)
+    assert network.n_stops == 50
+    assert len(network.routes) == 4
+    assert all(len(set(route)) == 10 for route in network.routes)
+    assert Network.random(50, 4, 10, seed=1).routes == network.routes
+
+
+def test_save_load(tmp_path):
+    network = Network.random(20, 3, 5, seed=0)
+    network.save(tmp_path / "network.npz")
+    loaded = Network.load(tmp_path / "network.npz")
+
+    assert loaded.routes == network.routes
+    assert (loaded.demand == network.demand).all()
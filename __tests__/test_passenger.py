@@ -49,4 +49,10 @@ def test_dispatches_events():
     p = Passenger(ev, Stop(ev))
     p.disembark(1, lambda: None)
     p.embark(1000, lambda: None)
-    assert [record.action for record in log.log] == [PASSENGER_JOIN_QUEUE, PASSENGER_DISEMBARK, PASSENGER_EMBARK]
+    # embarking cancels the passenger's patience timer
+    assert [(record.action, record.status) for record in log.log] == [
+        (PASSENGER_JOIN_QUEUE, "DISPATCHED"),
+        (PASSENGER_DISEMBARK, "DISPATCHED"),
+        (PASSENGER_JOIN_QUEUE, "CANCELLED"),
+        (PASSENGER_EMBARK, "DISPATCHED"),
+    ]
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+from src.log import CSVLog
+from src.sim import Sim
+from analysis.preprocessing import iter_preprocess, preprocess_chunked, preprocess, ignore_burnin, max_queue_len
+
+
+def _normalize(df):
+    """Sorted by event id with plain columns, chunks build their categoricals from different categories"""
+    df = df.sort_values("event_id", ignore_index=True)
+    return df.astype({col: str for col in ["action", "object_type"]})
+
+
+def test_iter_preprocess_matches_preprocess(tmp_path):
+    log = CSVLog(path=str(tmp_path), msg="test")
+    Sim(4, log=log, seed=2).run(stop_time=3*60)
+    full = preprocess(pd.read_csv(log.f_name))
+    expected = _normalize(ignore_burnin(full, 30))
+
+    # small chunks, so that most passengers join a queue in one chunk and get on a bus in a later one
+    chunks = list(iter_preprocess(pd.read_csv(log.f_name, chunksize=200), burnin=30))
+    assert len(chunks) > 10
+    streamed = _normalize(pd.concat(chunks, ignore_index=True))
+    pd.testing.assert_frame_equal(streamed, expected)
+
+    # the file version writes the same rows and finds the same longest queue
+    out_path = str(tmp_path / "preprocessed.csv")
+    longest = preprocess_chunked(log.f_name, out_path, chunksize=200, burnin=30)
+    assert longest == max_queue_len(expected) > 0
+    written = _normalize(pd.read_csv(out_path))
+    assert list(written.columns) == list(expected.columns)
+    assert list(written["event_id"]) == list(expected["event_id"])
+    assert np.allclose(written["duration"], expected["duration"])
@@ -0,0 +1,47 @@
+from pytest import raises
+
+from src.random_source import RandomSource
+
+
+def test_seeded_sources_agree():
+    a = RandomSource(seed=42, block_size=8)
+    b = RandomSource(seed=42, block_size=8)
+
+    # long enough to cross several buffer refills
+    for _ in range(100):
+        assert a.bus.normal(3, 0.5) == b.bus.normal(3, 0.5)
+        assert a.stop.exponential(2) == b.stop.exponential(2)
+        assert a.passenger.randint(1, 7) == b.passenger.randint(1, 7)
+
+
+def test_streams_are_independent():
+    a = RandomSource(seed=42)
+    b = RandomSource(seed=42)
+
+    # draining one stream in a source does not shift the draws of any other stream
+    for _ in range(1000):
+        a.passenger.normal()
+    assert [a.bus.normal() for _ in range(10)] == [b.bus.normal() for _ in range(10)]
+    assert [a.bus.normal() for _ in range(10)] != [a.stop.normal() for _ in range(10)]
+
+
+def test_distributions():
+    source = RandomSource(seed=0)
+    n = 20000
+
+    normals = [source.bus.normal(loc=3, scale=0.5) for _ in range(n)]
+    assert abs(sum(normals)/n - 3) < 0.05
+
+    exponentials = [source.stop.exponential(scale=2) for _ in range(n)]
+    assert min(exponentials) >= 0
+    assert abs(sum(exponentials)/n - 2) < 0.1
+
+    ints = [source.passenger.randint(1, 7) for _ in range(n)]
+    assert set(ints) == set(range(1, 8))
+
+
+def test_validation():
+    with raises(ValueError):
+        RandomSource(block_size=0)
+    with raises(ValueError):
+        RandomSource().passenger.randint(5, 1)
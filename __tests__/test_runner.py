@@ -0,0 +1,174 @@
+import os
+
+import pandas as pd
+from pytest import raises
+
+import analysis.runner as runner
+from analysis.cache import ResultCache, cell_key
+from analysis.runner import replication_seed, run_parallel, warm_snapshot, run_forked, run_cached, run_sequential, \
+    confidence_interval
+from src.passenger import Passenger
+from src.sim import Sim
+
+
+def test_replication_seed():
+    seeds = {(n_buses, run_id): replication_seed(1, n_buses, run_id) for n_buses in (2, 3) for run_id in range(3)}
+
+    # the same cell always gets the same seed, and every cell gets its own
+    assert seeds == {cell: replication_seed(1, *cell) for cell in seeds}
+    assert len(set(seeds.values())) == len(seeds)
+    assert replication_seed(2, 2, 0) != seeds[(2, 0)]
+
+
+def test_run_parallel_is_reproducible():
+    first = run_parallel([2, 3], n_runs=2, sim_duration=30, seed=1, in_memory=True, max_workers=1)
+    second = run_parallel([2, 3], n_runs=2, sim_duration=30, seed=1, in_memory=True, max_workers=1)
+
+    assert len(first) > 0
+    assert sorted(set(zip(first["n_buses"], first["run_id"]))) == [(2, 0), (2, 1), (3, 0), (3, 1)]
+    pd.testing.assert_frame_equal(first, second)
+
+
+class _FlakySim(Sim):
+    """Fails the first run of every cell, the marker files are shared with the forked workers"""
+    markers = ""
+
+    def __init__(self, *args, seed=None, **kwargs):
+        super().__init__(*args, seed=seed, **kwargs)
+        self.marker = os.path.join(_FlakySim.markers, str(seed))
+
+    def run(self, *args, **kwargs):
+        if not os.path.exists(self.marker):
+            open(self.marker, "w").close()
+            raise RuntimeError("worker failed")
+        return super().run(*args, **kwargs)
+
+
+def test_run_parallel_retries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("markers")
+    monkeypatch.setattr(_FlakySim, "markers", str(tmp_path / "markers"))
+    monkeypatch.setattr(runner, "Sim", _FlakySim)
+
+    runs = run_parallel([2], n_runs=2, sim_duration=30, seed=1, max_workers=1)
+
+    # every replication failed once and was rerun, only the logs of the successful attempts are left
+    assert len(os.listdir("markers")) == 2
+    assert all(os.path.exists(f_name) for f_name in runs["path"])
+    assert sorted(f for f in os.listdir(os.path.dirname(runs["path"][0])) if f.endswith(".csv")) == \
+        sorted(os.path.basename(f_name) for f_name in runs["path"])
+
+    # a replication that keeps failing abandons the sweep
+    with raises(RuntimeError):
+        run_parallel([3], n_runs=1, sim_duration=30, seed=1, max_workers=1, max_retries=0)
+
+
+def test_run_forked(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "snapshots")
+    snapshot = warm_snapshot(3, burnin=60, seed=1, cache_dir=cache_dir)
+    f_name = f"warm_{cell_key(n_buses=3, burnin=60, seed=1)}.pkl"
+    assert os.listdir(cache_dir) == [f_name]
+
+    # the cached snapshot is reused rather than run again
+    with open(os.path.join(cache_dir, f_name), "wb") as f:
+        f.write(b"cached")
+    assert warm_snapshot(3, burnin=60, seed=1, cache_dir=cache_dir) == b"cached"
+
+    # unless the model changed since
+    with monkeypatch.context() as patch:
+        patch.setattr(Passenger, "PATIENCE", Passenger.PATIENCE + 1)
+        assert warm_snapshot(3, burnin=60, seed=1, cache_dir=cache_dir) != b"cached"
+        assert len(os.listdir(cache_dir)) == 2
+
+    first = run_forked(snapshot, n_runs=2, sim_duration=90, seed=1, max_workers=1)
+    second = run_forked(snapshot, n_runs=2, sim_duration=90, seed=1, max_workers=1)
+    other = run_forked(snapshot, n_runs=2, sim_duration=90, seed=2, max_workers=1)
+
+    # only what happens after the burn-in is logged, the same seed gives the same runs and each run its own
+    assert len(first) > 0 and first["time"].min() >= 60
+    pd.testing.assert_frame_equal(first, second)
+    runs = [df.drop(columns=["run_id", "event_id"]).reset_index(drop=True) for _, df in first.groupby("run_id")]
+    assert not runs[0].equals(runs[1])
+    assert not first.drop(columns="event_id").equals(other.drop(columns="event_id"))
+
+
+def test_run_cached(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    first = run_cached([2, 3], n_runs=2, sim_duration=60, seed=1, cache=cache, max_workers=1)
+    assert len(first) == 4 and not first["cached"].any()
+    assert len(cache) == 4
+
+    # a second sweep that overlaps the first only runs the new cells
+    second = run_cached([2, 3], n_runs=3, sim_duration=60, seed=1, cache=cache, max_workers=1)
+    assert list(second["cached"]) == [True, True, False, True, True, False]
+    merged = second[second["run_id"] < 2].drop(columns="cached").reset_index(drop=True)
+    pd.testing.assert_frame_equal(merged, first.drop(columns="cached"), check_like=True)
+
+
+def test_run_cached_evicting(tmp_path):
+    # room for barely one entry, so storing new results evicts the ones this sweep just read or stored
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=3000)
+    run_cached([2], n_runs=1, sim_duration=60, seed=1, cache=cache, max_workers=1)
+    runs = run_cached([2, 3], n_runs=2, sim_duration=60, seed=1, cache=cache, max_workers=1)
+
+    assert len(runs) == 4 and list(runs["cached"]) == [True, False, False, False]
+    assert runs["n_passengers"].notna().all()
+    assert cache.size <= 3000
+
+
+def test_run_sequential():
+    summary, runs = run_sequential([2, 3, 5], sim_duration=60, seed=1, kpis=["wait", "max_queue_length"],
+                                   rel_half_width=0.1, batch_size=2, min_runs=2, max_runs=20, max_workers=1)
+
+    # the runs table holds every replication each cell was counted with
+    assert list(summary.index) == [2, 3, 5]
+    assert summary["n_runs"].to_dict() == runs.groupby("n_buses").size().to_dict()
+    assert all(sorted(df["run_id"]) == list(range(len(df))) for _, df in runs.groupby("n_buses"))
+
+    # every cell stopped at the first batch that reached the target, not before and not after
+    assert summary["converged"].all() and len(set(summary["n_runs"])) > 1
+    for bus_i, cell in summary.iterrows():
+        df = runs[runs["n_buses"] == bus_i].sort_values("run_id")
+        for kpi in ["wait", "max_queue_length"]:
+            assert cell[f"{kpi}_rel_half_width"] <= 0.1
+            assert cell[f"{kpi}_mean"] == df[kpi].mean()
+        earlier = df.iloc[:int(cell["n_runs"]) - 2]
+        intervals = [confidence_interval(earlier[kpi], 0.95) for kpi in ["wait", "max_queue_length"]]
+        assert any(abs(half_width / mean) > 0.1 for mean, half_width in intervals)
+
+
+def test_run_sequential_max_runs(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    summary, runs = run_sequential([3], sim_duration=60, seed=1, rel_half_width=1e-6, batch_size=2, min_runs=2,
+                                   max_runs=5, cache=cache, max_workers=1)
+
+    # an unreachable target stops at max_runs, even partway through a batch
+    assert summary.loc[3, "n_runs"] == 5 and len(runs) == 5
+    assert not summary.loc[3, "converged"]
+
+    # the replications are kept for the next sweep, which gives the same estimates from them
+    assert len(ResultCache(str(tmp_path / "cache"))) == 5
+    cached_summary, _ = run_sequential([3], sim_duration=60, seed=1, rel_half_width=1e-6, batch_size=2, min_runs=2,
+                                       max_runs=5, cache=cache, max_workers=1)
+    pd.testing.assert_frame_equal(cached_summary, summary)
+
+
+def test_run_sequential_workers():
+    # whichever worker finishes first, the cells get the same replications and the same estimates
+    args = dict(sim_duration=60, seed=1, kpis=("wait",), rel_half_width=0.15, batch_size=2, min_runs=2)
+    summary, runs = run_sequential([2, 4], max_workers=1, **args)
+    parallel_summary, parallel_runs = run_sequential([2, 4], max_workers=2, **args)
+    pd.testing.assert_frame_equal(summary, parallel_summary)
+    pd.testing.assert_frame_equal(runs, parallel_runs)
+
+
+def test_run_sequential_kpis():
+    with raises(ValueError):
+        run_sequential([2], sim_duration=60, seed=1, kpis=[])
+    with raises(ValueError):
+        run_sequential([2], sim_duration=60, seed=1, kpis=["throughput"])
+
+    # any iterable of names will do
+    summary, _ = run_sequential([2], sim_duration=60, seed=1, kpis={"wait"}, rel_half_width=0.5, min_runs=2,
+                                max_workers=1)
+    assert "wait_mean" in summary and "max_queue_length_mean" not in summary
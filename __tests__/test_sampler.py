@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from src.sampler import QueueSampler
+from src.sim import Sim
+from src.stop import Stop
+from src.kpi import KPILog
+from src.event_manager import EventManager
+from src.log import VoidLog
+from src.random_source import RandomSource
+from src.actions import STOP_REPORT_QUEUE_LENGTH, SAMPLE_QUEUE_LENGTHS
+
+
+def test_init_bad_inputs():
+    with pytest.raises(ValueError):
+        QueueSampler(EventManager(VoidLog()), [], interval=0)
+    with pytest.raises(ValueError):
+        Sim(3, queue_sampling="nope")
+    with pytest.raises(ValueError):
+        Sim(3, queue_sampling="stop", queue_integrals=True)
+
+
+def test_matches_stop_reports():
+    per_stop = Sim(3, seed=1, queue_sampling="stop")
+    per_stop.run(stop_time=305)
+    sampled = Sim(3, seed=1)
+    sampled.run(stop_time=305)
+
+    # one event per tick instead of one per stop, with the same queue lengths
+    assert not any(r.action == STOP_REPORT_QUEUE_LENGTH for r in sampled.log.log)
+    ticks = [r for r in sampled.log.log if r.action == SAMPLE_QUEUE_LENGTHS and r.status == "DISPATCHED"]
+    assert len(ticks) == sampled.sampler.n_samples == 31
+    assert sampled.sampler.times.tolist() == [10.0 * i for i in range(31)]
+
+    reports = {}
+    position = {stop.id: i for i, stop in enumerate(per_stop.route)}
+    for r in per_stop.log.log:
+        if r.action == STOP_REPORT_QUEUE_LENGTH and r.status == "DISPATCHED":
+            reports.setdefault(position[r.object_id], []).append(r.data)
+    assert [reports[i] for i in range(Sim.n_stops)] == sampled.sampler.samples.tolist()
+
+    df = sampled.sampler.to_dataframe()
+    assert df.shape == (31, Sim.n_stops) and list(df.columns) == [stop.id for stop in sampled.route]
+
+
+def test_matrix_grows():
+    ev = EventManager(VoidLog(), RandomSource(0))
+    stops = [Stop(ev) for _ in range(3)]
+    for stop in stops:
+        stop.start(report=False)
+    sampler = QueueSampler(ev, stops, interval=5, integrals=True, capacity=2)
+    sampler.start()
+    ev.run(stop_time=98)
+
+    assert sampler.samples.shape == (3, 20) and sampler.areas.shape == (3, 20)
+    assert (sampler.times == np.arange(20) * 5.0).all()
+    assert sampler.interval_means().shape == (3, 19)
+
+
+@pytest.mark.parametrize("arrival_mode", ["event", "batch", "lazy", "sparse"])
+def test_integrals_are_exact(arrival_mode):
+    log = KPILog()
+    sim = Sim(4, log=log, seed=2, arrival_mode=arrival_mode, queue_integrals=True)
+    sim.run(stop_time=8*60)
+    end = sim.event_manager.time
+
+    # brings every stop up to date first, which logs the latest arrivals in batch and lazy mode
+    mean_queue_length = sim.sampler.mean_queue_length()
+    queue_length = log.summary().queue_length
+
+    # the log only hears about passengers in lazy and sparse mode once they leave the queue, so the ones still
+    # waiting are added back
+    expected = []
+    for stop in sim.route:
+        area = queue_length.get(stop.id, 0) * end
+        if arrival_mode in ("lazy", "sparse"):
+            waiting = stop._passengers_waiting
+            area += (end - waiting.arrival[waiting._head:waiting._tail]).sum()
+        expected.append(area / end)
+
+    assert mean_queue_length == pytest.approx(expected)
+
+    # the mean over each interval averages out to the mean over the whole run
+    whole = sim.sampler.interval_means() @ np.diff(sim.sampler.times) / (sim.sampler.times[-1] - sim.sampler.times[0])
+    assert whole == pytest.approx(sim.sampler.areas[:, -1] / sim.sampler.times[-1])
+
+
+def test_integrals_needed():
+    sim = Sim(2, seed=0)
+    with pytest.raises(ValueError):
+        sim.sampler.mean_queue_length()
+    with pytest.raises(ValueError):
+        sim.sampler.interval_means()
@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from src.scheduler import HeapScheduler, CalendarQueue, SCHEDULERS
+from src.event_manager import EventManager
+from src.log import VoidLog
+from src.sim import Sim
+
+
+class _Event:
+    def __init__(self):
+        self.done = False
+
+
+@pytest.mark.parametrize("scheduler", list(SCHEDULERS))
+def test_pops_in_order(scheduler):
+    rng = random.Random(0)
+    queue = SCHEDULERS[scheduler]()
+    reference = HeapScheduler()
+
+    # pushes never go before the last pop, with ties, bursts of nearly equal times and far off events mixed in
+    now, event_id = 0.0, 0
+    for _ in range(50_000):
+        if rng.random() < 0.52 or not len(reference):
+            delay = rng.choice([rng.expovariate(1), 10.0, 0.0, rng.expovariate(100), 1000 * rng.random()])
+            entry = (now + delay, event_id, _Event())
+            event_id += 1
+            queue.push(entry)
+            reference.push(entry)
+        else:
+            entry = queue.pop()
+            assert entry is reference.pop()
+            now = entry[0]
+        assert len(queue) == len(reference)
+
+    assert sorted(queue) == sorted(reference)
+    with pytest.raises(IndexError):
+        for _ in range(len(reference) + 1):
+            queue.pop()
+
+
+@pytest.mark.parametrize("scheduler", list(SCHEDULERS))
+def test_remove_done(scheduler):
+    queue = SCHEDULERS[scheduler]()
+    push, pop = queue.bind()
+    entries = [(float(i % 7), i, _Event()) for i in range(100)]
+    for entry in entries:
+        push(entry)
+    for entry in entries[::2]:
+        entry[2].done = True
+
+    # what the event manager bound before the cleanup keeps working after it
+    queue.remove_done()
+    assert len(queue) == 50
+    assert [pop() for _ in range(50)] == sorted(entries[1::2])
+
+
+def test_calendar_queue_resizes():
+    queue = CalendarQueue()
+    with pytest.raises(ValueError):
+        CalendarQueue(width=0)
+
+    for i in range(1000):
+        queue.push((i * 0.01, i, _Event()))
+    assert queue.n_buckets >= 512
+    # the width follows the spacing of the entries
+    assert 0.01 <= queue.width <= 0.1
+
+    for _ in range(990):
+        queue.pop()
+    assert queue.n_buckets == CalendarQueue.MIN_BUCKETS
+
+
+def test_event_manager_with_calendar_queue():
+    ev = EventManager(VoidLog(), scheduler=CalendarQueue())
+    calls = []
+    handles = [ev.dispatch(None, "", 5 - i % 5, calls.append, args=(i,)) for i in range(10)]
+    ev.cancel(handles[0])
+    ev.run()
+    assert calls == [4, 9, 3, 8, 2, 7, 1, 6, 5]
+
+
+def test_sims_match():
+    def history(scheduler):
+        sim = Sim(5, seed=3, scheduler=scheduler)
+        sim.run(stop_time=600)
+        return [(r.time, r.action, r.status) for r in sim.log.log]
+
+    assert history("heap") == history("calendar")
+    with pytest.raises(ValueError):
+        Sim(5, scheduler="nope")
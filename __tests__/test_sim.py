@@ -1,7 +1,13 @@
+import numpy as np
 import pytest
 
 from src.sim import Sim
-from src.actions import BUS_MOVE
+from src.network import Network
+from src.stop import ARRIVAL_RATES
+from src.log import ColumnarLog, VoidLog
+from src.kpi import KPILog
+from src.actions import BUS_MOVE, PASSENGER_JOIN_QUEUE, SAMPLE_QUEUE_LENGTHS
+from analysis.preprocessing import preprocess, make_passenger_df
 
 
 def test_init():
@@ -11,7 +17,7 @@ def test_init():
     assert len(set([bus.stop for bus in sim.buses])) == 15
 
     # all the buses have been told to move
-    assert len(set([record.obj.id for record in sim.log.log if record.action == BUS_MOVE])) == 15
+    assert len(set([record.object_id for record in sim.log.log if record.action == BUS_MOVE])) == 15
 
     # route setup
     assert set(sim.route) == set([stop.next for stop in sim.route])
@@ -31,3 +37,112 @@ def test_init_bad_inputs():
 def test_finite_duration():
     sim = Sim(1)
     sim.run(10)
+
+
+def test_seeded_runs_are_reproducible():
+    def history(seed):
+        sim = Sim(3, seed=seed)
+        sim.run(stop_time=120)
+        return [(record.time, record.action, record.status) for record in sim.log.log]
+
+    assert history(7) == history(7)
+    assert history(7) != history(8)
+
+
+def test_aggregate_dwell_mode():
+    with pytest.raises(ValueError):
+        Sim(3, dwell_mode="nope")
+
+    log = ColumnarLog()
+    Sim(5, log=log, seed=2, dwell_mode="aggregate").run(stop_time=8*60)
+    passengers = make_passenger_df(preprocess(log.to_dataframe()))
+
+    assert len(passengers) > 0
+    assert (passengers["wait_duration"] >= 0).all()
+    assert (passengers["transit_duration"] > passengers["wait_duration"]).all()
+
+
+@pytest.mark.parametrize("dwell_mode", ["passenger", "aggregate"])
+def test_lazy_arrival_mode(dwell_mode):
+    log = ColumnarLog()
+    Sim(5, log=log, seed=2, dwell_mode=dwell_mode, arrival_mode="lazy").run(stop_time=8*60)
+    passengers = make_passenger_df(preprocess(log.to_dataframe()))
+
+    assert len(passengers) > 0
+    assert (passengers["wait_duration"] >= 0).all()
+    assert (passengers["transit_duration"] > passengers["wait_duration"]).all()
+
+
+def _records(log):
+    return [(r.time, r.action, r.status, r.object_type) for r in log.log]
+
+
+def test_snapshot_restore():
+    sim = Sim(5, seed=4)
+    sim.run(stop_time=2*60)
+    snapshot = sim.snapshot()
+
+    # the restored sim carries on exactly like the original
+    n_before = len(sim.log.log)
+    sim.run(stop_time=4*60)
+    restored = Sim.restore(snapshot)
+    assert restored.event_manager.time == pytest.approx(2*60, abs=5)
+    restored.run(stop_time=4*60)
+    assert _records(restored.log) == _records(sim.log)[n_before:]
+
+    # restored objects keep their ids, and nothing new reuses them
+    assert [stop.id for stop in restored.route] == [stop.id for stop in sim.route]
+    assert [bus.id for bus in restored.buses] == [bus.id for bus in sim.buses]
+    new = [r.object_id for r in restored.log.log if r.action == PASSENGER_JOIN_QUEUE and r.status == "DISPATCHED"]
+    old = [r.object_id for r in sim.log.log[:n_before] if r.action == PASSENGER_JOIN_QUEUE]
+    assert not set(new) & set(old)
+
+
+def test_forks_are_independent():
+    sim = Sim(5, log=VoidLog(), seed=4)
+    sim.run(stop_time=2*60)
+    snapshot = sim.snapshot()
+
+    forks = []
+    for seed in [1, 1, 2]:
+        fork = Sim.restore(snapshot, seed=seed)
+        fork.run(stop_time=3*60)
+        forks.append(_records(fork.log))
+    assert forks[0] == forks[1]
+    assert forks[0] != forks[2]
+
+
+def test_restored_sim_kpis():
+    sim = Sim(5, log=VoidLog(), seed=4)
+    sim.run(stop_time=2*60)
+
+    # passengers who were already waiting or riding are left out instead of breaking the log
+    log = KPILog()
+    Sim.restore(sim.snapshot(), log=log, seed=1).run(stop_time=4*60)
+    summary = log.summary()
+    assert summary.n_passengers > 0
+    assert all(length >= 0 for length in summary.queue_length.values())
+
+
+def test_network():
+    # two routes that share stop 2, and a stop that no route visits
+    network = Network([[0, 1, 2, 3], [2, 4, 5]], np.tile(ARRIVAL_RATES, (7, 1)))
+    log = ColumnarLog()
+    sim = Sim(4, log=log, seed=1, arrival_mode="sparse", network=network)
+
+    assert len(sim.route) == 7
+    assert [bus.route for bus in sim.buses] == [sim.routes[0], sim.routes[1]] * 2
+    assert [bus.stop for bus in sim.buses] == [sim.route[0], sim.route[2], sim.route[1], sim.route[4]]
+
+    # stops dispatch nothing in sparse mode, only the buses and the queue sampler are in the queue
+    assert sorted(entry[2].action for entry in sim.event_manager.queue) == [BUS_MOVE] * 4 + [SAMPLE_QUEUE_LENGTHS]
+
+    sim.run(stop_time=4*60)
+    passengers = make_passenger_df(preprocess(log.to_dataframe()))
+    assert len(passengers) > 0
+    assert (passengers["wait_duration"] >= 0).all()
+
+    # passengers at the stop nobody visits all walk away, and are logged when the run ends
+    df = log.to_dataframe()
+    joins = df[(df["action"] == PASSENGER_JOIN_QUEUE) & (df["status"] == "DISPATCHED")]
+    assert (joins["data"] == sim.route[6].id).sum() > 0
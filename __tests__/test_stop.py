@@ -1,7 +1,13 @@
-from src.stop import Stop
+from pytest import raises
+import numpy as np
+
+from src.stop import Stop, WaitingArrays, ARRIVAL_WINDOW, QUEUE_LEN_REPORT_FREQUENCY
 from src.event_manager import EventManager
+from src.random_source import RandomSource
 from src.log import InMemoryLog, VoidLog
-from src.actions import PASSENGER_JOIN_QUEUE
+from src.passenger import Passenger
+from src.actions import PASSENGER_JOIN_QUEUE, PASSENGER_ABANDON_QUEUE, STOP_PASSENGER_JOIN, STOP_ARRIVAL_WINDOW, \
+    STOP_REPORT_QUEUE_LENGTH
 
 
 def test_passenger_arrival():
@@ -43,3 +49,208 @@ def test_expected_arrival_interval():
     assert stop.expected_arrival_interval(1 * 60) == stop.expected_arrival_interval(25 * 60)
     assert stop.expected_arrival_interval(7 * 60) == stop.expected_arrival_interval(19 * 60)
     assert stop.expected_arrival_interval(7.1 * 60) == stop.expected_arrival_interval(19 * 60)
+
+
+def test_load_one_bus_at_a_time():
+    stop = Stop(EventManager(VoidLog()))
+    disembarks = []
+
+    class bus:
+        def __init__(self, name):
+            self.name = name
+
+        def disembark(self):
+            disembarks.append(self.name)
+
+    stop.park(bus("a"))
+    stop.park(bus("b"))
+
+    # the second bus waits instead of restarting the bus that is already loading
+    assert disembarks == ["a"]
+
+    stop.depart()
+    assert disembarks == ["a", "b"]
+
+
+def test_passenger_queue():
+    ev = EventManager(VoidLog())
+    stop = Stop(ev)
+    passengers = [Passenger(ev, stop) for _ in range(5)]
+    for p in passengers:
+        stop.passengers_waiting.appendleft(p)
+
+    # removing from the middle keeps everyone else in line
+    stop.remove_passenger(passengers[2])
+    stop.remove_passenger(passengers[2])
+    assert len(stop.passengers_waiting) == 4
+    assert passengers[2] not in stop.passengers_waiting
+    assert list(stop.passengers_waiting) == [passengers[0], passengers[1], passengers[3], passengers[4]]
+
+    # first in, first out
+    assert [stop.passengers_waiting.pop() for _ in range(4)] == [passengers[0], passengers[1], passengers[3], passengers[4]]
+    assert not stop.passengers_waiting
+    with raises(IndexError):
+        stop.passengers_waiting.pop()
+
+    # a bus can take passengers from anywhere in line
+    for p in passengers:
+        stop.passengers_waiting.appendleft(p)
+    assert list(stop.passengers_waiting.deadlines()) == [p.deadline for p in passengers]
+    assert stop.passengers_waiting.take([1, 3]) == [passengers[1], passengers[3]]
+    assert list(stop.passengers_waiting) == [passengers[0], passengers[2], passengers[4]]
+
+
+def test_batch_arrivals():
+    log = InMemoryLog()
+    ev = EventManager(log, RandomSource(3))
+    stop = Stop(ev, arrival_mode="batch")
+    stop.start()
+
+    # one window of arrivals is drawn up front, nothing else goes through the queue
+    assert sorted((entry[0], entry[2].action) for entry in ev.queue) == [
+        (QUEUE_LEN_REPORT_FREQUENCY, STOP_REPORT_QUEUE_LENGTH), (ARRIVAL_WINDOW, STOP_ARRIVAL_WINDOW)
+    ]
+
+    ev.run(stop_time=30)
+    joins = [r for r in log.log if r.action == STOP_PASSENGER_JOIN and r.status == "FINISHED"]
+    assert 0 < len(joins) and all(r.time <= ev.time for r in joins)
+    assert [r.time for r in joins] == sorted(r.time for r in joins)
+
+    # passengers only join once somebody looks at the queue, and those who would have walked off never join
+    ev.run(stop_time=50)
+    n_waiting = len(stop.passengers_waiting)
+    assert 0 < n_waiting
+    assert all(p.deadline >= ev.time for p in stop.passengers_waiting)
+    abandons = [r for r in log.log if r.action == PASSENGER_ABANDON_QUEUE and r.status == "DISPATCHED"]
+    assert all(r.time <= ev.time for r in abandons)
+
+
+def test_waiting_arrays():
+    ev = EventManager(VoidLog())
+    stop = Stop(ev)
+    waiting = WaitingArrays(stop, capacity=2)
+
+    # the arrays grow as passengers join
+    waiting.extend(100, np.array([0.0, 1.0, 2.0]), np.array([1, 2, 3]))
+    waiting.extend(103, np.array([8.0]), np.array([4]))
+    assert len(waiting) == 4
+
+    # passengers whose patience ran out leave from the front of the line
+    ids, arrival = waiting.expire(Passenger.PATIENCE + 1.5)
+    assert ids.tolist() == [100, 101] and arrival.tolist() == [0.0, 1.0]
+    assert len(waiting) == 2
+
+    # passengers are only created as they leave the line
+    passenger = waiting.pop()
+    assert (passenger.id, passenger.initialization_time, passenger.stops_traveling) == (102, 2.0, 3)
+    with raises(ValueError):
+        waiting.remove(passenger)
+    assert waiting.pop().id == 103
+    with raises(IndexError):
+        waiting.pop()
+
+    # passengers taken from the middle of the line are created, the ones they skip keep their place
+    waiting.extend(104, np.array([10.0, 11.0, 12.0, 13.0]), np.array([1, 2, 3, 4]))
+    assert list(waiting.deadlines()) == [10.0 + Passenger.PATIENCE + i for i in range(4)]
+    assert [p.id for p in waiting.take([1, 2])] == [105, 106]
+    assert len(waiting) == 2
+    assert [(p.id, p.stops_traveling) for p in (waiting.pop(), waiting.pop())] == [(104, 1), (107, 4)]
+
+
+def test_lazy_arrivals():
+    log = InMemoryLog()
+    ev = EventManager(log, RandomSource(3))
+    stop = Stop(ev, arrival_mode="lazy")
+    stop.start()
+    ev.run(stop_time=50)
+
+    # nobody is created while they wait, and everyone still in line has some patience left
+    n_waiting = len(stop.passengers_waiting)
+    assert 0 < n_waiting
+    assert not any(r.action == PASSENGER_JOIN_QUEUE and r.status == "DISPATCHED" and r.time > ev.time - Passenger.PATIENCE
+                   for r in log.log)
+
+    # passengers who gave up are logged as having joined and abandoned the queue
+    joins = {r.object_id: r for r in log.log if r.action == PASSENGER_JOIN_QUEUE and r.status == "DISPATCHED"}
+    abandons = {r.object_id: r for r in log.log if r.action == PASSENGER_ABANDON_QUEUE and r.status == "DISPATCHED"}
+    assert 0 < len(abandons) and joins.keys() == abandons.keys()
+    assert all(abandons[id].time == joins[id].time + Passenger.PATIENCE for id in joins)
+
+    # every arrival is logged with the queue length once the passenger joined
+    arrivals = [r for r in log.log if r.action == STOP_PASSENGER_JOIN and r.status == "FINISHED"]
+    assert len(arrivals) == n_waiting + len(abandons)
+    assert arrivals[-1].data == n_waiting
+
+    # the passenger at the front of the line is created with their arrival time, and waits for a bus
+    passenger = stop.passengers_waiting.pop()
+    assert passenger.deadline >= ev.time
+    assert log.log[-1].object_id == passenger.id and log.log[-1].action == PASSENGER_JOIN_QUEUE
+
+
+def test_arrival_mode_validation():
+    with raises(ValueError):
+        Stop(EventManager(VoidLog()), arrival_mode="nope")
+
+
+def test_sparse_arrivals():
+    log = InMemoryLog()
+    ev = EventManager(log, RandomSource(3))
+    stop = Stop(ev, arrival_mode="sparse")
+    stop.start(report=False)
+
+    # sparse stops dispatch nothing, arrivals are drawn when somebody looks at the queue
+    assert not ev.queue
+    ev.dispatch(None, "tick", 50)
+    ev.run()
+    n_waiting = len(stop.passengers_waiting)
+    assert 0 < n_waiting
+    arrivals = [r for r in log.log if r.action == STOP_PASSENGER_JOIN and r.status == "FINISHED"]
+    abandons = [r for r in log.log if r.action == PASSENGER_ABANDON_QUEUE and r.status == "DISPATCHED"]
+    assert 0 < len(abandons) and len(arrivals) == n_waiting + len(abandons)
+    assert [r.time for r in arrivals] == sorted(r.time for r in arrivals) and arrivals[-1].time <= 50
+
+
+def test_draw_arrivals():
+    rates = [0.0] * 24
+    rates[8] = 2.0
+    stop = Stop(EventManager(VoidLog(), RandomSource(0)), arrival_mode="sparse", arrival_rates=rates)
+
+    # arrivals only come in the hour with demand, however long the stop was left alone
+    arrival = stop._draw_arrivals(30, 3*24*60 + 30)
+    assert (np.diff(arrival) >= 0).all()
+    assert ((arrival // 60) % 24 == 8).all()
+    assert abs(len(arrival) - 3*2.0*60) < 4 * (3*2.0*60) ** 0.5
+    assert len(stop._draw_arrivals(60, 8*60)) == 0
+
+
+def test_arrival_rates_validation():
+    ev = EventManager(VoidLog())
+    with raises(ValueError):
+        Stop(ev, arrival_rates=[1.0] * 23)
+    with raises(ValueError):
+        Stop(ev, arrival_mode="lazy", arrival_rates=[-1.0] * 24)
+    with raises(ValueError):
+        Stop(ev, arrival_rates=[0.0] * 24)
+
+    stop = Stop(ev, arrival_mode="lazy", arrival_rates=[0.0] * 12 + [2.0] * 12)
+    assert stop.expected_arrival_interval(60) == float("inf")
+    assert stop.expected_arrival_interval(13*60) == 0.5
+
+
+def test_queue_area():
+    ev = EventManager(VoidLog())
+    stop = Stop(ev)
+    area = stop.track_queue_area()
+    assert stop.queue_area is area and stop.track_queue_area() is area
+
+    # two passengers wait from 0, one leaves at 4 and the other gives up at 10
+    first, second = Passenger(ev, stop), Passenger(ev, stop)
+    stop.passengers_waiting.appendleft(first)
+    stop.passengers_waiting.appendleft(second)
+    ev.dispatch(None, "tick", 4)
+    ev.run(max_events=1)
+    stop.passengers_waiting.pop()
+    ev.run()
+
+    assert area.length == 0
+    assert area.area() == 4 + Passenger.PATIENCE
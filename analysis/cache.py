@@ -0,0 +1,216 @@
+from typing import Optional, Dict, Any
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from time import time
+
+import pandas as pd
+
+from src import actions, bus, event_manager, kpi, network, passenger, random_source, sampler, scheduler, sim, \
+    stop
+from src.bus import Bus
+from src.passenger import Passenger
+from src.sim import Sim
+from src.stop import ARRIVAL_RATES, QUEUE_LEN_REPORT_FREQUENCY
+
+# the modules that make up the model, changes to any of them invalidate every cached result
+MODEL_MODULES = (actions, bus, event_manager, kpi, network, passenger, random_source, sampler, scheduler, sim, stop)
+
+MODEL_VERSION = hashlib.sha256(
+    b"".join(inspect.getsource(module).encode() for module in MODEL_MODULES)
+).hexdigest()
+
+# default size bound of a cache, in bytes
+MAX_BYTES = 1 << 30
+
+
+def model_parameters() -> Dict[str, Any]:
+    """The model constants that results depend on, read when called so that patched constants are picked up"""
+    return {
+        "travel_time_average": Bus.TRAVEL_TIME_AVERAGE,
+        "travel_time_std": Bus.TRAVEL_TIME_STD,
+        "bus_max_capacity": Bus.BUS_MAX_CAPACITY,
+        "n_stops": Sim.n_stops,
+        "patience": Passenger.PATIENCE,
+        "embark_time": Passenger.EMBARK_TIME,
+        "disembark_time": Passenger.DISEMBARK_TIME,
+        "service_time_std": Passenger.SERVICE_TIME_STD,
+        "arrival_rates": list(ARRIVAL_RATES),
+        "queue_len_report_frequency": QUEUE_LEN_REPORT_FREQUENCY,
+    }
+
+
+def cell_key(**cell) -> str:
+    """The cache key of a cell, a hash of its parameters together with the model parameters and code version
+
+    Args:
+        cell: everything that identifies the run besides the model, e.g. n_buses, sim_duration and seed. Values must
+            be json serializable
+    """
+    payload = {"cell": cell, "model": model_parameters(), "version": MODEL_VERSION}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, root: str, max_bytes: int = MAX_BYTES):
+        """A content-addressed store for the results of sweep cells
+
+        Each entry holds the KPIs of one run as json and, optionally, its event table as parquet, under
+        `root/<key>`. Keys come from `cell_key`, so a result is only reused for the exact same parameters, model
+        constants and model code. Once the entries take up more than `max_bytes`, the least recently used ones are
+        evicted. Storing event tables requires pyarrow.
+
+        The manifest is rewritten whenever entries are added or removed. Reads only update the last-used times in
+        memory, call `flush` to write them out.
+
+        Args:
+            root: the directory holding the cache, created if it doesn't exist
+            max_bytes: the size the cache is kept under
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self._manifest_path = os.path.join(root, "manifest.json")
+        self.manifest: Dict[str, dict] = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+        # whether reads changed the manifest since it was last saved
+        self._dirty = False
+
+    def _save_manifest(self) -> None:
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self._manifest_path)
+        self._dirty = False
+
+    def flush(self) -> None:
+        """Writes the last-used times of the entries read since the manifest was last saved"""
+        if self._dirty:
+            self._save_manifest()
+
+    def _entry_path(self, key: str, name: Optional[str] = None) -> str:
+        path = os.path.join(self.root, key)
+        return path if name is None else os.path.join(path, name)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.manifest
+
+    def __len__(self) -> int:
+        return len(self.manifest)
+
+    @property
+    def size(self) -> int:
+        """The total size of the entries, in bytes"""
+        return sum(entry["size"] for entry in self.manifest.values())
+
+    def get(self, key: str) -> Optional[dict]:
+        """The KPIs stored under `key`, or None if there are none"""
+        if key not in self.manifest:
+            return None
+        with open(self._entry_path(key, "kpis.json")) as f:
+            kpis = json.load(f)
+        self._touch(key)
+        return kpis
+
+    def get_events(self, key: str, columns=None) -> Optional[pd.DataFrame]:
+        """The event table stored under `key`, or None if the entry doesn't exist or was stored without one"""
+        if key not in self.manifest or not self.manifest[key]["events"]:
+            return None
+        df = pd.read_parquet(self._entry_path(key, "events.parquet"), columns=columns)
+        self._touch(key)
+        return df
+
+    def _touch(self, key: str) -> None:
+        self.manifest[key]["last_used"] = time()
+        self._dirty = True
+
+    def put(self, key: str, cell: dict, kpis: dict, events: Optional[pd.DataFrame] = None) -> None:
+        """Stores the results of a cell, replacing any entry under the same key, then evicts down to `max_bytes`
+
+        Args:
+            key: the output of `cell_key` for the cell
+            cell: the parameters of the cell, kept in the manifest so that entries can be listed
+            kpis: json serializable KPIs, e.g. `KPISummary.to_dict()`
+            events: the event table of the run, if it should be kept
+        """
+        path = self._entry_path(key)
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        with open(os.path.join(tmp, "kpis.json"), "w") as f:
+            json.dump(kpis, f)
+        if events is not None:
+            events.to_parquet(os.path.join(tmp, "events.parquet"), index=False)
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+
+        # the entry only appears once it is complete
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+        now = time()
+        self.manifest[key] = {"cell": cell, "version": MODEL_VERSION, "events": events is not None, "size": size,
+                              "created": now, "last_used": now}
+        self.evict(self.max_bytes)
+
+    def remove(self, key: str) -> None:
+        """Removes the entry stored under `key`"""
+        shutil.rmtree(self._entry_path(key), ignore_errors=True)
+        del self.manifest[key]
+        self._save_manifest()
+
+    def evict(self, max_bytes: int) -> int:
+        """Removes the least recently used entries until the cache is under `max_bytes`, returns how many went"""
+        n_removed = 0
+        total = self.size
+        for key in sorted(self.manifest, key=lambda k: self.manifest[k]["last_used"]):
+            if total <= max_bytes:
+                break
+            total -= self.manifest[key]["size"]
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            del self.manifest[key]
+            n_removed += 1
+        self._save_manifest()
+        return n_removed
+
+    def entries(self) -> pd.DataFrame:
+        """Lists the entries, one row per entry with its key, cell parameters, size and times, most recent first"""
+        rows = [
+            {"key": key, **entry["cell"], "stale": entry["version"] != MODEL_VERSION, "events": entry["events"],
+             "size": entry["size"], "created": entry["created"], "last_used": entry["last_used"]}
+            for key, entry in self.manifest.items()
+        ]
+        if not rows:
+            return pd.DataFrame(columns=["key", "stale", "events", "size", "created", "last_used"])
+        return pd.DataFrame(rows).sort_values("last_used", ascending=False, ignore_index=True)
+
+    def prune(self, older_than: Optional[float] = None, stale: bool = True) -> int:
+        """Removes entries that can't be reused or haven't been, returns the number removed
+
+        Args:
+            older_than: also remove entries not used in this many seconds
+            stale: remove entries computed with a different version of the model code
+        """
+        now = time()
+        doomed = [
+            key for key, entry in self.manifest.items()
+            if (stale and entry["version"] != MODEL_VERSION)
+            or (older_than is not None and now - entry["last_used"] > older_than)
+        ]
+        for key in doomed:
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            del self.manifest[key]
+
+        # directories left behind by interrupted writes
+        for name in os.listdir(self.root):
+            if name.endswith(".tmp"):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+        self._save_manifest()
+        return len(doomed)
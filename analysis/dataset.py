@@ -0,0 +1,191 @@
+from typing import List, Optional, Iterable, Dict, Tuple
+import hashlib
+import inspect
+import json
+import os
+import re
+
+import pandas as pd
+
+from analysis import preprocessing
+from analysis.preprocessing import preprocess, make_passenger_df
+
+# matches the file names written by analysis.runner, log_{n_buses}_{run_id}_{timestamp}.csv
+LOG_NAME = re.compile(r"log_(\d+)_(\d+)_.*\.csv$")
+
+# column types of a CSVLog file, fixed so that every chunk of a log is written to parquet with the same schema.
+# data is parsed separately, it holds "None" for events without data
+CSV_DTYPES = {"event_id": "int64", "time": "float64", "object_type": str, "object_id": "int64", "action": str,
+              "status": str}
+
+# derived tables that can be cached, in the order they are computed
+STAGES = ("preprocessed", "passengers")
+
+# changes to the preprocessing code invalidate every cached table
+_CODE_HASH = hashlib.sha256(inspect.getsource(preprocessing).encode()).hexdigest()
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Dataset:
+
+    def __init__(self, root: str):
+        """A store for the logs of many sweeps, partitioned by (n_buses, run_id)
+
+        Raw events live in a hive-partitioned parquet dataset under `root/events`. The outputs of `preprocess` and
+        `make_passenger_df` for each partition are cached under `root/cache`, keyed by a hash of the log contents and
+        of the preprocessing code, so they are recomputed only when either changes. Requires pyarrow.
+
+        Args:
+            root: the directory holding the store, created if it doesn't exist
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        self._manifest_path = os.path.join(root, "manifest.json")
+        self.manifest: Dict[str, dict] = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as f:
+                self.manifest = json.load(f)
+
+    @staticmethod
+    def _key(n_buses: int, run_id: int) -> str:
+        return f"{n_buses}/{run_id}"
+
+    def _save_manifest(self) -> None:
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self._manifest_path)
+
+    def _events_path(self, n_buses: int, run_id: int) -> str:
+        return os.path.join(self.root, "events", f"n_buses={n_buses}", f"run_id={run_id}", "part.parquet")
+
+    def _cache_path(self, stage: str, n_buses: int, run_id: int) -> str:
+        content_hash = self.manifest[self._key(n_buses, run_id)]["hash"]
+        key = hashlib.sha256(f"{stage}:{content_hash}:{_CODE_HASH}".encode()).hexdigest()
+        return os.path.join(self.root, "cache", stage, f"{key}.parquet")
+
+    @property
+    def partitions(self) -> List[Tuple[int, int]]:
+        """Every (n_buses, run_id) in the store"""
+        return sorted((entry["n_buses"], entry["run_id"]) for entry in self.manifest.values())
+
+    def ingest(self, sweep_dir: str, run_offset: int = 0, chunksize: int = 1_000_000) -> List[Tuple[int, int]]:
+        """Adds the logs of a sweep directory written by `analysis.runner`
+
+        Logs that are already in the store with the same contents are skipped, so a sweep can be ingested again after
+        more runs were added to it. Each log is converted `chunksize` rows at a time, so logs don't have to fit in
+        memory.
+
+        Args:
+            sweep_dir: a `data/sim_*` directory
+            run_offset: added to the run ids in the file names, to keep the runs of different sweeps apart
+            chunksize: the number of log rows to read at a time
+
+        Returns:
+            the (n_buses, run_id) partitions that were added or replaced
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        changed = []
+        for name in sorted(os.listdir(sweep_dir)):
+            match = LOG_NAME.match(name)
+            if not match:
+                continue
+            n_buses, run_id = int(match.group(1)), int(match.group(2)) + run_offset
+            path = os.path.join(sweep_dir, name)
+            content_hash = _file_hash(path)
+
+            key = self._key(n_buses, run_id)
+            if key in self.manifest and self.manifest[key]["hash"] == content_hash:
+                continue
+
+            events_path = self._events_path(n_buses, run_id)
+            os.makedirs(os.path.dirname(events_path), exist_ok=True)
+            # written under a temporary name first so that a crash never leaves half a partition behind
+            writer = None
+            try:
+                for df in pd.read_csv(path, dtype=CSV_DTYPES, chunksize=chunksize):
+                    df["data"] = pd.to_numeric(df["data"].replace("None", "")).astype("float64")
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(events_path + ".tmp", table.schema)
+                    writer.write_table(table)
+            finally:
+                if writer is not None:
+                    writer.close()
+            os.replace(events_path + ".tmp", events_path)
+
+            self.manifest[key] = {"n_buses": n_buses, "run_id": run_id, "source": path, "hash": content_hash}
+            changed.append((n_buses, run_id))
+
+        self._save_manifest()
+        return changed
+
+    def _table(self, stage: str, n_buses: int, run_id: int, columns: Optional[List[str]]) -> pd.DataFrame:
+        """Loads one partition of a table, computing and caching it first if needed"""
+        if stage == "events":
+            return pd.read_parquet(self._events_path(n_buses, run_id), columns=columns)
+        if stage not in STAGES:
+            raise ValueError(f"unknown table {stage}, expected events or one of {STAGES}")
+
+        path = self._cache_path(stage, n_buses, run_id)
+        if not os.path.exists(path):
+            if stage == "preprocessed":
+                df = preprocess(self._table("events", n_buses, run_id, None))
+            else:
+                df = make_passenger_df(self._table("preprocessed", n_buses, run_id, None))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            df.to_parquet(path, index=False)
+
+        return pd.read_parquet(path, columns=columns)
+
+    def load(self, table: str = "passengers", columns: Optional[List[str]] = None,
+             n_buses: Optional[Iterable[int]] = None, run_ids: Optional[Iterable[int]] = None) -> pd.DataFrame:
+        """Loads a table across runs, reading only the requested columns and partitions
+
+        Args:
+            table: "events", "preprocessed" or "passengers"
+            columns: the columns to read, all of them if not given
+            n_buses: only read runs with these numbers of buses
+            run_ids: only read runs with these ids
+
+        Returns:
+            the matching partitions concatenated, with n_buses and run_id columns added
+        """
+        n_buses = None if n_buses is None else set(n_buses)
+        run_ids = None if run_ids is None else set(run_ids)
+
+        frames = [
+            self._table(table, bus_i, run_i, columns).assign(n_buses=bus_i, run_id=run_i)
+            for bus_i, run_i in self.partitions
+            if (n_buses is None or bus_i in n_buses) and (run_ids is None or run_i in run_ids)
+        ]
+        if not frames:
+            return pd.DataFrame(columns=(columns or []) + ["n_buses", "run_id"])
+        return pd.concat(frames, ignore_index=True)
+
+    def prune_cache(self) -> int:
+        """Deletes cached tables that no partition refers to anymore, returns the number of files deleted"""
+        live = {
+            os.path.basename(self._cache_path(stage, bus_i, run_i))
+            for stage in STAGES for bus_i, run_i in self.partitions
+        }
+        n_deleted = 0
+        for stage in STAGES:
+            directory = os.path.join(self.root, "cache", stage)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name not in live:
+                    os.remove(os.path.join(directory, name))
+                    n_deleted += 1
+        return n_deleted
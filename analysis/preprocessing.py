@@ -1,10 +1,16 @@
 import pandas as pd
 import numpy as np
+from typing import Iterable, Iterator, Optional
 
 from src.actions import *
 
+# column order of preprocessed frames
+COLUMNS = ["event_id", "action", "object_type", "object_id", "dispatch_time", "finish_time", "duration",
+           "dispatch_data", "cb_data"]
 
-def preprocess(df_raw):
+
+def _split(df_raw):
+    """Coerces types and splits a raw log into its DISPATCHED and FINISHED or CANCELLED halves"""
     # type coercion
     for col in ["object_type", "action", "status"]:
         df_raw[col] = df_raw[col].astype("category")
@@ -16,10 +22,16 @@ def preprocess(df_raw):
         .rename(columns={"time": "dispatch_time", "data": "dispatch_data"})
         .drop("status", axis=1))
 
-    # just take event_id and time from this one
-    finished = (df_raw[df_raw["status"] == "FINISHED"][["event_id", "time", "data"]]
+    # just take event_id and time from this one, cancelled events end when they are cancelled
+    finished = (df_raw[df_raw["status"].isin(["FINISHED", "CANCELLED"])][["event_id", "time", "data"]]
         .rename(columns={"time": "finish_time", "data": "cb_data"}))
 
+    return dispatched, finished
+
+
+def preprocess(df_raw):
+    dispatched, finished = _split(df_raw)
+
     # merge them back together to get start and end times for every event
     df = pd.merge(dispatched, finished, how="left", on="event_id")
     
@@ -30,11 +42,70 @@ def preprocess(df_raw):
     df = df[df["finish_time"].notna()]
 
     # reorder columns
-    df = df[["event_id", "action", "object_type", "object_id", "dispatch_time", "finish_time", "duration", "dispatch_data", "cb_data"]]
+    df = df[COLUMNS]
 
     return df
 
 
+def iter_preprocess(chunks: Iterable[pd.DataFrame], burnin: Optional[float] = None,
+                    max_pending: int = 1_000_000) -> Iterator[pd.DataFrame]:
+    """Streaming version of `preprocess`, for logs that don't fit in memory
+
+    Takes the raw log in consecutive chunks and yields the finished events of each chunk as soon as they are paired up.
+    Every event is logged as DISPATCHED before it is logged as FINISHED or CANCELLED, so only dispatched events that haven't
+    finished yet have to be held on to between chunks. Events still in progress at the end of the log are dropped,
+    like in `preprocess`. Within a chunk, events are sorted by event_id.
+
+    Args:
+        chunks: the raw log, e.g. from `pd.read_csv(path, chunksize=...)`
+        burnin: if given, events dispatched at or before this time are dropped, like `ignore_burnin`
+        max_pending: the largest number of unfinished events to hold on to before giving up, protects against logs
+            that aren't in order
+    """
+    pending = None
+    for chunk in chunks:
+        dispatched, finished = _split(chunk)
+        if burnin is not None:
+            dispatched = dispatched[dispatched["dispatch_time"] > burnin]
+
+        pending = dispatched if pending is None else pd.concat([pending, dispatched], ignore_index=True)
+
+        is_finished = pending["event_id"].isin(finished["event_id"])
+        df = pd.merge(pending[is_finished], finished, on="event_id").sort_values("event_id")
+        pending = pending[~is_finished]
+
+        if len(pending) > max_pending:
+            raise ValueError(f"more than {max_pending} events are waiting to finish, is the log in order?")
+
+        df["duration"] = df["finish_time"] - df["dispatch_time"]
+        yield df[COLUMNS]
+
+
+def preprocess_chunked(path: str, out_path: str, chunksize: int = 1_000_000, burnin: Optional[float] = None,
+                       max_pending: int = 1_000_000) -> float:
+    """Preprocesses a CSVLog file chunk by chunk, appending the result to a csv file
+
+    See `iter_preprocess`, the output has the same columns as `preprocess`.
+
+    Args:
+        path: the log file
+        out_path: where to write the preprocessed events
+        chunksize: the number of log rows to read at a time
+        burnin: if given, events dispatched at or before this time are dropped, like `ignore_burnin`
+        max_pending: see `iter_preprocess`
+
+    Returns:
+        the longest queue length in the preprocessed events, like `max_queue_len`
+    """
+    longest = np.nan
+    with open(out_path, "w") as f:
+        f.write(",".join(COLUMNS) + "\n")
+        for df in iter_preprocess(pd.read_csv(path, chunksize=chunksize), burnin=burnin, max_pending=max_pending):
+            longest = np.fmax(longest, max_queue_len(df))
+            df.to_csv(f, header=False, index=False)
+    return longest
+
+
 def ignore_burnin(df, mins):
     """Remove any events that were dispatched before some time
     
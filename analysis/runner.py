@@ -1,11 +1,19 @@
-from typing import List
+from typing import List, Optional, Tuple, Dict, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
 import os
 from datetime import datetime
 from time import time
 
-from src.log import CSVLog, LogFilter
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from src.log import CSVLog, ColumnarLog, LogFilter, VoidLog, TeeLog
+from src.kpi import KPILog
 from src.sim import Sim
 from src.actions import BUS_MOVE
+from analysis.cache import ResultCache, cell_key
 
 readme = """
 About this simulation:
@@ -40,5 +48,417 @@ def run(n_buses: List[int], n_runs: int, sim_duration: int):
     print(f"success! run completed in {(time() - start_time)/60} minutes")
 
 
+def replication_seed(root_seed: int, n_buses: int, run_id: int) -> int:
+    """The seed for one replication of a sweep
+
+    Each (n_buses, run_id) cell gets its own child of the root SeedSequence, so its stream does not depend on which
+    other cells are in the sweep or on the order the workers pick them up in.
+    """
+    child = np.random.SeedSequence(root_seed, spawn_key=(n_buses, run_id))
+    return int(child.generate_state(1, np.uint64)[0])
+
+
+def _run_replication(n_buses: int, run_id: int, sim_duration: int, seed: int, path: Optional[str],
+                     profile: bool = False):
+    """Runs a single replication in a worker process
+
+    Returns the path of the csv log if `path` is given, otherwise the event table of the run. If `profile`, the
+    profiler results are written next to the csv log, with a .profile.json extension.
+    """
+    if path is not None:
+        log = CSVLog(path=path, msg=f"{n_buses}_{run_id}")
+        try:
+            sim = Sim(n_buses=n_buses, log=LogFilter(log, keep=lambda r: r.action != BUS_MOVE), seed=seed,
+                      profile=profile)
+            sim.run(stop_time=sim_duration)
+        except BaseException:
+            # a retry writes a new file, don't leave a partial log behind next to it
+            os.remove(log.f_name)
+            raise
+        if profile:
+            sim.profiler.to_json(os.path.splitext(log.f_name)[0] + ".profile.json")
+        return log.f_name
+
+    log = ColumnarLog()
+    Sim(n_buses=n_buses, log=log, seed=seed).run(stop_time=sim_duration)
+    df = log.to_dataframe()
+    return df[df["action"] != BUS_MOVE]
+
+
+def run_parallel(n_buses: List[int], n_runs: int, sim_duration: int, seed: Optional[int] = None,
+                 in_memory: bool = False, max_workers: Optional[int] = None, max_retries: int = 2,
+                 profile: bool = False) -> pd.DataFrame:
+    """Runs every (n_buses, run) replication of a sweep in a pool of worker processes
+
+    Every replication is seeded from `seed` with `replication_seed`, so a sweep can be repeated exactly. If no seed is
+    given a fresh one is drawn and written to the readme.
+
+    A replication that raises, or that is lost because a worker crashed and took the pool down with it, is
+    resubmitted to a fresh pool up to `max_retries` times before the sweep is abandoned.
+
+    Args:
+        n_buses: the numbers of buses to simulate
+        n_runs: the number of replications for each number of buses
+        sim_duration: the length of each replication in sim minutes
+        seed: the root seed of the sweep
+        in_memory: return the event tables of the runs instead of writing csv logs
+        max_workers: the number of worker processes, defaults to the number of cores
+        max_retries: how many times a failed replication is retried
+        profile: profile each replication and write the results next to its csv log, see EventManager.profile
+
+    Returns:
+        if `in_memory`, the event tables of all the runs concatenated, with n_buses and run_id columns added.
+        Otherwise, a table of n_buses, run_id, seed and path for each replication.
+    """
+    start_time = time()
+
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+
+    path = None
+    if not in_memory:
+        path = os.path.join("data", f"sim_" + str(datetime.now()).replace(" ", "_"))
+        os.makedirs(path)
+
+        with open(os.path.join(path, "readme.txt"), "a") as f:
+            f.write(readme
+                    .replace("N_BUSES", str(n_buses))
+                    .replace("N_RUNS", str(n_runs))
+                    .replace("N_STEPS", str(sim_duration))
+                    + f"seed: {seed}\n")
+
+    cells = [(bus_i, run_i) for bus_i in n_buses for run_i in range(n_runs)]
+    seeds = {cell: replication_seed(seed, *cell) for cell in cells}
+    attempts: Dict[Tuple[int, int], int] = {cell: 0 for cell in cells}
+    results = {}
+
+    # every pass submits the replications that are still missing to a fresh pool, a crashed worker breaks the whole
+    # pool so it can't be reused
+    while len(results) < len(cells):
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_run_replication, bus_i, run_i, sim_duration, seeds[(bus_i, run_i)], path,
+                                profile): (bus_i, run_i)
+                for bus_i, run_i in cells if (bus_i, run_i) not in results
+            }
+            for future in as_completed(futures):
+                cell = futures[future]
+                try:
+                    results[cell] = future.result()
+                except Exception as e:
+                    attempts[cell] += 1
+                    if attempts[cell] > max_retries:
+                        executor.shutdown(cancel_futures=True)
+                        raise RuntimeError(f"replication n_buses={cell[0]} run_id={cell[1]} failed "
+                                           f"{attempts[cell]} times") from e
+
+    print(f"success! run completed in {(time() - start_time)/60} minutes")
+
+    if in_memory:
+        return pd.concat(
+            [results[cell].assign(n_buses=cell[0], run_id=cell[1]) for cell in cells],
+            ignore_index=True
+        )
+    return pd.DataFrame(
+        [(bus_i, run_i, seeds[(bus_i, run_i)], results[(bus_i, run_i)]) for bus_i, run_i in cells],
+        columns=["n_buses", "run_id", "seed", "path"]
+    )
+
+
+def _run_cell(n_buses: int, sim_duration: int, seed: int, burnin: float, keep_events: bool):
+    """Runs a single replication in a worker process, returns its KPIs and, if `keep_events`, its event table"""
+    kpis = KPILog(burnin=burnin)
+    events = ColumnarLog() if keep_events else None
+    log = TeeLog(kpis, events) if keep_events else kpis
+    sim = Sim(n_buses=n_buses, log=log, seed=seed)
+    sim.run(stop_time=sim_duration)
+
+    # stop ids depend on how many sims the worker ran before this one, queues are keyed by position on the route
+    summary = kpis.summary().to_dict()
+    position = {stop.id: i for i, stop in enumerate(sim.route)}
+    for name in ("queue_length", "max_queue_length"):
+        summary[name] = {position[stop_id]: value for stop_id, value in sorted(summary[name].items())}
+
+    df = None
+    if keep_events:
+        df = events.to_dataframe()
+        df = df[df["action"] != BUS_MOVE]
+    return summary, df
+
+
+def run_cached(n_buses: List[int], n_runs: int, sim_duration: int, seed: int, cache: ResultCache,
+               burnin: float = 0, keep_events: bool = False, max_workers: Optional[int] = None) -> pd.DataFrame:
+    """Runs a sweep like `run_parallel`, reusing every replication already in `cache`
+
+    Each (n_buses, run_id) cell is keyed by its parameters, its replication seed, the model constants and the model
+    code, see `analysis.cache.cell_key`. Only cells that are missing from the cache are run, and their results are
+    added to it. A seed is required, since unseeded runs can't be reused.
+
+    Args:
+        n_buses: the numbers of buses to simulate
+        n_runs: the number of replications for each number of buses
+        sim_duration: the length of each replication in sim minutes
+        seed: the root seed of the sweep
+        cache: where results are looked up and stored
+        burnin: passed to KPILog, passengers who joined a queue before this time are left out
+        keep_events: also store the event table of each run, cells cached without one are rerun
+        max_workers: the number of worker processes, defaults to the number of cores
+
+    Returns:
+        one row of flattened KPIs per cell, with n_buses, run_id, seed, key and cached columns. Queue lengths are keyed
+        by the position of the stop on the route
+    """
+    cells = {}
+    for bus_i in n_buses:
+        for run_i in range(n_runs):
+            params = {"n_buses": bus_i, "sim_duration": sim_duration, "seed": replication_seed(seed, bus_i, run_i),
+                      "burnin": burnin}
+            cells[(bus_i, run_i)] = (params, cell_key(**params))
+
+    missing = [
+        cell for cell, (params, key) in cells.items()
+        if key not in cache or (keep_events and not cache.manifest[key]["events"])
+    ]
+    # read before anything is added, storing new results may evict entries of this very sweep
+    results = {cell: cache.get(key) for cell, (params, key) in cells.items() if cell not in missing}
+    if missing:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_run_cell, cells[cell][0]["n_buses"], sim_duration, cells[cell][0]["seed"], burnin,
+                                keep_events): cell
+                for cell in missing
+            }
+            for future in as_completed(futures):
+                cell = futures[future]
+                params, key = cells[cell]
+                kpis, events = future.result()
+                cache.put(key, params, kpis, events)
+                # the json round trip gives fresh results the same form as cached ones, e.g. string stop keys
+                results[cell] = json.loads(json.dumps(kpis))
+    cache.flush()
+
+    rows = []
+    for (bus_i, run_i), (params, key) in cells.items():
+        rows.append({"n_buses": bus_i, "run_id": run_i, "seed": params["seed"], "key": key,
+                     "cached": (bus_i, run_i) not in missing,
+                     **pd.json_normalize(results[(bus_i, run_i)]).to_dict("records")[0]})
+    return pd.DataFrame(rows)
+
+
+# the KPIs `run_sequential` can target, each read from the summary of a single replication
+SEQUENTIAL_KPIS = {
+    "wait": lambda summary: summary["wait"]["mean"],
+    "wait_transit_ratio": lambda summary: summary["wait_transit_ratio"]["mean"],
+    "max_queue_length": lambda summary: max(summary["max_queue_length"].values(), default=0),
+}
+
+
+def confidence_interval(values: Sequence[float], confidence: float = 0.95) -> Tuple[float, float]:
+    """The mean of `values` and the half-width of its Student t confidence interval, NaN values are left out"""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) < 2:
+        return (values.mean() if len(values) else float("nan")), float("inf")
+    t = stats.t.ppf((1 + confidence) / 2, len(values) - 1)
+    return values.mean(), t * values.std(ddof=1) / np.sqrt(len(values))
+
+
+def run_sequential(n_buses: List[int], sim_duration: int, seed: Optional[int] = None,
+                   kpis: Sequence[str] = tuple(SEQUENTIAL_KPIS), rel_half_width: float = 0.05,
+                   confidence: float = 0.95, batch_size: int = 4, min_runs: int = 4, max_runs: int = 200,
+                   burnin: float = 0, cache: Optional[ResultCache] = None,
+                   max_workers: Optional[int] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Runs replications of each n_buses cell in batches until the confidence interval of every KPI is narrow enough
+
+    After each batch, the mean of each KPI over the replications of a cell and the half-width of its confidence
+    interval are updated. A cell stops once every half-width is within `rel_half_width` of its mean, or once it has
+    had `max_runs` replications. Stable cells stop after a few runs while saturated ones keep going, so the runs go
+    where the noise is.
+
+    Replications are seeded with `replication_seed` like the other runners, and every batch is waited for in full
+    before deciding, so the number of runs a cell needs does not depend on the order the workers finish in. If a
+    cache is given, replications already in it are reused and new ones added, keyed like those of `run_cached`.
+
+    Args:
+        n_buses: the numbers of buses to simulate
+        sim_duration: the length of each replication in sim minutes
+        seed: the root seed of the sweep, a fresh one is drawn if not given
+        kpis: the KPIs that must reach the target precision, at least one of SEQUENTIAL_KPIS. The mean wait and
+            wait/transit ratio are the means over passengers, the max queue length the longest queue at any stop
+        rel_half_width: the target half-width of each confidence interval, relative to the mean
+        confidence: the confidence level of the intervals
+        batch_size: the number of replications added to each unfinished cell per batch
+        min_runs: the number of replications a cell gets before it can stop
+        max_runs: the number of replications after which a cell stops even if it hasn't reached the target
+        burnin: passed to KPILog, passengers who joined a queue before this time are left out
+        cache: where replications are looked up and stored, requires a seed
+        max_workers: the number of worker processes, defaults to the number of cores
+
+    Returns:
+        a table with one row per cell, indexed by n_buses, with the number of runs it needed, whether it reached the
+        target, and the mean, half-width and relative half-width of each KPI. And a table of the KPIs of every
+        replication, with n_buses, run_id and seed columns
+    """
+    kpis = tuple(kpis)
+    if not kpis:
+        raise ValueError("kpis must name at least one KPI")
+    unknown = set(kpis) - set(SEQUENTIAL_KPIS)
+    if unknown:
+        raise ValueError(f"unknown KPIs {sorted(unknown)}, expected some of {list(SEQUENTIAL_KPIS)}")
+    if rel_half_width <= 0:
+        raise ValueError("rel_half_width must be strictly positive")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be strictly between 0 and 1")
+    if not 2 <= min_runs <= max_runs:
+        raise ValueError("min_runs must be at least 2 and at most max_runs")
+    if batch_size <= 0:
+        raise ValueError("batch_size must be strictly positive")
+    if cache is not None and seed is None:
+        raise ValueError("a seed is needed to use a cache, since unseeded runs can't be reused")
+
+    start_time = time()
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+
+    values: Dict[int, Dict[str, List[float]]] = {bus_i: {kpi: [] for kpi in kpis} for bus_i in n_buses}
+    runs = []
+    cells = {}
+    active = list(n_buses)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while active:
+            batch = {}
+            for bus_i in active:
+                n_done = len(values[bus_i][kpis[0]])
+                # the first batch brings every cell up to min_runs
+                n_new = max(batch_size, min_runs - n_done)
+                for run_i in range(n_done, min(n_done + n_new, max_runs)):
+                    params = {"n_buses": bus_i, "sim_duration": sim_duration,
+                              "seed": replication_seed(seed, bus_i, run_i), "burnin": burnin}
+                    batch[(bus_i, run_i)] = params
+
+            summaries = {}
+            futures = {}
+            for cell, params in batch.items():
+                key = cell_key(**params) if cache is not None else None
+                if key is not None and key in cache:
+                    summaries[cell] = cache.get(key)
+                else:
+                    futures[executor.submit(_run_cell, cell[0], sim_duration, params["seed"], burnin, False)] = cell
+            for future in as_completed(futures):
+                cell = futures[future]
+                summaries[cell] = future.result()[0]
+                if cache is not None:
+                    cache.put(cell_key(**batch[cell]), batch[cell], summaries[cell])
+
+            # added in run order, so the estimates don't depend on which replication finished first
+            for cell in sorted(batch):
+                bus_i, run_i = cell
+                row = {"n_buses": bus_i, "run_id": run_i, "seed": batch[cell]["seed"]}
+                for kpi in kpis:
+                    row[kpi] = SEQUENTIAL_KPIS[kpi](summaries[cell])
+                    values[bus_i][kpi].append(row[kpi])
+                runs.append(row)
+
+            for bus_i in list(active):
+                n_done = len(values[bus_i][kpis[0]])
+                cell = {"n_runs": n_done}
+                for kpi in kpis:
+                    mean, half_width = confidence_interval(values[bus_i][kpi], confidence)
+                    cell[f"{kpi}_mean"] = mean
+                    cell[f"{kpi}_half_width"] = half_width
+                    cell[f"{kpi}_rel_half_width"] = abs(half_width / mean) if mean else float("inf")
+                cell["converged"] = all(cell[f"{kpi}_rel_half_width"] <= rel_half_width for kpi in kpis)
+                cells[bus_i] = cell
+                if cell["converged"] or n_done >= max_runs:
+                    active.remove(bus_i)
+
+    if cache is not None:
+        cache.flush()
+    print(f"success! run completed in {(time() - start_time)/60} minutes, "
+          f"{len(runs)} replications over {len(n_buses)} cells")
+
+    summary = pd.DataFrame.from_dict(cells, orient="index").loc[list(n_buses)]
+    summary.index.name = "n_buses"
+    return summary, pd.DataFrame(runs)
+
+
+def warm_snapshot(n_buses: int, burnin: float, seed: Optional[int] = None,
+                  cache_dir: Optional[str] = os.path.join("data", "snapshots")) -> bytes:
+    """Runs a sim through its burn-in and returns a snapshot of it, see `Sim.snapshot`
+
+    Seeded snapshots are cached in `cache_dir` under the `cell_key` of n_buses, burnin and seed, so a sweep only pays
+    the burn-in once, and a change to the model code or constants gives a fresh snapshot rather than a stale one.
+
+    Args:
+        n_buses: the number of buses to simulate
+        burnin: how long to run the sim for before taking the snapshot, in sim minutes
+        seed: the seed of the burn-in run, snapshots are only cached if it is given
+        cache_dir: where to cache snapshots, None to disable the cache
+    """
+    f_name = None
+    if seed is not None and cache_dir is not None:
+        f_name = os.path.join(cache_dir, f"warm_{cell_key(n_buses=n_buses, burnin=burnin, seed=seed)}.pkl")
+        if os.path.exists(f_name):
+            with open(f_name, "rb") as f:
+                return f.read()
+
+    sim = Sim(n_buses=n_buses, log=VoidLog(), seed=seed)
+    sim.run(stop_time=burnin)
+    snapshot = sim.snapshot()
+
+    if f_name is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under a temporary name first so that a crash never leaves half a snapshot behind
+        with open(f_name + ".tmp", "wb") as f:
+            f.write(snapshot)
+        os.replace(f_name + ".tmp", f_name)
+    return snapshot
+
+
+_snapshot: Optional[bytes] = None
+
+
+def _set_snapshot(snapshot: bytes) -> None:
+    """Worker initializer, the snapshot is sent to each worker once rather than with every replication"""
+    global _snapshot
+    _snapshot = snapshot
+
+
+def _run_fork(run_id: int, sim_duration: float, seed: int) -> pd.DataFrame:
+    """Restores the worker's snapshot with fresh random streams and runs it, returns the event table of the run"""
+    log = ColumnarLog()
+    Sim.restore(_snapshot, log=log, seed=seed).run(stop_time=sim_duration)
+    df = log.to_dataframe()
+    return df[df["action"] != BUS_MOVE].assign(run_id=run_id)
+
+
+def run_forked(snapshot: bytes, n_runs: int, sim_duration: float, seed: Optional[int] = None,
+               max_workers: Optional[int] = None) -> pd.DataFrame:
+    """Runs `n_runs` replications that all start from the same warm snapshot, in a pool of worker processes
+
+    Each replication restores the snapshot with its own child of `seed`, so the runs share the burn-in but are
+    independent after it. Only events after the snapshot are logged, so there is no burn-in to drop.
+
+    Args:
+        snapshot: the output of `Sim.snapshot`, e.g. from `warm_snapshot`
+        n_runs: the number of replications
+        sim_duration: the sim time to run each replication until, counted from the start of the original sim
+        seed: the root seed of the replications, a fresh one is drawn if not given
+        max_workers: the number of worker processes, defaults to the number of cores
+
+    Returns:
+        the event tables of all the runs concatenated, with a run_id column added
+    """
+    if seed is None:
+        seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+    seeds = [int(np.random.SeedSequence(seed, spawn_key=(run_id,)).generate_state(1, np.uint64)[0])
+             for run_id in range(n_runs)]
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_set_snapshot, initargs=(snapshot,)) as executor:
+        results = list(executor.map(_run_fork, range(n_runs), [sim_duration] * n_runs, seeds))
+    return pd.concat(results, ignore_index=True)
+
+
 if __name__ == "__main__":
     run(n_buses=[5], n_runs=1, sim_duration=2*60)
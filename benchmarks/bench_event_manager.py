@@ -0,0 +1,96 @@
+"""Compares the heapq EventManager against the original PriorityQueue implementation on multi-day runs
+
+Usage:
+    python -m benchmarks.bench_event_manager [n_days] [n_buses]
+"""
+import sys
+from dataclasses import dataclass
+from queue import PriorityQueue
+from time import perf_counter
+from typing import Callable
+from unittest import mock
+
+from src.event_manager import EventManager
+from src.log import VoidLog, LogRecord
+from src.sim import Sim
+
+
+@dataclass(frozen=True)
+class _Event:
+    time: float
+    callback: Callable[[float], None]
+
+    def __lt__(self, other):
+        if not isinstance(other, _Event):
+            raise ValueError(f"cannot compare Event to {other.__class__}")
+        return self.time < other.time
+
+
+class PriorityQueueEventManager(EventManager):
+    """The EventManager as it was before the switch to heapq, kept here as a reference point
+
+    It accepts callback args and start times so that it can drive the current model code, but otherwise builds a
+    closure and two LogRecords per event and locks the queue on every operation, like the original did.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = PriorityQueue()
+
+    def dispatch(self, obj, action, duration, callback=None, data=None, args=(), start_time=None):
+        if duration < 0:
+            raise ValueError("duration must be nonnegative")
+        if start_time is None:
+            start_time = self.time
+
+        event_id = self._n_dispatches
+        self._n_dispatches += 1
+
+        def cb(time):
+            cb_return = callback(*args) if callback is not None else None
+            self.log.write(LogRecord(event_id, time, type(obj).__name__, obj.id, action, "FINISHED", cb_return))
+
+        self.log.write(LogRecord(event_id, start_time, type(obj).__name__, obj.id, action, "DISPATCHED", data))
+        self.queue.put(_Event(time=start_time + duration, callback=cb))
+
+    def cancel(self, event):
+        # the original had no cancellation, timers always ran to completion
+        pass
+
+    def next(self):
+        task = self.queue.get()
+        self._time = task.time
+        task.callback(self.time)
+
+    def run(self, max_events=float("inf"), stop_time=float("inf")):
+        i = 0
+        while not self.queue.empty() and self.time < stop_time:
+            self.next()
+            i += 1
+            if i >= max_events:
+                break
+
+
+def time_sim(n_buses: int, sim_duration: float, seed: int = 0) -> float:
+    """Wall-clock seconds to run a seeded sim with no logging"""
+    start = perf_counter()
+    sim = Sim(n_buses, log=VoidLog(), seed=seed)
+    sim.run(stop_time=sim_duration)
+    return perf_counter() - start
+
+
+def main(n_days: int = 3, n_buses: int = 10):
+    sim_duration = n_days*24*60
+
+    heap_time = time_sim(n_buses, sim_duration)
+    with mock.patch("src.sim.EventManager", PriorityQueueEventManager):
+        legacy_time = time_sim(n_buses, sim_duration)
+
+    print(f"{n_days} days, {n_buses} buses")
+    print(f"PriorityQueue: {legacy_time:.2f}s")
+    print(f"heapq:         {heap_time:.2f}s")
+    print(f"speedup:       {legacy_time/heap_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,101 @@
+"""Finds where the calendar queue overtakes the binary heap as the number of pending events grows
+
+The hold model keeps a fixed number of events pending: each step pops the earliest event and pushes a new one some
+time after it, with delays mixed like the model's: passenger arrivals, bus moves, patience timers and boarding times.
+The sim cases run event mode arrivals on networks with more and more stops, where every waiting passenger holds a
+patience timer.
+
+Usage:
+    python -m benchmarks.bench_scheduler [--sizes 1000 10000 ...] [--stops 1000 10000 ...] [--ops 200000]
+"""
+import argparse
+from time import perf_counter
+from typing import Dict, List
+
+import numpy as np
+
+from src.event_manager import Event
+from src.log import VoidLog
+from src.network import Network
+from src.scheduler import SCHEDULERS
+from src.sim import Sim
+
+
+def model_delays(n: int, seed: int = 0) -> List[float]:
+    """Event durations drawn like the model's: arrivals, bus moves, patience timers and boarding, in equal parts"""
+    rng = np.random.default_rng(seed)
+    kind = rng.integers(0, 4, n)
+    delays = np.select(
+        [kind == 0, kind == 1, kind == 2],
+        [rng.exponential(1.0, n), rng.normal(3.0, 0.5, n).clip(0), np.full(n, 10.0)],
+        rng.exponential(0.05, n),
+    )
+    return delays.tolist()
+
+
+def time_hold(scheduler: str, size: int, n_ops: int, seed: int = 0) -> float:
+    """Nanoseconds per hold operation, one pop and one push, with `size` events pending"""
+    queue = SCHEDULERS[scheduler]()
+    delays = model_delays(size + n_ops, seed)
+    event = Event(0, None, "", None, ())
+
+    # starting somewhere within each delay, as if the model had been running for a while, rather than with every
+    # patience timer due at exactly the same time
+    phase = np.random.default_rng(seed + 1).random(size).tolist()
+    for i in range(size):
+        queue.push((delays[i] * phase[i], i, event))
+
+    push, pop = queue.push, queue.pop
+    start = perf_counter()
+    for i in range(size, size + n_ops):
+        time = pop()[0]
+        push((time + delays[i], i, event))
+    return (perf_counter() - start) / n_ops * 1e9
+
+
+def time_sim(scheduler: str, n_stops: int, sim_duration: float = 30, seed: int = 0) -> Dict[str, float]:
+    """Events per second of an event mode sim on a network of `n_stops` stops, and its largest pending set"""
+    network = Network.random(n_stops, max(1, n_stops // 50), min(n_stops, 30), seed=seed)
+    sim = Sim(max(1, n_stops // 100), log=VoidLog(), seed=seed, network=network, queue_sampling="none",
+              scheduler=scheduler)
+    n_dispatches = sim.event_manager._n_dispatches
+
+    peak = 0
+    start = perf_counter()
+    # run in slices to see the pending set grow as passengers pile up
+    for t in np.linspace(0, sim_duration, 11)[1:]:
+        sim.event_manager.run(stop_time=t)
+        peak = max(peak, len(sim.event_manager.queue))
+    wall_time = perf_counter() - start
+
+    return {"events_per_second": (sim.event_manager._n_dispatches - n_dispatches) / wall_time, "peak_pending": peak}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="*", default=[100, 1_000, 10_000, 100_000, 300_000, 1_000_000])
+    parser.add_argument("--stops", type=int, nargs="*", default=[1_000, 10_000, 30_000])
+    parser.add_argument("--ops", type=int, default=200_000, help="hold operations timed at each size")
+    args = parser.parse_args(argv)
+
+    print("hold model, ns per pop and push")
+    print(f"{'pending':>10} " + " ".join(f"{name:>10}" for name in SCHEDULERS))
+    crossover = None
+    for size in args.sizes:
+        times = {name: time_hold(name, size, args.ops) for name in SCHEDULERS}
+        print(f"{size:>10,} " + " ".join(f"{times[name]:>10.0f}" for name in SCHEDULERS))
+        if crossover is None and times["calendar"] < times["heap"]:
+            crossover = size
+    print(f"calendar queue is faster from {crossover:,} pending events" if crossover else
+          "the heap was faster at every size")
+
+    print("\nevent mode sims, events per second")
+    print(f"{'stops':>10} {'pending':>10} " + " ".join(f"{name:>10}" for name in SCHEDULERS))
+    for n_stops in args.stops:
+        results = {name: time_sim(name, n_stops) for name in SCHEDULERS}
+        print(f"{n_stops:>10,} {results['heap']['peak_pending']:>10,} "
+              + " ".join(f"{results[name]['events_per_second']:>10,.0f}" for name in SCHEDULERS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""Throughput and memory benchmarks for Sim across scale parameters, and for the analysis pipeline
+
+Every case runs in a fresh worker process so that peak RSS is its own. Results can be saved as a baseline and later
+runs compared against it: a case regresses when a throughput metric drops, or a time or memory metric grows, by more
+than the threshold.
+
+Usage:
+    python -m benchmarks.bench_sim [--grid quick|full] [--save-baseline] [--baseline PATH] [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from multiprocessing import get_context
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.actions import BUS_MOVE, PASSENGER_JOIN_QUEUE, PASSENGER_EMBARK, PASSENGER_DISEMBARK
+from src.log import VoidLog, InMemoryLog, CSVLog, LogFilter
+from src.network import Network
+from src.sim import Sim
+from analysis.preprocessing import preprocess, make_passenger_df
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+SINKS = ("void", "memory", "csv", "filter")
+
+# (n_buses, n_stops, sim_duration in sim minutes, sink) for sims, numbers of stops in sparse networks of a fixed size
+# fleet, and numbers of passengers for the pipeline
+GRIDS = {
+    "quick": {
+        "sim": list(product([5, 10], [15], [24*60], SINKS)),
+        "network": [100, 10_000],
+        "pipeline": [10_000],
+    },
+    "full": {
+        "sim": list(product([5, 10, 20], [15, 30], [24*60, 3*24*60], SINKS)),
+        "network": [100, 1_000, 10_000, 100_000],
+        "pipeline": [10_000, 100_000, 1_000_000],
+    },
+}
+
+# the routes and fleet of the network cases, only the number of stops they pick from changes
+NETWORK_ROUTES = 20
+NETWORK_ROUTE_LENGTH = 30
+NETWORK_BUSES = 40
+
+# whether a bigger value of each metric is better, the others are compared the other way around
+HIGHER_IS_BETTER = {
+    "events_per_second": True,
+    "sim_minutes_per_second": True,
+    "rows_per_second": True,
+    "wall_time": False,
+    "setup_time": False,
+    "peak_rss_mb": False,
+    "traced_peak_mb": False,
+    "retained_blocks": False,
+}
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+
+
+def _make_log(sink: str, path: str):
+    if sink == "void":
+        return VoidLog()
+    if sink == "memory":
+        return InMemoryLog()
+    log = CSVLog(path=path, msg="bench")
+    if sink == "filter":
+        return LogFilter(log, keep=lambda r: r.action != BUS_MOVE)
+    return log
+
+
+def bench_sim(n_buses: int, n_stops: int, sim_duration: float, sink: str, seed: int = 0,
+              trace: bool = False) -> Dict[str, float]:
+    """Runs one seeded sim and measures it, meant to be called in a fresh process
+
+    Retained blocks come from sys.getallocatedblocks, the number of blocks still allocated when the run ends, so
+    sinks that hold on to records show up. With `trace`, the run is repeated under tracemalloc for its peak traced
+    memory, which is much slower.
+    """
+    Sim.n_stops = n_stops
+    with tempfile.TemporaryDirectory() as path:
+        blocks = sys.getallocatedblocks()
+        start = perf_counter()
+        sim = Sim(n_buses, log=_make_log(sink, path), seed=seed)
+        n_dispatches = sim.event_manager._n_dispatches
+        sim.run(stop_time=sim_duration)
+        wall_time = perf_counter() - start
+
+        result = {
+            "wall_time": wall_time,
+            "events": sim.event_manager._n_dispatches - n_dispatches,
+            "events_per_second": (sim.event_manager._n_dispatches - n_dispatches) / wall_time,
+            "sim_minutes_per_second": sim_duration / wall_time,
+            "peak_rss_mb": _peak_rss_mb(),
+            "retained_blocks": sys.getallocatedblocks() - blocks,
+        }
+        del sim
+
+        if trace:
+            tracemalloc.start()
+            Sim(n_buses, log=_make_log(sink, path), seed=seed).run(stop_time=sim_duration)
+            result["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+            tracemalloc.stop()
+    return result
+
+
+def bench_network(n_stops: int, sim_duration: float = 6*60, seed: int = 0) -> Dict[str, float]:
+    """Runs a sparse sim on a random network and times the event loop alone, meant to be called in a fresh process
+
+    The routes and buses are the same whatever the number of stops, so events per second should stay flat as the
+    network grows. Building the network is timed separately. Queue sampling is off, since every sample looks at every
+    stop.
+    """
+    network = Network.random(n_stops, NETWORK_ROUTES, NETWORK_ROUTE_LENGTH, seed=seed)
+    start = perf_counter()
+    sim = Sim(NETWORK_BUSES, log=VoidLog(), seed=seed, arrival_mode="sparse", network=network, queue_sampling="none")
+    setup_time = perf_counter() - start
+
+    n_dispatches = sim.event_manager._n_dispatches
+    start = perf_counter()
+    sim.run(stop_time=sim_duration)
+    wall_time = perf_counter() - start
+
+    return {
+        "setup_time": setup_time,
+        "wall_time": wall_time,
+        "events": sim.event_manager._n_dispatches - n_dispatches,
+        "events_per_second": (sim.event_manager._n_dispatches - n_dispatches) / wall_time,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def synthetic_log(n_passengers: int, seed: int = 0) -> pd.DataFrame:
+    """A raw log of passengers who each join a queue, board and get off, without running a sim
+
+    Every passenger has a JOIN_QUEUE event that is cancelled when they board, an EMBARK and a DISEMBARK, each with
+    its DISPATCHED and FINISHED or CANCELLED records, in time order.
+    """
+    rng = np.random.default_rng(seed)
+    join = np.sort(rng.uniform(0, n_passengers / 10, n_passengers))
+    seated = join + rng.exponential(5, n_passengers)
+    embarked = seated - rng.exponential(0.5, n_passengers)
+    alight = seated + rng.exponential(15, n_passengers)
+    off = alight + rng.exponential(0.5, n_passengers)
+    stops = rng.integers(1, 7, n_passengers, endpoint=True)
+
+    ids = np.arange(n_passengers)
+    nan = np.full(n_passengers, np.nan)
+    parts = [
+        # (event id offset, time, action, status, data)
+        (0, join, PASSENGER_JOIN_QUEUE, "DISPATCHED", np.zeros(n_passengers)),
+        (0, embarked, PASSENGER_JOIN_QUEUE, "CANCELLED", nan),
+        (1, embarked, PASSENGER_EMBARK, "DISPATCHED", nan),
+        (1, seated, PASSENGER_EMBARK, "FINISHED", nan),
+        (2, alight, PASSENGER_DISEMBARK, "DISPATCHED", stops.astype(float)),
+        (2, off, PASSENGER_DISEMBARK, "FINISHED", off - join),
+    ]
+    df = pd.DataFrame({
+        "event_id": np.concatenate([3*ids + offset for offset, *_ in parts]),
+        "time": np.concatenate([time for _, time, *_ in parts]),
+        "object_type": "Passenger",
+        "object_id": np.tile(ids, len(parts)),
+        "action": np.repeat([action for _, _, action, *_ in parts], n_passengers),
+        "status": np.repeat([status for *_, status, _ in parts], n_passengers),
+        "data": np.concatenate([data for *_, data in parts]),
+    })
+    return df.sort_values("time", kind="stable", ignore_index=True)
+
+
+def bench_pipeline(n_passengers: int, seed: int = 0) -> Dict[str, float]:
+    """Times preprocess and make_passenger_df on a synthetic log, meant to be called in a fresh process"""
+    df_raw = synthetic_log(n_passengers, seed)
+    start = perf_counter()
+    passengers = make_passenger_df(preprocess(df_raw))
+    wall_time = perf_counter() - start
+    assert len(passengers) == n_passengers
+
+    return {
+        "wall_time": wall_time,
+        "rows_per_second": len(df_raw) / wall_time,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _isolated(fn, *args, **kwargs):
+    """Calls `fn` in a fresh process, so that it doesn't share peak RSS or warmed up caches with other cases"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(fn, *args, **kwargs).result()
+
+
+def run_suite(grid: str = "quick", trace: bool = False) -> Dict[str, Dict[str, float]]:
+    """Runs every case in a grid, returns the metrics of each case keyed by the name of the case"""
+    results = {}
+    for n_buses, n_stops, sim_duration, sink in GRIDS[grid]["sim"]:
+        name = f"sim/buses={n_buses}/stops={n_stops}/minutes={sim_duration}/sink={sink}"
+        results[name] = _isolated(bench_sim, n_buses, n_stops, sim_duration, sink, trace=trace)
+        print(f"{name}: {results[name]['events_per_second']:,.0f} events/s, "
+              f"{results[name]['sim_minutes_per_second']:,.0f} sim min/s, {results[name]['peak_rss_mb']:.0f} MB")
+    for n_stops in GRIDS[grid]["network"]:
+        name = f"network/stops={n_stops}"
+        results[name] = _isolated(bench_network, n_stops)
+        print(f"{name}: {results[name]['events_per_second']:,.0f} events/s, "
+              f"{results[name]['setup_time']:.2f}s setup, {results[name]['peak_rss_mb']:.0f} MB")
+    for n_passengers in GRIDS[grid]["pipeline"]:
+        name = f"pipeline/passengers={n_passengers}"
+        results[name] = _isolated(bench_pipeline, n_passengers)
+        print(f"{name}: {results[name]['rows_per_second']:,.0f} rows/s, {results[name]['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            threshold: float) -> List[Tuple[str, str, float, float]]:
+    """Finds the metrics that got worse than the baseline by more than `threshold`, as a fraction of the baseline
+
+    Returns:
+        (case, metric, baseline value, new value) for every regression. Cases or metrics missing from either side are
+        skipped
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if metric not in HIGHER_IS_BETTER or metric not in baseline.get(name, {}):
+                continue
+            old = baseline[name][metric]
+            if HIGHER_IS_BETTER[metric]:
+                worse = value < old * (1 - threshold)
+            else:
+                worse = value > old * (1 + threshold)
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grid", choices=sorted(GRIDS), default="quick")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline results to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed regression, as a fraction")
+    parser.add_argument("--trace", action="store_true", help="also measure peak memory with tracemalloc (slow)")
+    parser.add_argument("--output", help="where to write the results as json")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.grid, args.trace)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline to store one")
+        return 0
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name} {metric}: {old:,.2f} -> {new:,.2f}")
+    if regressions:
+        return 1
+    print(f"no regressions beyond {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,26 @@ PASSENGER_ABANDON_QUEUE = "PASSENGER_ABANDON_QUEUE"
 
 # bus actions
 BUS_MOVE = "BUS_MOVE"
+BUS_DWELL = "BUS_DWELL"
 
 # stop actions
 STOP_PASSENGER_JOIN = "STOP_PASSENGER_JOIN"
 STOP_REPORT_QUEUE_LENGTH = "STOP_REPORT_QUEUE_LENGTH"
+STOP_ARRIVAL_WINDOW = "STOP_ARRIVAL_WINDOW"
+
+# sampler actions
+SAMPLE_QUEUE_LENGTHS = "SAMPLE_QUEUE_LENGTHS"
+
+# every action in a fixed order, so that logs can store each one as a small integer code
+ACTIONS = (
+    PASSENGER_JOIN_QUEUE,
+    PASSENGER_EMBARK,
+    PASSENGER_DISEMBARK,
+    PASSENGER_ABANDON_QUEUE,
+    BUS_MOVE,
+    STOP_PASSENGER_JOIN,
+    STOP_REPORT_QUEUE_LENGTH,
+    BUS_DWELL,
+    STOP_ARRIVAL_WINDOW,
+    SAMPLE_QUEUE_LENGTHS,
+)
@@ -0,0 +1,338 @@
+from typing import Optional, List, Tuple
+
+import numpy as np
+
+from src.sim import Sim
+from src.bus import Bus
+from src.passenger import Passenger
+from src.stop import ARRIVAL_RATES
+
+# what each bus is doing: travelling to its next stop, waiting for the stop to free up, about to start loading because
+# the stop just freed up, or dwelling at the stop while passengers get on and off
+MOVING, QUEUED, READY, DWELLING = range(4)
+
+# arrivals are drawn at the peak rate and thinned down to the rate of the hour they fall in
+PEAK_ARRIVAL_RATE = max(ARRIVAL_RATES)
+
+# initial number of passengers each stop's queue can hold, it grows as needed
+QUEUE_CAPACITY = 64
+
+PASSENGER_COLUMNS = ("replication", "stops_traveling", "seated_time", "wait_duration", "transit_duration",
+                     "wait_transit_ratio")
+
+
+def _row_searchsorted(a: np.ndarray, v: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """For each row i, counts the entries of a[i, :n[i]] that are strictly below each value in v[i]
+
+    The rows of `a` must be sorted up to n[i]. Rows are laid end to end by offsetting each one past the values of the
+    row before it, so a single searchsorted handles all of them.
+    """
+    rows, width = a.shape
+    valid = np.arange(width) < n[:, None]
+    span = 2 * (max(np.abs(v).max(initial=0), np.abs(np.where(valid, a, 0)).max(initial=0)) + 1)
+    offsets = span * np.arange(rows)[:, None]
+
+    # entries past n[i] are parked above every value of their row
+    flat = (np.where(valid, a, span / 2) + offsets).ravel()
+    counts = np.searchsorted(flat, (v + offsets).ravel(), side="left").reshape(v.shape)
+    return counts - width * np.arange(rows)[:, None]
+
+
+class BatchSim:
+
+    def __init__(self, n_buses: int, n_replications: int, seed: Optional[int] = None,
+                 queue_capacity: int = QUEUE_CAPACITY):
+        """Runs many independent replications of the bus route in lockstep, as numpy arrays
+
+        Each replication follows the same model as a `Sim` in aggregate dwell mode: buses travel the same ring of
+        stops, stops load one bus at a time in the order they arrived, and each dwell alights and then boards everyone
+        it can in one step, with service times drawn from the same distributions. Every replication keeps its own
+        clock. At each step, every replication processes its own next event, found with an argmin over its buses, and
+        all the replications processing the same kind of event are handled together.
+
+        Passengers are never created. Waiting passengers are stored as arrival times in a (replication x stop x queue)
+        array, and riders as arrival, seated and destination arrays of shape (replication x bus x capacity). Arrivals
+        at a stop are only drawn when a bus looks at it, by thinning a Poisson process at the peak rate, so each stop's
+        arrivals are an exact non-homogeneous Poisson process.
+
+        Args:
+            n_buses: the number of buses in each replication
+            n_replications: how many replications to run
+            seed: the seed for every random draw, shared by all the replications
+            queue_capacity: the initial number of passengers each stop's queue can hold
+        """
+        if n_buses <= 0:
+            raise ValueError("n_buses must be strictly positive")
+        if n_replications <= 0:
+            raise ValueError("n_replications must be strictly positive")
+
+        self.n_buses = n_buses
+        self.n_replications = n_replications
+        self.rng = np.random.default_rng(seed)
+        self.capacity = Bus.BUS_MAX_CAPACITY
+        self._rates = np.array(ARRIVAL_RATES)
+
+        R, B, S = n_replications, n_buses, Sim.n_stops
+
+        # buses, placed on the route like in Sim.create_buses, all start by moving to the next stop
+        self.bus_stop = np.tile(np.arange(B) % S, (R, 1))
+        self.bus_visits = np.zeros((R, B), dtype=np.int64)
+        self.bus_state = np.full((R, B), MOVING, dtype=np.int8)
+        self.bus_time = self._travel_times(R * B).reshape(R, B)
+        self.bus_queued_at = np.full((R, B), np.inf)
+
+        # riders, in boarding order, with the visit number they get off at
+        self.n_riders = np.zeros((R, B), dtype=np.int64)
+        self.rider_arrival = np.zeros((R, B, self.capacity))
+        self.rider_seated = np.zeros((R, B, self.capacity))
+        self.rider_dest = np.zeros((R, B, self.capacity), dtype=np.int64)
+        self.rider_stops = np.zeros((R, B, self.capacity), dtype=np.int8)
+
+        # stops, with the arrival times of the passengers waiting at each one, oldest first
+        self.stop_busy = np.zeros((R, S), dtype=bool)
+        self.queue = np.zeros((R, S, queue_capacity))
+        self.queue_len = np.zeros((R, S), dtype=np.int64)
+        self.last_sync = np.zeros((R, S))
+
+        self.time = np.zeros(R)
+        self.n_events = 0
+        self.n_arrived = np.zeros(R, dtype=np.int64)
+        self.n_abandoned = np.zeros(R, dtype=np.int64)
+        self._passengers: List[Tuple[np.ndarray, ...]] = []
+
+    def _travel_times(self, size: int) -> np.ndarray:
+        return np.maximum(0, self.rng.normal(Bus.TRAVEL_TIME_AVERAGE, Bus.TRAVEL_TIME_STD, size))
+
+    def run(self, stop_time: float) -> None:
+        """Runs every replication until its next event would happen at or after `stop_time`"""
+        rows = np.arange(self.n_replications)
+        while True:
+            bus = self.bus_time.argmin(axis=1)
+            time = self.bus_time[rows, bus]
+            active = time < stop_time
+            if not active.any():
+                break
+
+            r, b, t = rows[active], bus[active], time[active]
+            state = self.bus_state[r, b]
+            self.time[r] = t
+            self.n_events += len(r)
+
+            arriving = state == MOVING
+            if arriving.any():
+                self._arrive(r[arriving], b[arriving], t[arriving])
+            ready = state == READY
+            if ready.any():
+                self._dwell(r[ready], b[ready], t[ready])
+            dwelt = state == DWELLING
+            if dwelt.any():
+                self._dwell_done(r[dwelt], b[dwelt], t[dwelt])
+
+    def _arrive(self, r: np.ndarray, b: np.ndarray, t: np.ndarray) -> None:
+        """Buses pull up to the next stop, and start dwelling there unless another bus is loading"""
+        s = (self.bus_stop[r, b] + 1) % Sim.n_stops
+        self.bus_stop[r, b] = s
+        self.bus_visits[r, b] += 1
+
+        busy = self.stop_busy[r, s]
+        self.bus_state[r[busy], b[busy]] = QUEUED
+        self.bus_time[r[busy], b[busy]] = np.inf
+        self.bus_queued_at[r[busy], b[busy]] = t[busy]
+
+        free = ~busy
+        self.stop_busy[r[free], s[free]] = True
+        self._dwell(r[free], b[free], t[free])
+
+    def _dwell(self, r: np.ndarray, b: np.ndarray, t: np.ndarray) -> None:
+        """Buses alight everyone getting off here then board everyone they can, like Bus._dwell"""
+        self._sync_queues(r, self.bus_stop[r, b], t)
+        self._board(r, b, t, self._alight(r, b, t))
+
+    def _dwell_done(self, r: np.ndarray, b: np.ndarray, t: np.ndarray) -> None:
+        """Buses that finished dwelling board anyone who arrived in the meantime, or move on"""
+        s = self.bus_stop[r, b]
+        self._sync_queues(r, s, t)
+
+        boarding = (self.n_riders[r, b] < self.capacity) & (self.queue_len[r, s] > 0)
+        self._board(r[boarding], b[boarding], t[boarding], t[boarding])
+        self._depart(r[~boarding], b[~boarding], t[~boarding])
+
+    def _depart(self, r: np.ndarray, b: np.ndarray, t: np.ndarray) -> None:
+        """Buses leave their stop, which starts loading the bus that has been waiting there longest"""
+        s = self.bus_stop[r, b]
+        self.bus_state[r, b] = MOVING
+        self.bus_time[r, b] = t + self._travel_times(len(r))
+        self.stop_busy[r, s] = False
+
+        # each replication has at most one bus leaving, so the buses queued at its stop can be picked out per row
+        queued = (self.bus_state[r] == QUEUED) & (self.bus_stop[r] == s[:, None])
+        waiting_since = np.where(queued, self.bus_queued_at[r], np.inf)
+        next_bus = waiting_since.argmin(axis=1)
+        has_next = queued.any(axis=1)
+
+        r, next_bus, s, t = r[has_next], next_bus[has_next], s[has_next], t[has_next]
+        self.bus_state[r, next_bus] = READY
+        self.bus_time[r, next_bus] = t
+        self.bus_queued_at[r, next_bus] = np.inf
+        self.stop_busy[r, s] = True
+
+    def _sync_queues(self, r: np.ndarray, s: np.ndarray, t: np.ndarray) -> None:
+        """Brings the queues at stops s up to times t: new arrivals join and passengers out of patience leave"""
+        if not len(r):
+            return
+
+        # candidate arrivals at the peak rate since the queue was last looked at, thinned to the hourly rate
+        start = self.last_sync[r, s]
+        n_candidates = self.rng.poisson(PEAK_ARRIVAL_RATE * (t - start))
+        row = np.repeat(np.arange(len(r)), n_candidates)
+        arrival = self.rng.uniform(start[row], t[row])
+        hour = (arrival // 60).astype(np.int64) % 24
+        accepted = self.rng.random(len(arrival)) * PEAK_ARRIVAL_RATE < self._rates[hour]
+        row, arrival = row[accepted], arrival[accepted]
+        self.n_arrived += np.bincount(r[row], minlength=self.n_replications)
+        self.last_sync[r, s] = t
+
+        # passengers whose patience ran out before now never get on a bus
+        staying = arrival + Passenger.PATIENCE >= t[row]
+        self.n_abandoned += np.bincount(r[row[~staying]], minlength=self.n_replications)
+        row, arrival = row[staying], arrival[staying]
+
+        queue = self.queue[r, s]
+        slot = np.arange(queue.shape[1])
+        in_queue = slot < self.queue_len[r, s][:, None]
+        waiting = in_queue & (queue + Passenger.PATIENCE >= t[:, None])
+        self.n_abandoned += np.bincount(r, weights=(in_queue & ~waiting).sum(axis=1),
+                                        minlength=self.n_replications).astype(np.int64)
+
+        # everyone still waiting followed by the new arrivals, sorted by row and then arrival time
+        old_row, old_slot = np.nonzero(waiting)
+        row = np.concatenate((old_row, row))
+        arrival = np.concatenate((queue[old_row, old_slot], arrival))
+        order = np.lexsort((arrival, row))
+        row, arrival = row[order], arrival[order]
+
+        length = np.bincount(row, minlength=len(r))
+        if length.max(initial=0) > self.queue.shape[2]:
+            self._grow_queues(length.max())
+        position = np.arange(len(row)) - np.repeat(np.cumsum(length) - length, length)
+        self.queue[r[row], s[row], position] = arrival
+        self.queue_len[r, s] = length
+
+    def _grow_queues(self, size: int) -> None:
+        capacity = self.queue.shape[2]
+        while capacity < size:
+            capacity *= 2
+        queue = np.zeros(self.queue.shape[:2] + (capacity,))
+        queue[:, :, :self.queue.shape[2]] = self.queue
+        self.queue = queue
+
+    def _alight(self, r: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+        """Riders getting off at the current stop alight in boarding order, returns when the last one is off"""
+        n = self.n_riders[r, b]
+        slot = np.arange(self.capacity)
+        on_board = slot < n[:, None]
+        alighting = on_board & (self.rider_dest[r, b] == self.bus_visits[r, b][:, None])
+        if not alighting.any():
+            return t
+
+        # the i-th passenger off leaves with n - i on board
+        rank = np.cumsum(alighting, axis=1) - 1
+        n_on_board = np.maximum(1, n[:, None] - rank)
+        durations = Passenger.disembark_durations(n_on_board, self.rng.standard_normal(alighting.shape))
+        durations = np.where(alighting, durations, 0)
+        finish = t[:, None] + np.cumsum(durations, axis=1)
+
+        i, j = np.nonzero(alighting)
+        arrival = self.rider_arrival[r[i], b[i], j]
+        seated = self.rider_seated[r[i], b[i], j]
+        self._record(r[i], self.rider_stops[r[i], b[i], j], seated, seated - arrival, finish[i, j] - arrival)
+
+        # everyone else moves up, keeping boarding order
+        staying = on_board & ~alighting
+        order = np.argsort(~staying, axis=1, kind="stable")
+        for name in ("rider_arrival", "rider_seated", "rider_dest", "rider_stops"):
+            riders = getattr(self, name)
+            riders[r, b] = np.take_along_axis(riders[r, b], order, axis=1)
+        self.n_riders[r, b] = staying.sum(axis=1)
+
+        return t + durations.sum(axis=1)
+
+    def _board(self, r: np.ndarray, b: np.ndarray, now: np.ndarray, start: np.ndarray) -> None:
+        """Boards everyone waiting up to capacity from `start` on, like Bus._board_all, then dwells until they're seated
+
+        The j-th boarding slot goes to the first passenger in line after the one who took slot j - 1 whose patience
+        lasts until the slot starts, and passengers passed over walk away. Deadlines and slot start times both grow,
+        so the passenger for every slot is found at once with a searchsorted and a running maximum.
+        """
+        if not len(r):
+            return
+
+        s = self.bus_stop[r, b]
+        n = self.n_riders[r, b]
+        queue = self.queue[r, s]
+        queue_len = self.queue_len[r, s]
+        n_boarding = np.minimum(self.capacity - n, queue_len)
+        width = n_boarding.max(initial=0)
+
+        end = start.copy()
+        if width > 0:
+            slot = np.arange(width)
+            in_range = slot < n_boarding[:, None]
+            durations = Passenger.embark_durations(n[:, None] + slot, self.rng.standard_normal((len(r), width)))
+            times = start[:, None] + np.concatenate((np.zeros((len(r), 1)), np.cumsum(durations, axis=1)), axis=1)
+
+            # the index in line of the passenger taking each slot
+            passed_over = _row_searchsorted(queue + Passenger.PATIENCE, times[:, :-1], queue_len)
+            index = slot + np.maximum.accumulate(passed_over - slot, axis=1)
+            boards = in_range & (index < queue_len[:, None])
+            n_boarded = boards.sum(axis=1)
+
+            i, j = np.nonzero(boards)
+            arrival = queue[i, index[i, j]]
+            seat = n[i] + j
+            stops = self.rng.integers(1, 7, len(i), endpoint=True)
+            self.rider_arrival[r[i], b[i], seat] = arrival
+            self.rider_seated[r[i], b[i], seat] = times[i, j + 1]
+            self.rider_dest[r[i], b[i], seat] = self.bus_visits[r[i], b[i]] + stops
+            self.rider_stops[r[i], b[i], seat] = stops
+            self.n_riders[r, b] = n + n_boarded
+
+            # everyone up to the last passenger to board has left the line, or everyone if the line ran out first
+            last = np.take_along_axis(index, np.maximum(n_boarded - 1, 0)[:, None], axis=1)[:, 0]
+            cut = np.where(n_boarded == n_boarding, np.where(n_boarded > 0, last + 1, 0), queue_len)
+            self.n_abandoned += np.bincount(r, weights=cut - n_boarded, minlength=self.n_replications).astype(np.int64)
+
+            shifted = np.minimum(np.arange(queue.shape[1]) + cut[:, None], queue.shape[1] - 1)
+            self.queue[r, s] = np.take_along_axis(queue, shifted, axis=1)
+            self.queue_len[r, s] = queue_len - cut
+
+            end = times[np.arange(len(r)), n_boarded]
+
+        self.bus_state[r, b] = DWELLING
+        self.bus_time[r, b] = np.maximum(end, now)
+
+    def _record(self, replication, stops_traveling, seated_time, wait, transit) -> None:
+        self._passengers.append((replication, stops_traveling, seated_time, wait, transit))
+
+    def passenger_df(self):
+        """The statistics of every passenger who got off a bus, like `make_passenger_df` with a replication column
+
+        Rows are in the order passengers got off within each replication.
+        """
+        import pandas as pd
+
+        if self._passengers:
+            columns = [np.concatenate(column) for column in zip(*self._passengers)]
+        else:
+            columns = [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8)] + [np.zeros(0)] * 3
+        replication, stops_traveling, seated_time, wait, transit = columns
+
+        df = pd.DataFrame({
+            "replication": replication,
+            "stops_traveling": stops_traveling,
+            "seated_time": seated_time,
+            "wait_duration": wait,
+            "transit_duration": transit,
+            "wait_transit_ratio": wait / transit,
+        }, columns=list(PASSENGER_COLUMNS))
+        return df.sort_values("replication", kind="stable", ignore_index=True)
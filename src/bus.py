@@ -1,9 +1,14 @@
-from scipy import stats
-from typing import List
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
 
 from src.event_manager import EventManager
 from src.passenger import Passenger
-from src.actions import BUS_MOVE
+from src.actions import BUS_MOVE, BUS_DWELL
+
+# "passenger" dispatches one event per embarking or disembarking passenger, "aggregate" simulates every passenger
+# at a stop in one vectorized step and dispatches a single BUS_DWELL event
+DWELL_MODES = ("passenger", "aggregate")
 
 
 class Bus:
@@ -16,13 +21,41 @@ class Bus:
     # how many buses are in operation
     _bus_num = 0
 
-    def __init__(self, event_manager: EventManager, stop):
+    def __init__(self, event_manager: EventManager, stop, dwell_mode: str = "passenger",
+                 route: Optional[Sequence] = None):
+        """A bus that drives from stop to stop, picking up and dropping off passengers
+
+        Args:
+            event_manager: an instance of the event manager class
+            stop: the stop the bus starts at
+            dwell_mode: how the bus loads passengers, one of DWELL_MODES
+            route: the stops the bus visits in order, looping back to the first after the last. The bus starts at the
+                first visit to `stop`. Without a route, the bus goes to `stop.next` from each stop
+        """
+        if dwell_mode not in DWELL_MODES:
+            raise ValueError(f"dwell_mode must be one of {DWELL_MODES}")
+        self.dwell_mode = dwell_mode
+
         self.event_manager = event_manager
-        self.passengers: List[Passenger] = []
         self.stop = stop
+        self.route = route
+        self._route_position = route.index(stop) if route is not None else None
+        self._rng = event_manager.random.bus
+        self._passenger_rng = event_manager.random.passenger
 
         self.thing = None
 
+        # riders are bucketed by the stop they get off at, counted in stops visited since the bus started, so arriving
+        # at a stop touches nobody and alighting only touches the riders getting off. Buckets keep boarding order
+        self._riders: Dict[int, List[Passenger]] = {}
+        self._stops_visited = 0
+        self.n_passengers = 0
+
+        # progress through the passengers disembarking at the current stop
+        self._disembarking = ()
+        self._n_disembarked = 0
+        self._n_before_disembark = 0
+
         # assigns a process-unique id to each Bus
         self.id = Bus._bus_num
         Bus._bus_num += 1
@@ -33,69 +66,155 @@ class Bus:
     def __hash__(self):
         return self.id
 
+    @property
+    def passengers(self) -> Tuple[Passenger, ...]:
+        """The passengers on board, in the order they get off, read-only: see `add_passenger`"""
+        return tuple(p for visit in sorted(self._riders) for p in self._riders[visit])
+
+    @passengers.setter
+    def passengers(self, passengers: Sequence[Passenger]) -> None:
+        self._riders = {}
+        self.n_passengers = 0
+        for p in passengers:
+            self.add_passenger(p)
+
+    def add_passenger(self, passenger: Passenger) -> None:
+        """Puts a passenger on board, in the bucket for the stop they get off at, `stops_remaining` stops from here"""
+        visit = self._stops_visited + passenger.stops_remaining
+        riders = self._riders.get(visit)
+        if riders is None:
+            self._riders[visit] = [passenger]
+        else:
+            riders.append(passenger)
+        self.n_passengers += 1
+
+    def alighting(self) -> List[Passenger]:
+        """The passengers who get off at the current stop, in the order they boarded"""
+        return self._riders.get(self._stops_visited, [])
+
     def move(self):
-        """Go to the next stop, decrement passenger step counters, and request to park"""
+        """Go to the next stop and request to park"""
 
         # notify the stop that we are leaving
         self.stop.depart()
 
-        execution_time = stats.norm.rvs(
+        execution_time = self._rng.normal(
                 loc=Bus.TRAVEL_TIME_AVERAGE,
                 scale=Bus.TRAVEL_TIME_STD
             )
 
-        def cb():
-            self.stop = self.stop.next
-            for p in self.passengers:
-                p.stops_remaining -= 1
+        self.event_manager.dispatch(self, BUS_MOVE, execution_time, self._arrive)
 
-            # hands control to stop, control will be restored via call to disembark when the stop loads the bus
-            self.stop.park(self)
+    def _arrive(self):
+        """Called when a BUS_MOVE finishes"""
+        if self.route is None:
+            self.stop = self.stop.next
+        else:
+            self._route_position = (self._route_position + 1) % len(self.route)
+            self.stop = self.route[self._route_position]
+        self._stops_visited += 1
 
-        self.event_manager.dispatch(self, BUS_MOVE, execution_time, cb)
+        # hands control to stop, control will be restored via call to disembark when the stop loads the bus
+        self.stop.park(self)
 
     def disembark(self):
         """Exit all passengers who belong at the station, then request to embark"""
-        n_passengers = len(self.passengers)
-        disembarking_passengers = tuple(p for p in self.passengers if p.stops_remaining == 0)
-        i = 0
-
-        def disembark_next():
-            nonlocal i, disembarking_passengers, n_passengers
+        if self.dwell_mode == "aggregate":
+            return self._dwell()
 
-            if i < len(disembarking_passengers):
+        self._n_before_disembark = self.n_passengers
+        self._disembarking = self._riders.pop(self._stops_visited, ())
+        self._n_disembarked = 0
+        self._disembark_next()
 
-                # note passengers are unloaded in same order as they loaded: FIFO
-                disembarking_passenger = disembarking_passengers[i]
+    def _disembark_next(self):
+        """Exit the next disembarking passenger, or move on to embarking once they are all off"""
+        if self._n_disembarked < len(self._disembarking):
 
-                i += 1
+            # note passengers are unloaded in same order as they loaded: FIFO
+            disembarking_passenger = self._disembarking[self._n_disembarked]
 
-                # hands control to the passenger
-                disembarking_passenger.disembark(
-                    n_passengers - i + 1,
-                    disembark_next          # control returned via callback
-                )
+            self._n_disembarked += 1
 
-            else:
-                transiting_set = set(disembarking_passengers)
-                self.passengers = [p for p in self.passengers if p not in transiting_set]
-                self.embark()
+            # hands control to the passenger
+            disembarking_passenger.disembark(
+                self._n_before_disembark - self._n_disembarked + 1,
+                self._disembark_next          # control returned via callback
+            )
 
-        disembark_next()
+        else:
+            self.n_passengers -= len(self._disembarking)
+            self._disembarking = ()
+            self.embark()
 
     def embark(self):
         """Board passengers, then request to move"""
-
-        def embark_next():
-            if len(self.passengers) < Bus.BUS_MAX_CAPACITY and self.stop.passengers_waiting:
-                embarking = self.stop.passengers_waiting.pop()
-
-                def cb():
-                    self.passengers.append(embarking)
-                    embark_next()
-
-                embarking.embark(len(self.passengers), cb)
-            else:
-                self.move()
-
-        embark_next()
+        if self.n_passengers < Bus.BUS_MAX_CAPACITY and self.stop.passengers_waiting:
+            embarking = self.stop.passengers_waiting.pop()
+            embarking.embark(self.n_passengers, self._seat, (embarking,))
+        else:
+            self.move()
+
+    def _seat(self, passenger: Passenger):
+        """Called when a passenger has finished embarking, control returns to embark"""
+        self.add_passenger(passenger)
+        self.embark()
+
+    def _dwell(self):
+        """Aggregate dwell mode: simulates all disembarking and embarking at the stop at once
+
+        Service times are drawn in one vectorized step with the same distributions as in passenger mode, and each
+        passenger's embark or disembark is logged straight away with `Passenger.board` and `Passenger.alight`. The
+        bus then waits out the whole dwell in a single BUS_DWELL event.
+        """
+        time = self.event_manager.time
+        n_passengers = self.n_passengers
+        disembarking = self._riders.pop(self._stops_visited, None)
+
+        if disembarking:
+            # passengers are unloaded in the same order as they loaded, the i-th one leaves with n - i on board
+            n_on_board = n_passengers - np.arange(len(disembarking))
+            durations = Passenger.disembark_durations(n_on_board, self._passenger_rng.normals(len(disembarking)))
+            times = (time + np.concatenate(([0], np.cumsum(durations)))).tolist()
+
+            for p, start, finish in zip(disembarking, times[:-1], times[1:]):
+                p.alight(start, finish)
+
+            self.n_passengers -= len(disembarking)
+            time = times[-1]
+
+        self._board_all(time)
+
+    def _board_all(self, time: float):
+        """Boards everyone waiting, up to capacity, starting at `time` and dispatches a BUS_DWELL until the last is seated"""
+        waiting = self.stop.passengers_waiting
+        n_boarding = min(Bus.BUS_MAX_CAPACITY - self.n_passengers, len(waiting))
+
+        if n_boarding > 0:
+            # the j-th passenger to board gets on with n + j passengers already on board
+            n_on_board = self.n_passengers + np.arange(n_boarding)
+            durations = Passenger.embark_durations(n_on_board, self._passenger_rng.normals(n_boarding))
+            times = (time + np.concatenate(([0], np.cumsum(durations)))).tolist()
+
+            # passengers who would run out of patience before their turn stay in line until they walk away
+            positions = []
+            for k, deadline in enumerate(waiting.deadlines()):
+                if len(positions) == n_boarding:
+                    break
+                if deadline >= times[len(positions)]:
+                    positions.append(k)
+
+            if positions:
+                for j, p in enumerate(waiting.take(positions)):
+                    p.board(times[j], times[j + 1])
+                    self.add_passenger(p)
+            time = times[len(positions)]
+
+        self.event_manager.dispatch(self, BUS_DWELL, time - self.event_manager.time, self._dwell_done)
+
+    def _dwell_done(self):
+        """Called when a BUS_DWELL finishes, boards anyone who arrived in the meantime or moves on"""
+        if self.n_passengers < Bus.BUS_MAX_CAPACITY and self.stop.passengers_waiting:
+            self._board_all(self.event_manager.time)
+        else:
+            self.move()
@@ -1,38 +1,64 @@
-from dataclasses import dataclass
-from queue import PriorityQueue
-from typing import Callable
+from typing import Callable, Optional
+from time import perf_counter
 
-from src.log import Log, LogRecord
+from src.log import Log
+from src.random_source import RandomSource
+from src.profiling import Profiler, ProfiledLog, histogram_bucket
+from src.scheduler import Scheduler, HeapScheduler
 
 
-@dataclass(frozen=True)
 class Event:
-    """Class used internally in Sim to store upcoming events
+    """Class used internally in EventManager to store upcoming events
+
+    Events are allocated once per dispatch and carry everything needed to finish them, so no closure has to be built.
+    The callback is called with `args` when the event finishes. Events are returned from dispatch as handles that can
+    be passed to EventManager.cancel.
 
     Args:
-        time: the time (in sim mins) when the event finishes
-        callback: function to execute when the event is finished
+        id: the unique id of the event, also used to break ties between events finishing at the same time
+        obj: the object that initiated the event
+        action: the type of action being performed
+        callback: function to execute when the event is finished, or None
+        args: positional arguments for the callback
     """
-    time: float
-    callback: Callable[[float], None]
+    __slots__ = ("id", "obj", "action", "callback", "args", "done")
+
+    def __init__(self, id: int, obj: object, action: str, callback: Optional[Callable], args: tuple) -> None:
+        self.id = id
+        self.obj = obj
+        self.action = action
+        self.callback = callback
+        self.args = args
 
-    def __lt__(self, other):
-        if not isinstance(other, Event):
-            raise ValueError(f"cannot compare Event to {other.__class__}")
-        return self.time < other.time
+        # set once the event has finished or been cancelled
+        self.done = False
 
 
 class EventManager:
 
-    def __init__(self, log: Log):
+    # the scheduler is rid of cancelled events once there are at least this many of them and they make up more than half
+    # of its entries
+    COMPACT_MIN_CANCELLED = 1024
+
+    def __init__(self, log: Log, random: Optional[RandomSource] = None, scheduler: Optional[Scheduler] = None):
         """Class that governs the game clock and executes events in order
 
+        Upcoming events are kept in a scheduler as (time, event_id, event) tuples, a binary heap by default. Event ids
+        increase with every dispatch, so events that finish at the same time fire in the order they were dispatched,
+        and comparisons never have to look past the first two fields.
+
         Args:
             log: a log object
+            random: the source of random numbers shared by everything in the sim, unseeded if not provided
+            scheduler: holds the upcoming events, a HeapScheduler if not provided
         """
         self._n_dispatches = 1000
+        self.profiler: Optional[Profiler] = None
         self.log = log
-        self.queue = PriorityQueue()
+        self.random = random if random else RandomSource()
+        self.queue: Scheduler = scheduler if scheduler is not None else HeapScheduler()
+        self._push, self._pop = self.queue.bind()
+        self._n_cancelled = 0
         self._time = 0
 
     @property
@@ -40,37 +66,148 @@ class EventManager:
         """getter for self._time, protects value from accidental tampering"""
         return self._time
 
-    def dispatch(self, obj: object, action: str, duration: float, callback: Callable = (lambda: None), data=None) -> None:
+    @property
+    def logging(self) -> bool:
+        """Whether the log keeps records, callers can skip building data that would only be thrown away"""
+        return self._logging
+
+    @property
+    def log(self) -> Log:
+        return self._log.base_log if self.profiler is not None else self._log
+
+    @log.setter
+    def log(self, log: Log) -> None:
+        if self.profiler is not None:
+            log = ProfiledLog(log, self.profiler)
+
+        # cached so that sinks which throw everything away cost a single branch per event
+        self._log = log
+        self._logging = log.enabled
+
+    def profile(self, profiler: Optional[Profiler] = None) -> Profiler:
+        """Turns on profiling, from now on runs collect counters and timings per action into the returned Profiler
+
+        Profiling wraps the log in a ProfiledLog and swaps in an instrumented event loop, so nothing is added to the
+        regular loop. Events are counted even if the log throws its records away.
+
+        Args:
+            profiler: the profiler to add to, a new one if not given
+        """
+        if self.profiler is not None:
+            raise ValueError("already profiling")
+        log = self._log
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.log = log
+        return self.profiler
+
+    def stop_profiling(self) -> Optional[Profiler]:
+        """Turns off profiling and returns the profiler, if there was one"""
+        profiler = self.profiler
+        if profiler is not None:
+            log = self._log.base_log
+            self.profiler = None
+            self.log = log
+        return profiler
+
+    def dispatch(self, obj: object, action: str, duration: float, callback: Optional[Callable] = None, data=None,
+                 args: tuple = (), start_time: Optional[float] = None) -> Event:
         """Adds an event to the queue
 
         Args:
             obj: the object initiating this action
             action: the type of action being performed
             duration: the length (in sim minutes) of the event
-            callback: function to execute when the event is finished
+            callback: function to execute when the event is finished, its return value is logged
+            data: extra information recorded with the DISPATCHED log record
+            args: positional arguments passed to the callback
+            start_time: when the event started, defaults to now. Events may have started in the past as long as they
+                finish no earlier than now
+
+        Returns:
+            a handle that can be used to cancel the event
         """
         if duration < 0:
             raise ValueError("duration must be nonnegative")
+        if start_time is None:
+            start_time = self._time
+        elif start_time + duration < self._time:
+            raise ValueError("events can't finish in the past")
+
+        event_id = self._n_dispatches
+        self._n_dispatches += 1
+
+        if self._logging:
+            self._log.record(event_id, start_time, obj, action, "DISPATCHED", data)
+
+        event = Event(event_id, obj, action, callback, args)
+        self._push((start_time + duration, event_id, event))
+        return event
+
+    def log_event(self, obj: object, action: str, start_time: float, finish_time: float, data=None,
+                  cb_data=None) -> None:
+        """Records an event that was simulated outside of the queue, e.g. in bulk, without scheduling it
+
+        The event gets an id like a dispatched event, and its DISPATCHED and FINISHED records are both written right
+        away, so the times may lie in the future.
+
+        Args:
+            obj: the object that performed the action
+            action: the type of action performed
+            start_time: when the event started
+            finish_time: when the event finished
+            data: recorded with the DISPATCHED log record
+            cb_data: recorded with the FINISHED log record
+        """
+        if finish_time < start_time:
+            raise ValueError("finish_time must not be before start_time")
 
         event_id = self._n_dispatches
         self._n_dispatches += 1
 
-        def cb(time: float) -> None:
-            cb_return = callback()
-            self.log.write(LogRecord(event_id, time, obj, action, "FINISHED", cb_return))
+        if self._logging:
+            self._log.record(event_id, start_time, obj, action, "DISPATCHED", data)
+            self._log.record(event_id, finish_time, obj, action, "FINISHED", cb_data)
+
+    def cancel(self, event: Event, time: Optional[float] = None) -> None:
+        """Cancels a pending event so that its callback never runs
 
-        self.log.write(LogRecord(event_id, self.time, obj, action, "DISPATCHED", data))
+        The event is logged as CANCELLED at `time`, in place of the FINISHED record it would have had. Cancelled
+        events are skipped when they reach the front of the queue, and the queue is compacted when they pile up.
+        Cancelling an event that has already finished or been cancelled does nothing.
+
+        Args:
+            event: the handle returned by dispatch
+            time: when the event was cancelled, the current time if not given. Later times are for cancellations that
+                are simulated ahead of time, like the boardings of an aggregate dwell
+        """
+        if event.done:
+            return
+        event.done = True
+        self._n_cancelled += 1
 
-        self.queue.put(Event(
-            time=self.time + duration,
-            callback=cb
-        ))
+        if self._logging:
+            self._log.record(event.id, self._time if time is None else time, event.obj, event.action, "CANCELLED")
+
+        if self._n_cancelled >= EventManager.COMPACT_MIN_CANCELLED and 2*self._n_cancelled > len(self.queue):
+            self.compact()
+
+    def compact(self) -> None:
+        """Removes cancelled events from the scheduler"""
+        self.queue.remove_done()
+        self._n_cancelled = 0
 
     def next(self) -> None:
         """Move the sim clock forward until the next event finishes and execute callback"""
-        task = self.queue.get()
-        self._time = task.time
-        task.callback(self.time)
+        time, _, event = self._pop()
+        while event.done:
+            self._n_cancelled -= 1
+            time, _, event = self._pop()
+        event.done = True
+
+        self._time = time
+        cb_return = event.callback(*event.args) if event.callback is not None else None
+        if self._logging:
+            self._log.record(event.id, time, event.obj, event.action, "FINISHED", cb_return)
 
     def run(self, max_events=float("inf"), stop_time=float("inf")) -> None:
         """Run the simulation
@@ -79,9 +216,67 @@ class EventManager:
             max_events: only run this many events at maximum
             stop_time: stop after this many game minutes have elapsed
         """
+        if self.profiler is not None:
+            return self._run_profiled(max_events, stop_time)
+
+        # the body of next() is inlined here, this loop runs once per event. Schedulers raise IndexError once they are
+        # empty, which is cheaper to catch than asking them for their length every time
+        pop = self._pop
         i = 0
-        while not self.queue.empty() and self.time < stop_time:
-            self.next()
+        while self._time < stop_time:
+            try:
+                time, _, event = pop()
+            except IndexError:
+                break
+            if event.done:
+                self._n_cancelled -= 1
+                continue
+            event.done = True
+            self._time = time
+
+            callback = event.callback
+            cb_return = callback(*event.args) if callback is not None else None
+            if self._logging:
+                self._log.record(event.id, time, event.obj, event.action, "FINISHED", cb_return)
+
+            i += 1
+            if i >= max_events:
+                break
+
+    def _run_profiled(self, max_events, stop_time) -> None:
+        """The loop of run(), timing every callback and tracking the size of the scheduler for the profiler"""
+        profiler = self.profiler
+        queue = self.queue
+        i = 0
+        run_start = perf_counter()
+        while queue and self._time < stop_time:
+            if len(queue) > profiler.peak_heap:
+                profiler.peak_heap = len(queue)
+
+            time, _, event = self._pop()
+            if event.done:
+                self._n_cancelled -= 1
+                continue
+            event.done = True
+            self._time = time
+
+            # log writes made by the callback are counted as log time, not callback time
+            log_time = profiler.log_time
+            start = perf_counter()
+            callback = event.callback
+            cb_return = callback(*event.args) if callback is not None else None
+            elapsed = perf_counter() - start - (profiler.log_time - log_time)
+
+            stats = profiler.action(event.action)
+            stats.executed += 1
+            stats.callback_time += elapsed
+            stats.histogram[histogram_bucket(elapsed)] += 1
+
+            self._log.record(event.id, time, event.obj, event.action, "FINISHED", cb_return)
+
             i += 1
             if i >= max_events:
                 break
+
+        profiler.n_events += i
+        profiler.wall_time += perf_counter() - run_start
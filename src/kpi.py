@@ -0,0 +1,304 @@
+from dataclasses import dataclass, field, asdict
+from typing import Union, Any, Dict, Tuple, List, Sequence
+
+from src.log import Log, LogRecord
+from src.actions import PASSENGER_JOIN_QUEUE, PASSENGER_EMBARK, PASSENGER_DISEMBARK, PASSENGER_ABANDON_QUEUE
+
+# quantiles estimated for every passenger statistic
+QUANTILES = (0.5, 0.9, 0.95)
+
+
+class RunningStats:
+
+    def __init__(self) -> None:
+        """Mean, variance and range of a stream of numbers in constant memory, using Welford's algorithm"""
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+
+    @property
+    def variance(self) -> float:
+        """The sample variance, NaN for fewer than two observations"""
+        return self._m2 / (self.count - 1) if self.count > 1 else float("nan")
+
+
+class P2Quantile:
+
+    def __init__(self, p: float) -> None:
+        """Streaming estimate of a single quantile in constant memory, using the P-square algorithm
+
+        Five markers track the minimum, the p/2, p and (1+p)/2 quantiles and the maximum, and are nudged towards their
+        desired positions with piecewise-parabolic interpolation as observations arrive. See Jain and Chlamtac, "The
+        P2 algorithm for dynamic calculation of quantiles and histograms without storing observations" (1985).
+
+        Args:
+            p: the quantile to estimate, strictly between 0 and 1
+        """
+        if not 0 < p < 1:
+            raise ValueError("p must be strictly between 0 and 1")
+        self.p = p
+        self.count = 0
+        self._heights: List[float] = []
+        self._positions = [0, 1, 2, 3, 4]
+        self._desired = [0, 2*p, 4*p, 2 + 2*p, 4]
+        self._increments = [0, p/2, p, (1 + p)/2, 1]
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        q = self._heights
+
+        # the first five observations are the initial marker heights
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        n = self._positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # adjust the heights of the middle markers if they are off their desired positions
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    @property
+    def value(self) -> float:
+        """The current estimate, exact for five or fewer observations and NaN for none"""
+        if self.count == 0:
+            return float("nan")
+        if self.count <= 5:
+            # nearest rank on the sorted observations
+            return self._heights[min(self.count - 1, int(self.p * self.count))]
+        return self._heights[2]
+
+
+class DistributionSketch:
+
+    def __init__(self, quantiles: Sequence[float] = QUANTILES) -> None:
+        """Summary statistics plus a set of streaming quantile estimates for one stream of numbers"""
+        self.stats = RunningStats()
+        self.quantiles = [P2Quantile(p) for p in quantiles]
+
+    def add(self, x: float) -> None:
+        self.stats.add(x)
+        for q in self.quantiles:
+            q.add(x)
+
+    def summary(self) -> "DistributionSummary":
+        return DistributionSummary(
+            count=self.stats.count,
+            mean=self.stats.mean if self.stats.count else float("nan"),
+            variance=self.stats.variance,
+            min=self.stats.min if self.stats.count else float("nan"),
+            max=self.stats.max if self.stats.count else float("nan"),
+            quantiles={q.p: q.value for q in self.quantiles}
+        )
+
+
+@dataclass(frozen=True)
+class DistributionSummary:
+    count: int
+    mean: float
+    variance: float
+    min: float
+    max: float
+    quantiles: Dict[float, float] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class KPISummary:
+    """Result of a KPILog, see KPILog for the definitions
+
+    Args:
+        n_passengers: the number of passengers who completed a trip
+        n_abandoned: the number of passengers who gave up waiting
+        wait: time from joining the queue to being seated, for passengers who completed a trip
+        transit: time from joining the queue to getting off the bus, for passengers who completed a trip
+        wait_transit_ratio: wait divided by transit, for passengers who completed a trip
+        queue_length: the time-weighted mean queue length at each stop, keyed by stop id
+        max_queue_length: the longest queue at each stop after the burn-in, keyed by stop id
+    """
+    n_passengers: int
+    n_abandoned: int
+    wait: DistributionSummary
+    transit: DistributionSummary
+    wait_transit_ratio: DistributionSummary
+    queue_length: Dict[int, float]
+    max_queue_length: Dict[int, int]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class _StopQueue:
+    """Time-weighted length of the queue at a single stop
+
+    The area under the queue length up to `end` is `length * end` minus the sum of `delta * time` over the changes,
+    which does not depend on the order the changes come in. Stops in batch and lazy mode log arrivals and abandonments
+    after the fact, so changes are not always recorded in time order. The maximum is taken in the order changes are
+    recorded, over the lengths held after the burn-in: both sides of a change after it, and the length carried out of
+    it, see `peak`.
+    """
+    __slots__ = ("length", "max", "weighted_time")
+
+    def __init__(self) -> None:
+        self.length = 0
+        self.max = 0
+        self.weighted_time = 0.0
+
+    def change(self, time: float, delta: int, count_max: bool = True) -> None:
+        if count_max and self.length > self.max:
+            # the length before the change held until `time`
+            self.max = self.length
+        self.weighted_time += delta * time
+        self.length += delta
+        if count_max and self.length > self.max:
+            self.max = self.length
+
+    def area(self, end: float) -> float:
+        return self.length * end - self.weighted_time
+
+    def peak(self) -> int:
+        """The longest queue, including the current length, which has held since the last change"""
+        return max(self.max, self.length)
+
+
+class KPILog(Log):
+
+    def __init__(self, burnin: float = 0, quantiles: Sequence[float] = QUANTILES) -> None:
+        """Computes passenger and queue KPIs on the fly instead of storing records
+
+        Passenger statistics match those of `analysis.preprocessing.make_passenger_df`: they are taken when a passenger
+        gets off the bus, so passengers still on board when the sim stops are not counted. State is only kept for
+        passengers who are waiting or riding, so memory does not grow with the length of the run. Passengers who joined
+        a queue before the log started, e.g. in a sim restored from a snapshot, are left out.
+
+        Args:
+            burnin: passengers who joined a queue before this time (in sim minutes) are left out, and queue lengths
+                are averaged and maximized from this time on
+            quantiles: the quantiles to estimate for every passenger statistic
+        """
+        self.burnin = burnin
+        self.n_abandoned = 0
+        self.wait = DistributionSketch(quantiles)
+        self.transit = DistributionSketch(quantiles)
+        self.wait_transit_ratio = DistributionSketch(quantiles)
+
+        self._time = 0
+        self._queues: Dict[int, _StopQueue] = {}
+
+        # passenger id -> (queue time, stop id) for waiting passengers, passenger id -> queue time for boarding
+        # passengers, and passenger id -> wait for riding passengers
+        self._waiting: Dict[int, Tuple[float, int]] = {}
+        self._boarding: Dict[int, float] = {}
+        self._riding: Dict[int, float] = {}
+
+    def _queue(self, stop_id: int) -> _StopQueue:
+        queue = self._queues.get(stop_id)
+        if queue is None:
+            queue = self._queues[stop_id] = _StopQueue()
+        return queue
+
+    def _queue_change(self, stop_id: int, time: float, delta: int) -> None:
+        # changes during burn-in only set the starting length, and don't count towards the maximum
+        self._queue(stop_id).change(max(time, self.burnin), delta, time > self.burnin)
+
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        self._update(time, getattr(obj, "id", -1), action, status, data)
+
+    def write(self, record: LogRecord) -> None:
+        self._update(record.time, record.object_id, record.action, record.status, record.data)
+
+    def _update(self, time: Union[float, int], object_id: int, action: str, status: str, data: Any) -> None:
+        if time > self._time:
+            self._time = time
+
+        if status == "DISPATCHED":
+            if action == PASSENGER_JOIN_QUEUE:
+                # the stop id is recorded as data on the join event
+                self._waiting[object_id] = (time, data)
+                self._queue_change(data, time, 1)
+            elif action == PASSENGER_ABANDON_QUEUE:
+                waiting = self._waiting.pop(object_id, None)
+                if waiting is not None:
+                    queue_time, stop_id = waiting
+                    self._queue_change(stop_id, time, -1)
+                    if queue_time > self.burnin:
+                        self.n_abandoned += 1
+
+        elif status == "CANCELLED":
+            # a passenger's patience timer is cancelled when they are taken off the queue to board
+            if action == PASSENGER_JOIN_QUEUE:
+                waiting = self._waiting.pop(object_id, None)
+                if waiting is not None:
+                    queue_time, stop_id = waiting
+                    self._queue_change(stop_id, time, -1)
+                    self._boarding[object_id] = queue_time
+
+        elif status == "FINISHED":
+            if action == PASSENGER_EMBARK:
+                queue_time = self._boarding.pop(object_id, None)
+                if queue_time is not None and queue_time > self.burnin:
+                    self._riding[object_id] = time - queue_time
+            elif action == PASSENGER_DISEMBARK:
+                wait = self._riding.pop(object_id, None)
+                if wait is not None:
+                    # the transit time is returned from the disembark callback
+                    self.wait.add(wait)
+                    self.transit.add(data)
+                    self.wait_transit_ratio.add(wait / data)
+
+    def summary(self) -> KPISummary:
+        """Summarizes the run so far, queue lengths are averaged up to the time of the latest record"""
+        end = max(self._time, self.burnin)
+        queue_length = {}
+        for stop_id, queue in self._queues.items():
+            queue_length[stop_id] = queue.area(end) / (end - self.burnin) if end > self.burnin else float("nan")
+
+        return KPISummary(
+            n_passengers=self.wait.stats.count,
+            n_abandoned=self.n_abandoned,
+            wait=self.wait.summary(),
+            transit=self.transit.summary(),
+            wait_transit_ratio=self.wait_transit_ratio.summary(),
+            queue_length=queue_length,
+            max_queue_length={
+                stop_id: queue.peak() if end > self.burnin else 0 for stop_id, queue in self._queues.items()
+            }
+        )
@@ -1,30 +1,96 @@
-from typing import Callable, Union, List, Any
+from typing import Callable, Union, List, Any, Dict, Optional
 from dataclasses import dataclass
 from abc import abstractmethod, ABC
+from queue import Queue
+from threading import Thread
 import datetime
+import json
 import os
 
+import numpy as np
+
+from src.actions import ACTIONS
+
+# the object types that initiate events, in a fixed order so that logs can store each one as a small integer code
+OBJECT_TYPES = ("Passenger", "Bus", "Stop")
+
+STATUSES = ("DISPATCHED", "FINISHED", "CANCELLED")
+STATUS_CODES = {status: i for i, status in enumerate(STATUSES)}
+
+# columns of the numeric log formats and their dtypes, in the order of the csv header
+COLUMNS = (
+    ("event_id", np.int64),
+    ("time", np.float64),
+    ("object_type", np.int8),
+    ("object_id", np.int64),
+    ("action", np.int8),
+    ("status", np.int8),
+    ("data", np.float64),
+)
+
+# layout of a single fixed-width record in a BinaryLog file
+RECORD_DTYPE = np.dtype([(name, np.dtype(dtype).newbyteorder("<")) for name, dtype in COLUMNS])
+
+
+def _intern(value: str, values: List[str], codes: Dict[str, int]) -> int:
+    """Looks up the integer code for a value, giving it the next free code if it hasn't been seen before"""
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(values)
+        values.append(value)
+    return code
+
+
+def _to_dataframe(columns: Dict[str, np.ndarray], object_types: List[str], actions: List[str]):
+    """Builds a dataframe with the same columns as a CSVLog file out of numeric columns and code tables"""
+    import pandas as pd
+
+    categories = {"object_type": object_types, "action": actions, "status": list(STATUSES)}
+    return pd.DataFrame({
+        name: (pd.Categorical.from_codes(columns[name], categories[name]) if name in categories else columns[name])
+        for name, _ in COLUMNS
+    }, copy=False)
+
 
 @dataclass(frozen=True)
 class LogRecord:
+    """A single log entry, the object that initiated the event is captured by type name and id
+
+    Records hold no reference to the object itself, so keeping records does not keep passengers alive after their
+    trip, along with everything they refer to.
+    """
     id: int
     time: Union[float, int]
-    obj: object
+    object_type: str
+    object_id: int
     action: str
     status: str
     data: Any = None
 
 
 class Log(ABC):
+
+    # sinks that throw every record away set this to False, so the EventManager can skip building records entirely
+    enabled = True
+
     @abstractmethod
     def write(self, record: LogRecord) -> None:
         pass
 
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        """Called by the EventManager for every event, materializes a LogRecord and writes it
+
+        Sinks that don't need a LogRecord object can override this to store the fields directly.
+        """
+        self.write(LogRecord(id, time, obj.__class__.__name__, getattr(obj, "id", -1), action, status, data))
+
     def close(self) -> None:
         pass
 
 
 class VoidLog(Log):
+    enabled = False
+
     def write(self, record: LogRecord) -> None:
         pass
 
@@ -37,6 +103,131 @@ class InMemoryLog(Log):
         self.log.append(record)
 
 
+class ColumnarLog(Log):
+
+    def __init__(self, capacity: int = 1 << 16):
+        """Stores records in growable numpy arrays, one per column
+
+        Object types, actions and statuses are interned as small integer codes, objects are stored by id and missing
+        data is stored as NaN, so a row costs a few dozen bytes and holds no references to sim objects. Object types
+        and actions that aren't known in advance are given new codes as they show up.
+
+        Args:
+            capacity: the number of rows to allocate up front, doubled every time it runs out
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be strictly positive")
+
+        self._n = 0
+        self._capacity = capacity
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in COLUMNS}
+
+        self.object_types: List[str] = list(OBJECT_TYPES)
+        self.actions: List[str] = list(ACTIONS)
+        self._object_type_codes: Dict[str, int] = {t: i for i, t in enumerate(self.object_types)}
+        self._action_codes: Dict[str, int] = {a: i for i, a in enumerate(self.actions)}
+
+    def __len__(self):
+        return self._n
+
+    def _grow(self) -> None:
+        self._capacity *= 2
+        for name, column in self._columns.items():
+            grown = np.empty(self._capacity, dtype=column.dtype)
+            grown[:self._n] = column[:self._n]
+            self._columns[name] = grown
+
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        self._append(id, time, obj.__class__.__name__, getattr(obj, "id", -1), action, status, data)
+
+    def write(self, record: LogRecord) -> None:
+        self._append(record.id, record.time, record.object_type, record.object_id, record.action, record.status,
+                     record.data)
+
+    def _append(self, id: int, time: Union[float, int], object_type: str, object_id: int, action: str, status: str,
+                data: Any) -> None:
+        i = self._n
+        if i == self._capacity:
+            self._grow()
+        self._set_row(i, id, time, object_type, object_id, action, status, data)
+        self._n = i + 1
+
+    def _set_row(self, i: int, id: int, time: Union[float, int], object_type: str, object_id: int, action: str,
+                 status: str, data: Any) -> None:
+        columns = self._columns
+        columns["event_id"][i] = id
+        columns["time"][i] = time
+        columns["object_type"][i] = _intern(object_type, self.object_types, self._object_type_codes)
+        columns["object_id"][i] = object_id
+        columns["action"][i] = _intern(action, self.actions, self._action_codes)
+        columns["status"][i] = STATUS_CODES[status]
+        columns["data"][i] = np.nan if data is None else data
+
+    def column(self, name: str) -> np.ndarray:
+        """A read-only view of the filled part of a column, codes are returned for interned columns"""
+        view = self._columns[name][:self._n]
+        view.flags.writeable = False
+        return view
+
+    def to_dataframe(self):
+        """Returns the log as a pandas dataframe with the same columns as a CSVLog file
+
+        Numeric columns are views of the underlying arrays and interned columns are categoricals built on top of the
+        stored codes, so the frame can be passed straight to `analysis.preprocessing.preprocess`.
+        """
+        return _to_dataframe({name: self.column(name) for name, _ in COLUMNS}, self.object_types, self.actions)
+
+
+class RingLog(ColumnarLog):
+
+    def __init__(self, capacity: int = 1 << 16, window: Optional[float] = None):
+        """Keeps only the latest `capacity` records, in fixed memory, for looking at the recent history of long runs
+
+        Records are stored in the same numpy columns as a ColumnarLog, allocated once and overwritten oldest first
+        once they are full, so memory stays flat however long the sim runs. Size the capacity to cover the stretch of
+        sim time you want to look at, `n_dropped` counts the records that were overwritten.
+
+        Args:
+            capacity: the number of records to keep
+            window: if given, `to_dataframe` only returns the records from the last `window` sim minutes before the
+                latest record
+        """
+        super().__init__(capacity)
+        if window is not None and window <= 0:
+            raise ValueError("window must be strictly positive")
+        self.window = window
+        # where the next record goes, the oldest record once the buffer is full
+        self._next = 0
+        self.n_dropped = 0
+
+    def _append(self, id: int, time: Union[float, int], object_type: str, object_id: int, action: str, status: str,
+                data: Any) -> None:
+        i = self._next
+        self._set_row(i, id, time, object_type, object_id, action, status, data)
+        self._next = i + 1 if i + 1 < self._capacity else 0
+        if self._n < self._capacity:
+            self._n += 1
+        else:
+            self.n_dropped += 1
+
+    def column(self, name: str) -> np.ndarray:
+        """A read-only copy of a column, oldest record first, codes are returned for interned columns"""
+        column = self._columns[name]
+        if self._n < self._capacity:
+            ordered = column[:self._n].copy()
+        else:
+            ordered = np.concatenate([column[self._next:], column[:self._next]])
+        ordered.flags.writeable = False
+        return ordered
+
+    def to_dataframe(self):
+        """Returns the records kept as a pandas dataframe with the same columns as a CSVLog file, oldest first"""
+        df = super().to_dataframe()
+        if self.window is not None and len(df):
+            df = df[df["time"] >= df["time"].max() - self.window].reset_index(drop=True)
+        return df
+
+
 class CSVLog(Log):
     def __init__(self, path="", msg="", buffer_size=10000):
         self.buffer_size = buffer_size
@@ -52,7 +243,7 @@ class CSVLog(Log):
     def write_to_file(self):
         with open(self.f_name, "a") as f:
             f.write("\n".join([
-                f"{r.id},{r.time},{r.obj.__class__.__name__},{r.obj.id},{r.action},{r.status},{r.data}"
+                f"{r.id},{r.time},{r.object_type},{r.object_id},{r.action},{r.status},{r.data}"
                 for r in self.log
             ]) + "\n")
         self.log = []
@@ -66,6 +257,139 @@ class CSVLog(Log):
         self.write_to_file()
 
 
+class BinaryLog(Log):
+
+    def __init__(self, path="", msg="", batch_size=1 << 16, max_pending=8):
+        """Writes records to a binary file of fixed-width records on a background thread
+
+        The sim thread only interns codes and appends a tuple per record. Full batches are handed to a writer thread
+        through a bounded queue, and the writer packs them into `RECORD_DTYPE` records and appends them to a file it
+        keeps open. If the writer falls `max_pending` batches behind, the sim blocks until it catches up.
+
+        Object types and actions are stored as codes, the table of codes is saved next to the log as
+        `<f_name>.json` when the log is closed. Use `read_binary_log` to load a finished log.
+
+        Args:
+            path: the directory to write the log to
+            msg: included in the file name
+            batch_size: the number of records handed to the writer thread at a time
+            max_pending: the number of batches that may wait for the writer thread before the sim blocks
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be strictly positive")
+
+        self.batch_size = batch_size
+        self.batch = []
+
+        self.object_types: List[str] = list(OBJECT_TYPES)
+        self.actions: List[str] = list(ACTIONS)
+        self._object_type_codes: Dict[str, int] = {t: i for i, t in enumerate(self.object_types)}
+        self._action_codes: Dict[str, int] = {a: i for i, a in enumerate(self.actions)}
+
+        self.f_name = f"log_{msg}_{str(datetime.datetime.now())}.bin"
+        if path:
+            self.f_name = os.path.join(path, self.f_name)
+
+        self._queue = Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._closed = False
+        self._writer = Thread(target=self._write_batches, args=(open(self.f_name, "wb"),), daemon=True)
+        self._writer.start()
+
+    def _write_batches(self, f) -> None:
+        """Body of the writer thread, encodes and writes batches until it receives None"""
+        with f:
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    return
+                if self._error is None:
+                    try:
+                        f.write(np.array(batch, dtype=RECORD_DTYPE).tobytes())
+                    except BaseException as e:
+                        self._error = e
+
+    def _flush(self) -> None:
+        if self._error is not None:
+            raise RuntimeError(f"background writer for {self.f_name} failed") from self._error
+        if self.batch:
+            self._queue.put(self.batch)
+            self.batch = []
+
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        self._append(id, time, obj.__class__.__name__, getattr(obj, "id", -1), action, status, data)
+
+    def write(self, record: LogRecord) -> None:
+        self._append(record.id, record.time, record.object_type, record.object_id, record.action, record.status,
+                     record.data)
+
+    def _append(self, id: int, time: Union[float, int], object_type: str, object_id: int, action: str, status: str,
+                data: Any) -> None:
+        self.batch.append((
+            id,
+            time,
+            _intern(object_type, self.object_types, self._object_type_codes),
+            object_id,
+            _intern(action, self.actions, self._action_codes),
+            STATUS_CODES[status],
+            np.nan if data is None else data,
+        ))
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._closed = True
+
+        with open(self.f_name + ".json", "w") as f:
+            json.dump({"object_types": self.object_types, "actions": self.actions}, f)
+
+        if self._error is not None:
+            raise RuntimeError(f"background writer for {self.f_name} failed") from self._error
+
+
+def read_binary_log(f_name: str):
+    """Loads a closed BinaryLog file as a pandas dataframe with the same columns as a CSVLog file
+
+    Args:
+        f_name: the path of the log file
+    """
+    with open(f_name + ".json") as f:
+        codes = json.load(f)
+    records = np.fromfile(f_name, dtype=RECORD_DTYPE)
+    return _to_dataframe({name: records[name] for name, _ in COLUMNS}, codes["object_types"], codes["actions"])
+
+
+def export_csv(f_name: str, csv_name: Optional[str] = None, chunk_size: int = 1 << 20) -> str:
+    """Converts a closed BinaryLog file to the CSVLog format, missing data is written as an empty field
+
+    Args:
+        f_name: the path of the binary log file
+        csv_name: where to write the csv, defaults to the log path with a .csv extension
+        chunk_size: the number of records converted at a time
+    """
+    if csv_name is None:
+        csv_name = os.path.splitext(f_name)[0] + ".csv"
+
+    with open(f_name + ".json") as f:
+        codes = json.load(f)
+    records = np.memmap(f_name, dtype=RECORD_DTYPE, mode="r") if os.path.getsize(f_name) else np.empty(0, RECORD_DTYPE)
+
+    with open(csv_name, "w") as f:
+        f.write(",".join(name for name, _ in COLUMNS) + "\n")
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            df = _to_dataframe({name: np.asarray(chunk[name]) for name, _ in COLUMNS},
+                               codes["object_types"], codes["actions"])
+            df.to_csv(f, header=False, index=False, na_rep="")
+
+    return csv_name
+
+
 class LogFilter(Log):
     def __init__(self, base_log: Log, keep: Callable[[LogRecord], bool]):
         self.keep = keep
@@ -77,3 +401,24 @@ class LogFilter(Log):
     
     def close(self) -> None:
         return self.base_log.close()
+
+
+class TeeLog(Log):
+    def __init__(self, *logs: Log):
+        """Sends every record to each of `logs`, e.g. to keep the full log of a run and compute its KPIs at once"""
+        self.logs = logs
+        self.enabled = any(log.enabled for log in logs)
+
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        for log in self.logs:
+            if log.enabled:
+                log.record(id, time, obj, action, status, data)
+
+    def write(self, record: LogRecord) -> None:
+        for log in self.logs:
+            if log.enabled:
+                log.write(record)
+
+    def close(self) -> None:
+        for log in self.logs:
+            log.close()
@@ -0,0 +1,80 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from src.stop import ARRIVAL_RATES, HOURS
+
+
+class Network:
+
+    def __init__(self, routes: Sequence[Sequence[int]], demand: Optional[np.ndarray] = None) -> None:
+        """Bus routes over a shared set of stops, and the passenger demand at each stop
+
+        Stops are numbered from 0. A stop can be on any number of routes, passengers waiting there board whichever bus
+        comes first. Stops that are on no route still get passengers, who all walk away.
+
+        Args:
+            routes: the stops each route visits in order, buses loop back to the first stop after the last
+            demand: passenger arrivals per minute at each stop for each hour of the day, an array of shape
+                (n_stops, 24). Every stop follows ARRIVAL_RATES if not given, with as many stops as the routes use
+        """
+        self.routes: List[List[int]] = [[int(stop) for stop in route] for route in routes]
+        if not self.routes or not all(self.routes):
+            raise ValueError("a network needs at least one route, and every route at least one stop")
+        if min(min(route) for route in self.routes) < 0:
+            raise ValueError("stops are numbered from 0")
+
+        if demand is None:
+            n_stops = max(max(route) for route in self.routes) + 1
+            demand = np.tile(ARRIVAL_RATES, (n_stops, 1))
+        self.demand = np.asarray(demand, dtype=np.float64)
+
+        if self.demand.ndim != 2 or self.demand.shape[1] != HOURS:
+            raise ValueError(f"demand must have shape (n_stops, {HOURS})")
+        if (self.demand < 0).any():
+            raise ValueError("demand must be nonnegative")
+        if max(max(route) for route in self.routes) >= self.n_stops:
+            raise ValueError("routes visit stops that have no demand")
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.demand)
+
+    @staticmethod
+    def loop(n_stops: int) -> "Network":
+        """A single circular route through `n_stops` stops with the default demand, the network Sim uses by default"""
+        if n_stops <= 0:
+            raise ValueError("n_stops must be strictly positive")
+        return Network([range(n_stops)])
+
+    @staticmethod
+    def random(n_stops: int, n_routes: int, route_length: int, seed: Optional[int] = None) -> "Network":
+        """A network of routes through randomly chosen stops, for testing how the sim scales
+
+        Each route visits `route_length` distinct stops, so routes share stops where they happen to overlap. Each stop
+        gets the default demand profile scaled by an exponential weight with mean 1.
+        """
+        if not 0 < route_length <= n_stops:
+            raise ValueError("route_length must be between 1 and n_stops")
+        if n_routes <= 0:
+            raise ValueError("n_routes must be strictly positive")
+
+        rng = np.random.default_rng(seed)
+        routes = [rng.choice(n_stops, route_length, replace=False) for _ in range(n_routes)]
+        demand = rng.standard_exponential((n_stops, 1)) * np.array(ARRIVAL_RATES)
+        return Network(routes, demand)
+
+    def save(self, f_name: str) -> None:
+        """Writes the network to an .npz file, which `load` reads back"""
+        offsets = np.cumsum([0] + [len(route) for route in self.routes])
+        np.savez(f_name, demand=self.demand, stops=np.concatenate(self.routes), offsets=offsets)
+
+    @staticmethod
+    def load(f_name: str) -> "Network":
+        """Reads a network from an .npz file with the arrays `demand`, of shape (n_stops, 24), `stops`, every route's
+        stops one after the other, and `offsets`, where each route starts in `stops` followed by where the last ends
+        """
+        with np.load(f_name) as arrays:
+            stops, offsets = arrays["stops"], arrays["offsets"]
+            routes = [stops[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            return Network(routes, arrays["demand"])
@@ -1,31 +1,46 @@
-from random import randint
-from scipy import stats
-from typing import Callable, Any
+from typing import Callable, Any, Optional
+
+import numpy as np
 
 from src.event_manager import EventManager
 from src.actions import PASSENGER_JOIN_QUEUE, PASSENGER_ABANDON_QUEUE, PASSENGER_EMBARK, PASSENGER_DISEMBARK
 
 
 class Passenger:
+
+    # simulation parameters
+    PATIENCE = 10               # minutes a passenger waits before walking
+    EMBARK_TIME = 0.05          # mean embark time per passenger already on the bus
+    DISEMBARK_TIME = 0.03       # mean disembark time per passenger on the bus
+    SERVICE_TIME_STD = 0.01     # standard deviation of embark/disembark times per sqrt(passengers on the bus)
+
     num_ps = 0
 
-    def __init__(self, event_manager: EventManager, stop) -> None:
+    def __init__(self, event_manager: EventManager, stop, arrival_time: Optional[float] = None,
+                 id: Optional[int] = None, stops_traveling: Optional[int] = None) -> None:
         """Represents a passenger in the simulation
 
         Args:
             event_manager: an instance of the event manager class
             stop: an instance of the stop class, the stop where the passenger is instantiated
+            arrival_time: when the passenger arrived at the stop, if it was before now
+            id: an id reserved earlier with `reserve_ids`, for passengers who were tracked before they were created
+            stops_traveling: how many stops the passenger rides, drawn at random if not given
         """
         self.event_manager = event_manager
         self.stop = stop
+        self._rng = event_manager.random.passenger
 
         # assigns a process-unique id to each Passenger
-        self.id = Passenger.num_ps
-        Passenger.num_ps += 1
+        if id is None:
+            id = Passenger.reserve_ids(1)
+        self.id = id
 
         self.has_embarked = False
-        self.initialization_time = event_manager.time
-        self.stops_traveling = randint(1, 7)
+        self.initialization_time = event_manager.time if arrival_time is None else arrival_time
+        self.stops_traveling = self._rng.randint(1, 7) if stops_traveling is None else stops_traveling
+        # how many stops the passenger still has to ride when they board, the bus files them under the stop they get
+        # off at and nothing counts this down, see Bus.add_passenger
         self.stops_remaining = self.stops_traveling
 
         self.join_queue()
@@ -37,18 +52,29 @@ class Passenger:
         return self.id
 
     def join_queue(self) -> None:
-        """Dispatches a JOIN_QUEUE action and prepares to leave if nnot picked up in 10 minutes"""
-
-        # passenger will wait this many minutes before walking
-        patience = 10
+        """Dispatches a JOIN_QUEUE action and prepares to leave if nnot picked up in 10 minutes
 
-        def cb():
-            if not self.has_embarked:
-                self.stop.remove_passenger(self)
-                self.event_manager.dispatch(self, PASSENGER_ABANDON_QUEUE, 0)
-        self.event_manager.dispatch(self, PASSENGER_JOIN_QUEUE, patience, cb)
-
-    def disembark(self, n_passengers: int, callback: Callable[[], None]) -> None:
+        Passengers who arrived in the past and have already run out of patience are recorded as having joined and
+        abandoned the queue, without dispatching anything.
+        """
+        if self.deadline < self.event_manager.time:
+            self._patience_event = None
+            Passenger.log_abandoned(self, self.event_manager, self.stop, self.initialization_time)
+            return
+
+        # the stop is recorded so that logs can follow the queue at each stop
+        self._patience_event = self.event_manager.dispatch(
+            self, PASSENGER_JOIN_QUEUE, Passenger.PATIENCE, self._lose_patience, self.stop.id,
+            start_time=self.initialization_time
+        )
+
+    def _lose_patience(self) -> None:
+        """Called when the JOIN_QUEUE action finishes, the passenger leaves if they are still waiting"""
+        if not self.has_embarked:
+            self.stop.remove_passenger(self)
+            self.event_manager.dispatch(self, PASSENGER_ABANDON_QUEUE, 0)
+
+    def disembark(self, n_passengers: int, callback: Callable[..., Any], args: tuple = ()) -> None:
         """Calculates duration and fires a disembark event, recording total travel time
         
         The total number of stops the Passenger traveled is recorded as data on the DISPATCHED event and
@@ -57,28 +83,112 @@ class Passenger:
         Args:
             n_passengers: the number of passengers currently on the bus, including this one
             callback: called when the passenger is done disembarking (return value is ignored)
+            args: positional arguments for the callback
         """
         if n_passengers <= 0:
             raise ValueError("n_passengers must be positive")
-        
-        def cb():
-            callback()
-            return total_transit_time
 
-        execution_time = max(0, stats.norm.rvs(scale=0.01*(n_passengers**0.5), loc=0.03*n_passengers))
+        execution_time = max(0, self._rng.normal(
+            scale=Passenger.SERVICE_TIME_STD*(n_passengers**0.5),
+            loc=Passenger.DISEMBARK_TIME*n_passengers
+        ))
         total_transit_time = (self.event_manager.time + execution_time) - self.initialization_time
-        self.event_manager.dispatch(self, PASSENGER_DISEMBARK, execution_time, cb, self.stops_traveling)
+        self.event_manager.dispatch(self, PASSENGER_DISEMBARK, execution_time, self._disembarked,
+                                    self.stops_traveling, (total_transit_time, callback, args))
+
+    @staticmethod
+    def _disembarked(total_transit_time: float, callback: Callable[..., Any], args: tuple) -> float:
+        """Called when the DISEMBARK action finishes, returns the transit time so it gets logged"""
+        callback(*args)
+        return total_transit_time
 
-    def embark(self, n_passengers: int, callback: Callable) -> None:
+    def embark(self, n_passengers: int, callback: Callable[..., Any], args: tuple = ()) -> None:
         """Calculates duration and fires a disembark event, recording total travel time
 
         Args:
             n_passengers: the number of passengers currently on the bus, including this one
             callback: called when the passenger is done disembarking
+            args: positional arguments for the callback
         """
         if n_passengers < 0:
             raise ValueError("n_passengers must be nonnegative")
 
         self.has_embarked = True
-        execution_time = max(0, stats.norm.rvs(scale=0.01*(n_passengers**0.5), loc=0.05*n_passengers))
-        self.event_manager.dispatch(self, PASSENGER_EMBARK, execution_time, callback)
+
+        # the passenger won't be leaving the queue anymore
+        self.event_manager.cancel(self._patience_event)
+
+        execution_time = max(0, self._rng.normal(
+            scale=Passenger.SERVICE_TIME_STD*(n_passengers**0.5),
+            loc=Passenger.EMBARK_TIME*n_passengers
+        ))
+        self.event_manager.dispatch(self, PASSENGER_EMBARK, execution_time, callback, args=args)
+
+    @staticmethod
+    def reserve_ids(n: int) -> int:
+        """Reserves `n` consecutive passenger ids and returns the first one"""
+        start = Passenger.num_ps
+        Passenger.num_ps += n
+        return start
+
+    @staticmethod
+    def unmaterialized(id: int) -> "Passenger":
+        """A bare passenger that only carries an id, for logging passengers that were never created"""
+        passenger = Passenger.__new__(Passenger)
+        passenger.id = id
+        return passenger
+
+    @staticmethod
+    def log_abandoned(passenger, event_manager: EventManager, stop, arrival_time: float) -> None:
+        """Records a passenger who joined the queue and gave up waiting before anyone noticed them
+
+        The passenger is logged as joining the queue at `arrival_time` and abandoning it once their patience ran out,
+        without dispatching anything.
+
+        Args:
+            passenger: the passenger to log, see `unmaterialized` for passengers that were never created
+            event_manager: an instance of the event manager class
+            stop: the stop where the passenger waited
+            arrival_time: when the passenger joined the queue
+        """
+        deadline = arrival_time + Passenger.PATIENCE
+        event_manager.log_event(passenger, PASSENGER_JOIN_QUEUE, arrival_time, deadline, stop.id)
+        event_manager.log_event(passenger, PASSENGER_ABANDON_QUEUE, deadline, deadline)
+
+    @property
+    def deadline(self) -> float:
+        """The time at which the passenger gives up waiting"""
+        return self.initialization_time + Passenger.PATIENCE
+
+    def board(self, start_time: float, finish_time: float) -> None:
+        """Records an embark that the bus simulated in bulk, without dispatching an event
+
+        Args:
+            start_time: when the passenger started embarking
+            finish_time: when the passenger was seated
+        """
+        self.has_embarked = True
+        self.event_manager.cancel(self._patience_event, start_time)
+        self.event_manager.log_event(self, PASSENGER_EMBARK, start_time, finish_time)
+
+    def alight(self, start_time: float, finish_time: float) -> None:
+        """Records a disembark that the bus simulated in bulk, without dispatching an event
+
+        Like `disembark`, the stops traveled and the total transit time are recorded on the event.
+
+        Args:
+            start_time: when the passenger started disembarking
+            finish_time: when the passenger was off the bus
+        """
+        self.event_manager.log_event(self, PASSENGER_DISEMBARK, start_time, finish_time, self.stops_traveling,
+                                     finish_time - self.initialization_time)
+
+    @staticmethod
+    def embark_durations(n_passengers: np.ndarray, z: np.ndarray) -> np.ndarray:
+        """Vectorized embark times, for buses with `n_passengers` on board and standard normal draws `z`"""
+        return np.maximum(0, Passenger.EMBARK_TIME*n_passengers + Passenger.SERVICE_TIME_STD*np.sqrt(n_passengers)*z)
+
+    @staticmethod
+    def disembark_durations(n_passengers: np.ndarray, z: np.ndarray) -> np.ndarray:
+        """Vectorized disembark times, for buses with `n_passengers` on board and standard normal draws `z`"""
+        return np.maximum(0, Passenger.DISEMBARK_TIME*n_passengers + Passenger.SERVICE_TIME_STD*np.sqrt(n_passengers)*z)
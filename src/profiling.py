@@ -0,0 +1,148 @@
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Union
+import json
+
+from src.log import Log, LogRecord
+
+# callback times are bucketed by powers of two microseconds, bucket k holds times in [2^(k-1), 2^k) us and the last
+# bucket holds everything slower
+N_HISTOGRAM_BUCKETS = 24
+
+
+def histogram_bucket(seconds: float) -> int:
+    return min(int(seconds * 1e6).bit_length(), N_HISTOGRAM_BUCKETS - 1)
+
+
+class ActionStats:
+    """Counters for a single action"""
+    __slots__ = ("dispatched", "finished", "cancelled", "executed", "callback_time", "histogram")
+
+    def __init__(self) -> None:
+        # finished counts every FINISHED record, including events simulated in bulk, executed only counts events that
+        # went through the queue
+        self.dispatched = 0
+        self.finished = 0
+        self.cancelled = 0
+        self.executed = 0
+        self.callback_time = 0.0
+        self.histogram = [0] * N_HISTOGRAM_BUCKETS
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "dispatched": self.dispatched,
+            "finished": self.finished,
+            "cancelled": self.cancelled,
+            "executed": self.executed,
+            "callback_time": self.callback_time,
+            "mean_callback_time": self.callback_time / self.executed if self.executed else float("nan"),
+            "histogram": list(self.histogram),
+        }
+
+
+class Profiler:
+
+    def __init__(self) -> None:
+        """Collects counters and timings for an EventManager, see EventManager.profile
+
+        For each action: how many events were dispatched, finished and cancelled, and the wall time spent in their
+        callbacks, in total and as a histogram. Callback times leave out time spent writing to the log, which is
+        counted separately along with the number of records written. For the run as a whole: the number of events,
+        the wall time, the peak heap size, and the time left over for the scheduler itself.
+        """
+        self.actions: Dict[str, ActionStats] = {}
+        self.n_events = 0
+        self.wall_time = 0.0
+        self.peak_heap = 0
+        self.log_time = 0.0
+        self.n_records = 0
+
+    def action(self, action: str) -> ActionStats:
+        stats = self.actions.get(action)
+        if stats is None:
+            stats = self.actions[action] = ActionStats()
+        return stats
+
+    @property
+    def callback_time(self) -> float:
+        return sum(stats.callback_time for stats in self.actions.values())
+
+    @property
+    def scheduler_time(self) -> float:
+        """Wall time not spent in callbacks or writing to the log: heap operations and the event loop itself"""
+        return self.wall_time - self.callback_time - self.log_time
+
+    @property
+    def events_per_second(self) -> float:
+        return self.n_events / self.wall_time if self.wall_time else float("nan")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "n_events": self.n_events,
+            "wall_time": self.wall_time,
+            "events_per_second": self.events_per_second,
+            "peak_heap": self.peak_heap,
+            "callback_time": self.callback_time,
+            "log_time": self.log_time,
+            "n_records": self.n_records,
+            "scheduler_time": self.scheduler_time,
+            "histogram_buckets_us": [0] + [2**k for k in range(N_HISTOGRAM_BUCKETS - 1)],
+            "actions": {action: stats.to_dict() for action, stats in sorted(self.actions.items())},
+        }
+
+    def to_json(self, f_name: Optional[str] = None) -> str:
+        """Returns the results as json, and writes them to `f_name` if given"""
+        text = json.dumps(self.to_dict(), indent=2)
+        if f_name is not None:
+            with open(f_name, "w") as f:
+                f.write(text)
+        return text
+
+    def to_dataframe(self):
+        """The per-action results as a table, one row per action, sorted by total callback time"""
+        import pandas as pd
+
+        rows: List[Dict[str, Any]] = [
+            {"action": action, **{k: v for k, v in stats.to_dict().items() if k != "histogram"}}
+            for action, stats in self.actions.items()
+        ]
+        columns = ["action", "dispatched", "finished", "cancelled", "executed", "callback_time", "mean_callback_time"]
+        return pd.DataFrame(rows, columns=columns).sort_values("callback_time", ascending=False, ignore_index=True)
+
+
+class ProfiledLog(Log):
+    # always enabled, so that events are counted even when the base log throws everything away
+    enabled = True
+
+    def __init__(self, base_log: Log, profiler: Profiler):
+        """Counts records by action and status for a Profiler, and times the records passed on to `base_log`"""
+        self.base_log = base_log
+        self.profiler = profiler
+        self._forward = base_log.enabled
+
+    def _count(self, action: str, status: str) -> None:
+        stats = self.profiler.action(action)
+        if status == "DISPATCHED":
+            stats.dispatched += 1
+        elif status == "FINISHED":
+            stats.finished += 1
+        else:
+            stats.cancelled += 1
+
+    def record(self, id: int, time: Union[float, int], obj: object, action: str, status: str, data: Any = None) -> None:
+        self._count(action, status)
+        if self._forward:
+            start = perf_counter()
+            self.base_log.record(id, time, obj, action, status, data)
+            self.profiler.log_time += perf_counter() - start
+            self.profiler.n_records += 1
+
+    def write(self, record: LogRecord) -> None:
+        self._count(record.action, record.status)
+        if self._forward:
+            start = perf_counter()
+            self.base_log.write(record)
+            self.profiler.log_time += perf_counter() - start
+            self.profiler.n_records += 1
+
+    def close(self) -> None:
+        return self.base_log.close()
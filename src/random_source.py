@@ -0,0 +1,124 @@
+from typing import Optional, List
+
+import numpy as np
+
+# how many variates to draw from numpy at once when a buffer runs dry
+BLOCK_SIZE = 4096
+
+# each entity type gets its own independent stream, so changing how one kind of entity consumes random numbers does
+# not shift the draws seen by the others
+STREAMS = ("bus", "passenger", "stop")
+
+
+class RandomStream:
+
+    def __init__(self, generator: np.random.Generator, block_size: int = BLOCK_SIZE) -> None:
+        """Buffered supply of random variates for a single entity type
+
+        Standard variates are drawn from numpy in blocks of `block_size` and handed out one at a time, then shifted
+        and scaled to the requested distribution. This is much cheaper than a call into scipy.stats per variate.
+
+        Args:
+            generator: the numpy generator backing this stream
+            block_size: the number of variates to draw from numpy at a time
+        """
+        if block_size <= 0:
+            raise ValueError("block_size must be strictly positive")
+
+        self.generator = generator
+        self.block_size = block_size
+
+        # buffers are stored as python lists because indexing them yields python floats, which are much faster to do
+        # arithmetic with than numpy scalars
+        self._normals: List[float] = []
+        self._normal_i = 0
+        self._exponentials: List[float] = []
+        self._exponential_i = 0
+        self._uniforms: List[float] = []
+        self._uniform_i = 0
+
+    def reset(self, generator: np.random.Generator) -> None:
+        """Switches the stream over to a new generator, dropping any variates buffered from the old one"""
+        self.generator = generator
+        self._normals, self._exponentials, self._uniforms = [], [], []
+        self._normal_i = self._exponential_i = self._uniform_i = 0
+
+    def normal(self, loc: float = 0.0, scale: float = 1.0) -> float:
+        """Draw from a normal distribution with mean `loc` and standard deviation `scale`"""
+        if self._normal_i >= len(self._normals):
+            self._normals = self.generator.standard_normal(self.block_size).tolist()
+            self._normal_i = 0
+        z = self._normals[self._normal_i]
+        self._normal_i += 1
+        return loc + scale*z
+
+    def normals(self, size: int) -> np.ndarray:
+        """Draw an array of standard normal variates, straight from numpy without going through the buffer"""
+        return self.generator.standard_normal(size)
+
+    def exponential(self, scale: float = 1.0) -> float:
+        """Draw from an exponential distribution with mean `scale`"""
+        if self._exponential_i >= len(self._exponentials):
+            self._exponentials = self.generator.standard_exponential(self.block_size).tolist()
+            self._exponential_i = 0
+        e = self._exponentials[self._exponential_i]
+        self._exponential_i += 1
+        return scale*e
+
+    def poisson(self, lam: float) -> int:
+        """Draw from a poisson distribution with mean `lam`, straight from numpy"""
+        return int(self.generator.poisson(lam))
+
+    def uniforms(self, low: float, high: float, size: int) -> np.ndarray:
+        """Draw an array of variates uniform on [low, high), straight from numpy without going through the buffer"""
+        return self.generator.uniform(low, high, size)
+
+    def randint(self, low: int, high: int) -> int:
+        """Draw an integer uniformly from the range [low, high], including both end points"""
+        if high < low:
+            raise ValueError("high must be at least low")
+        if self._uniform_i >= len(self._uniforms):
+            self._uniforms = self.generator.random(self.block_size).tolist()
+            self._uniform_i = 0
+        u = self._uniforms[self._uniform_i]
+        self._uniform_i += 1
+        return low + int(u * (high - low + 1))
+
+    def randints(self, low: int, high: int, size: int) -> np.ndarray:
+        """Draw an array of integers uniformly from the range [low, high], straight from numpy"""
+        if high < low:
+            raise ValueError("high must be at least low")
+        return self.generator.integers(low, high, size, endpoint=True)
+
+
+class RandomSource:
+
+    def __init__(self, seed: Optional[int] = None, block_size: int = BLOCK_SIZE) -> None:
+        """Owns one independent RandomStream per entity type
+
+        All the streams are spawned from a single numpy SeedSequence, so a simulation run with the same seed draws
+        exactly the same numbers. If no seed is given, fresh entropy is pulled from the OS.
+
+        Args:
+            seed: the root seed for all the streams
+            block_size: the number of variates each stream draws from numpy at a time
+        """
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy
+
+        children = self.seed_sequence.spawn(len(STREAMS))
+        self.bus, self.passenger, self.stop = [
+            RandomStream(np.random.default_rng(child), block_size) for child in children
+        ]
+
+    def reseed(self, seed: Optional[int] = None) -> None:
+        """Backs every stream with a fresh generator spawned from `seed`
+
+        The stream objects themselves are kept, so everything in a sim that holds on to a stream draws from the new
+        generators. This is how forks of a snapshot get independent random numbers.
+        """
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.seed = self.seed_sequence.entropy
+
+        for name, child in zip(STREAMS, self.seed_sequence.spawn(len(STREAMS))):
+            getattr(self, name).reset(np.random.default_rng(child))
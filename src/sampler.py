@@ -0,0 +1,127 @@
+from math import ceil
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from src.event_manager import EventManager
+from src.stop import Stop, QUEUE_LEN_REPORT_FREQUENCY
+from src.actions import SAMPLE_QUEUE_LENGTHS
+
+# "global" samples every stop with a single QueueSampler event per tick, "stop" has each stop dispatch its own
+# STOP_REPORT_QUEUE_LENGTH events, "none" doesn't sample queue lengths at all
+QUEUE_SAMPLING_MODES = ("global", "stop", "none")
+
+
+class QueueSampler:
+
+    def __init__(self, event_manager: EventManager, stops: Sequence[Stop],
+                 interval: float = QUEUE_LEN_REPORT_FREQUENCY, integrals: bool = False,
+                 capacity: Optional[int] = None) -> None:
+        """Samples the queue length at every stop with one event per tick, into a stops × samples matrix
+
+        Each tick looks at every stop's queue, bringing stops in batch, lazy and sparse mode up to date, writes the
+        lengths into the next column of `samples`, and dispatches one SAMPLE_QUEUE_LENGTHS event for the next tick
+        with the total number of people waiting as its data. The matrix is preallocated and doubles when it fills up.
+
+        With `integrals`, every stop also tracks the exact area under its queue length, updated on each join, board
+        and abandon without any events, see Stop.track_queue_area. The area up to each tick is kept in `areas`, so
+        the exact mean queue length is known over each sampling interval and not just at its ends.
+
+        Args:
+            event_manager: an instance of the event manager class
+            stops: the stops to sample, row i of the matrix is stops[i]
+            interval: the time between samples, in sim minutes
+            integrals: also track the exact time-weighted queue lengths
+            capacity: the number of samples to allocate room for, a day's worth if not given
+        """
+        if interval <= 0:
+            raise ValueError("interval must be strictly positive")
+
+        self.id = 0
+        self.event_manager = event_manager
+        self.stops: List[Stop] = list(stops)
+        self.interval = interval
+        self.integrals = integrals
+
+        if capacity is None:
+            capacity = ceil(24*60 / interval)
+        self._times = np.empty(capacity, dtype=np.float64)
+        self._samples = np.zeros((len(self.stops), capacity), dtype=np.int32)
+        self._areas = np.zeros((len(self.stops), capacity), dtype=np.float64) if integrals else None
+        self.n_samples = 0
+
+    def __repr__(self):
+        return f"<QueueSampler stops={len(self.stops)} samples={self.n_samples}>"
+
+    @property
+    def times(self) -> np.ndarray:
+        """The time of each sample"""
+        return self._times[:self.n_samples]
+
+    @property
+    def samples(self) -> np.ndarray:
+        """The queue length at each stop at each sample, of shape (n_stops, n_samples)"""
+        return self._samples[:, :self.n_samples]
+
+    @property
+    def areas(self) -> Optional[np.ndarray]:
+        """The area under each stop's queue length from the first sample until each sample, if tracking integrals"""
+        return self._areas[:, :self.n_samples] if self._areas is not None else None
+
+    def start(self) -> None:
+        """Takes the first sample now, and from then on one every `interval`"""
+        if self.integrals:
+            for stop in self.stops:
+                stop.track_queue_area()
+        self._sample()
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self._times)
+        self._times = np.resize(self._times, capacity)
+        for name in ("_samples", "_areas"):
+            old = getattr(self, name)
+            if old is not None:
+                new = np.zeros((old.shape[0], capacity), dtype=old.dtype)
+                new[:, :old.shape[1]] = old
+                setattr(self, name, new)
+
+    def _sample(self) -> None:
+        if self.n_samples == len(self._times):
+            self._grow()
+
+        i = self.n_samples
+        self._times[i] = self.event_manager.time
+        self._samples[:, i] = [len(stop.passengers_waiting) for stop in self.stops]
+        if self._areas is not None:
+            self._areas[:, i] = [stop.queue_area.area() for stop in self.stops]
+        self.n_samples += 1
+
+        self.event_manager.dispatch(self, SAMPLE_QUEUE_LENGTHS, self.interval, self._sample,
+                                    int(self._samples[:, i].sum()))
+
+    def interval_means(self) -> np.ndarray:
+        """The exact mean queue length at each stop over each interval between samples, of shape (n_stops, n - 1)"""
+        if self._areas is None:
+            raise ValueError("interval means need a sampler that tracks integrals")
+        return np.diff(self.areas, axis=1) / np.diff(self.times)
+
+    def mean_queue_length(self) -> np.ndarray:
+        """The exact mean queue length at each stop from the first sample until now"""
+        if self._areas is None:
+            raise ValueError("mean queue lengths need a sampler that tracks integrals")
+        if self.n_samples == 0:
+            raise ValueError("no samples have been taken yet")
+
+        start = self._times[0]
+        duration = self.event_manager.time - start
+        for stop in self.stops:
+            stop.sync()
+        areas = np.array([stop.queue_area.area() for stop in self.stops])
+        return (areas - self._areas[:, 0]) / duration if duration > 0 else np.full(len(self.stops), np.nan)
+
+    def to_dataframe(self):
+        """The samples as a table with one row per sample, indexed by time, and one column per stop id"""
+        import pandas as pd
+
+        return pd.DataFrame(self.samples.T, index=pd.Index(self.times, name="time"),
+                            columns=[stop.id for stop in self.stops])
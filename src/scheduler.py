@@ -0,0 +1,194 @@
+from abc import ABC, abstractmethod
+from bisect import insort
+from functools import partial
+from heapq import heappush, heappop, heapify
+from typing import Callable, Iterator, List, Tuple, Any
+
+# a pending event: (finish time, event id, event). Event ids are unique, so entries never compare their events
+Entry = Tuple[float, int, Any]
+
+
+class Scheduler(ABC):
+    """The set of pending events of an EventManager, handing them back in order of finish time and then event id
+
+    Schedulers only have to handle the access pattern of a simulation: nothing is pushed with a time before that of
+    the last entry popped.
+    """
+
+    @abstractmethod
+    def push(self, entry: Entry) -> None:
+        pass
+
+    @abstractmethod
+    def pop(self) -> Entry:
+        """Removes and returns the earliest entry, raises IndexError if there are none"""
+        pass
+
+    @abstractmethod
+    def remove_done(self) -> None:
+        """Drops the entries whose events are done, i.e. were cancelled"""
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[Entry]:
+        """Iterates over the entries in no particular order"""
+        pass
+
+    def bind(self) -> Tuple[Callable[[Entry], None], Callable[[], Entry]]:
+        """The push and pop functions the EventManager binds once and calls for every event
+
+        Schedulers can return something cheaper to call than their bound methods, as long as it behaves the same.
+        """
+        return self.push, self.pop
+
+
+class HeapScheduler(Scheduler):
+
+    def __init__(self) -> None:
+        """A binary heap, O(log n) push and pop. The default, and the fastest until the pending set gets very large
+
+        `bind` hands out heapq bound straight to the list of entries, so an EventManager using the heap through the
+        Scheduler interface pays nothing over using heapq directly.
+        """
+        self.entries: List[Entry] = []
+
+    def push(self, entry: Entry) -> None:
+        heappush(self.entries, entry)
+
+    def pop(self) -> Entry:
+        return heappop(self.entries)
+
+    def bind(self) -> Tuple[Callable[[Entry], None], Callable[[], Entry]]:
+        return partial(heappush, self.entries), partial(heappop, self.entries)
+
+    def remove_done(self) -> None:
+        # modified in place, bound functions hold on to the list
+        self.entries[:] = [entry for entry in self.entries if not entry[2].done]
+        heapify(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Entry]:
+        return iter(self.entries)
+
+
+class CalendarQueue(Scheduler):
+
+    # the number of buckets never drops below this
+    MIN_BUCKETS = 16
+    # the number of entries sampled to pick the bucket width
+    WIDTH_SAMPLE = 64
+
+    def __init__(self, width: float = 1.0, n_buckets: int = MIN_BUCKETS) -> None:
+        """A calendar queue (Brown, 1988), amortized O(1) push and pop when the bucket width suits the event times
+
+        Time is cut into "days" of `width` sim minutes, and entries go to the bucket of their day modulo the number of
+        buckets, kept sorted. Popping scans forward from the current day for the first bucket holding an entry from
+        that day. The number of buckets doubles or halves to stay between half and twice the number of entries, and
+        each time the width is reset to three times the average gap between entries, so a bucket holds a few entries
+        and a scan only looks at a few buckets.
+
+        Brown fits the width to the gaps between the earliest entries. In this model those are often a burst of
+        boarding events a fraction of a second apart, which makes the year so short that every patience timer wraps
+        around it many times and piles up in a few buckets. The gaps are taken over the bulk of all pending entries
+        instead.
+
+        Args:
+            width: the initial width of a day, in sim minutes
+            n_buckets: the initial number of buckets, rounded up to a power of two
+        """
+        if width <= 0:
+            raise ValueError("width must be strictly positive")
+        n = CalendarQueue.MIN_BUCKETS
+        while n < n_buckets:
+            n *= 2
+
+        self.width = width
+        self._buckets: List[List[Entry]] = [[] for _ in range(n)]
+        self._mask = n - 1
+        self._size = 0
+        # the time and day of the last entry popped, no entry is ever earlier than it
+        self._time = 0.0
+        self._day = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Entry]:
+        return (entry for bucket in self._buckets for entry in bucket)
+
+    @property
+    def n_buckets(self) -> int:
+        return self._mask + 1
+
+    def push(self, entry: Entry) -> None:
+        bucket = self._buckets[int(entry[0] / self.width) & self._mask]
+        if not bucket or entry > bucket[-1]:
+            bucket.append(entry)
+        else:
+            insort(bucket, entry)
+
+        self._size += 1
+        if self._size > 2 * (self._mask + 1):
+            self._resize(2 * (self._mask + 1))
+
+    def pop(self) -> Entry:
+        if not self._size:
+            raise IndexError("pop from an empty CalendarQueue")
+
+        buckets, mask, width = self._buckets, self._mask, self.width
+        day = self._day
+        for _ in range(mask + 1):
+            bucket = buckets[day & mask]
+            if bucket and int(bucket[0][0] / width) <= day:
+                self._day = day
+                return self._pop_from(bucket)
+            day += 1
+
+        # nothing in a whole year of days, jump straight to the earliest entry
+        bucket = min((bucket for bucket in buckets if bucket), key=lambda bucket: bucket[0])
+        self._day = int(bucket[0][0] / width)
+        return self._pop_from(bucket)
+
+    def _pop_from(self, bucket: List[Entry]) -> Entry:
+        entry = bucket.pop(0)
+        self._time = entry[0]
+        self._size -= 1
+        if self._size < (self._mask + 1) // 2 and self._mask + 1 > CalendarQueue.MIN_BUCKETS:
+            self._resize((self._mask + 1) // 2)
+        return entry
+
+    def _resize(self, n_buckets: int) -> None:
+        """Spreads the entries over `n_buckets` buckets, with a width fitted to all entries, see `_fit_width`"""
+        entries = [entry for bucket in self._buckets for entry in bucket]
+        self.width = self._fit_width(entries)
+        self._buckets = [[] for _ in range(n_buckets)]
+        self._mask = n_buckets - 1
+        # later entries may still come before the earliest one now, so the scan restarts from the last entry popped
+        self._day = int(self._time / self.width)
+        for entry in entries:
+            self._buckets[int(entry[0] / self.width) & self._mask].append(entry)
+        for bucket in self._buckets:
+            bucket.sort()
+
+    def _fit_width(self, entries: List[Entry]) -> float:
+        """Three times the average gap between entries, estimated from the spread of the middle 80% of a sample"""
+        n = len(entries)
+        times = sorted(entry[0] for entry in entries[::max(1, n // CalendarQueue.WIDTH_SAMPLE)])
+        k = len(times)
+        spread = times[(9 * k) // 10 - 1] - times[k // 10] if k >= 10 else 0
+        width = 3 * spread / (0.8 * n) if spread > 0 else 0
+        return width if width > 0 else self.width
+
+    def remove_done(self) -> None:
+        for bucket in self._buckets:
+            bucket[:] = [entry for entry in bucket if not entry[2].done]
+        self._size = sum(len(bucket) for bucket in self._buckets)
+
+
+SCHEDULERS = {"heap": HeapScheduler, "calendar": CalendarQueue}
@@ -1,47 +1,161 @@
+import pickle
 from typing import Optional
 
-from src.log import InMemoryLog, Log
+from src.log import InMemoryLog, Log, VoidLog
 from src.event_manager import EventManager
-from src.stop import Stop
-from src.bus import Bus
+from src.random_source import RandomSource
+from src.stop import Stop, ARRIVAL_MODES
+from src.bus import Bus, DWELL_MODES
+from src.passenger import Passenger
+from src.network import Network
+from src.sampler import QueueSampler, QUEUE_SAMPLING_MODES
+from src.scheduler import SCHEDULERS
+
+# the class attributes that hand out process-unique ids, saved with snapshots so that restored sims don't reuse them
+ID_COUNTERS = ((Passenger, "num_ps"), (Bus, "_bus_num"), (Stop, "_stop_num"))
 
 
 class Sim:
 
     n_stops = 15
 
-    def __init__(self, n_buses: int, log: Optional[Log] = None):
+    def __init__(self, n_buses: int, log: Optional[Log] = None, seed: Optional[int] = None,
+                 dwell_mode: str = "passenger", arrival_mode: str = "event", profile: bool = False,
+                 network: Optional[Network] = None, queue_sampling: str = "global", queue_integrals: bool = False,
+                 scheduler: str = "heap"):
+        """The bus routes, their stops and buses, wired to an event manager
+
+        Args:
+            n_buses: the number of buses on the route
+            log: where to log events, an InMemoryLog if not provided
+            seed: the root seed for the random streams, fresh entropy if not provided
+            dwell_mode: how buses load passengers, one of DWELL_MODES
+            arrival_mode: how passengers arrive at stops, one of ARRIVAL_MODES
+            profile: collect counters and timings per action into `self.profiler`, see EventManager.profile
+            network: the routes and the demand at each stop, a single loop of `Sim.n_stops` stops if not provided.
+                Buses are dealt out to the routes in turn
+            queue_sampling: how queue lengths are sampled, one of QUEUE_SAMPLING_MODES. With "global", the samples
+                end up in `self.sampler`
+            queue_integrals: also track the exact time-weighted queue length at every stop, needs global sampling
+            scheduler: the data structure holding upcoming events, one of SCHEDULERS. A calendar queue only pays off
+                with very many pending events, see benchmarks/bench_scheduler.py
+        """
 
         if n_buses <= 0:
             raise ValueError("n_buses must be strictly positive")
         self.n_buses = n_buses
 
-        self.log = log if log else InMemoryLog()
-        self.event_manager = EventManager(self.log)
+        if dwell_mode not in DWELL_MODES:
+            raise ValueError(f"dwell_mode must be one of {DWELL_MODES}")
+        self.dwell_mode = dwell_mode
+
+        if arrival_mode not in ARRIVAL_MODES:
+            raise ValueError(f"arrival_mode must be one of {ARRIVAL_MODES}")
+        self.arrival_mode = arrival_mode
+        self.network = network if network is not None else Network.loop(Sim.n_stops)
+
+        if queue_sampling not in QUEUE_SAMPLING_MODES:
+            raise ValueError(f"queue_sampling must be one of {QUEUE_SAMPLING_MODES}")
+        if queue_integrals and queue_sampling != "global":
+            raise ValueError("queue_integrals needs global queue sampling")
+        self.queue_sampling = queue_sampling
+
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"scheduler must be one of {tuple(SCHEDULERS)}")
+
+        self.log = log if log is not None else InMemoryLog()
+        self.random = RandomSource(seed)
+        self.event_manager = EventManager(self.log, self.random, SCHEDULERS[scheduler]())
+        self.profiler = self.event_manager.profile() if profile else None
         self.route = self.create_route()
         self.buses = self.create_buses()
+        self.sampler = None
+        if queue_sampling == "global":
+            self.sampler = QueueSampler(self.event_manager, self.route, integrals=queue_integrals)
 
         self.start()
 
     def create_route(self):
-        """Creates all the stops and arranges them as a circular linked list"""
-        stops = [Stop(self.event_manager) for _ in range(Sim.n_stops)]
-        for i in range(Sim.n_stops):
-            stops[i-1].next = stops[i]
+        """Creates all the stops, and the list of stops each route visits in `self.routes`
+
+        Each stop's `next` is the stop after it on the first route that visits it, so on a single loop the stops form
+        a circular linked list.
+        """
+        stops = [Stop(self.event_manager, arrival_mode=self.arrival_mode, arrival_rates=rates)
+                 for rates in self.network.demand.tolist()]
+        self.routes = [[stops[i] for i in route] for route in self.network.routes]
+        for route in self.routes:
+            for i in range(len(route)):
+                if route[i-1].next is None:
+                    route[i-1].next = route[i]
         return stops
 
     def create_buses(self):
-        """Creates the buses and assigns them to stops"""
-        return [Bus(self.event_manager, self.route[i % Sim.n_stops]) for i in range(self.n_buses)]
+        """Creates the buses, dealing them out to the routes in turn, and assigns each to a stop on its route"""
+        n_routes = len(self.routes)
+        buses = []
+        for i in range(self.n_buses):
+            route = self.routes[i % n_routes]
+            buses.append(Bus(self.event_manager, route[(i // n_routes) % len(route)], self.dwell_mode, route))
+        return buses
 
     def start(self):
-        """Tells all the buses to start moving"""
+        """Tells all the buses to start moving, and starts passengers arriving and queue lengths being sampled"""
         for bus in self.buses:
             bus.move()
         for stop in self.route:
-            stop.start()
+            stop.start(report=self.queue_sampling == "stop")
+        if self.sampler is not None:
+            self.sampler.start()
 
     def run(self, *args, **kwargs):
-        """Run the event manager and then close the log, forwards arguments to EventManager.run()"""
+        """Run the event manager and then close the log, forwards arguments to EventManager.run()
+
+        In sparse arrival mode every stop is brought up to date first if the log keeps records, so that passengers at
+        stops no bus has been to lately make it into the log.
+        """
         self.event_manager.run(*args, **kwargs)
+        if self.arrival_mode == "sparse" and self.event_manager.logging:
+            for stop in self.route:
+                stop.sync()
         self.log.close()
+
+    def snapshot(self) -> bytes:
+        """Captures the full state of the sim, so that it can be restored or forked later with `restore`
+
+        Everything is pickled except the log: the event queue with its callbacks, the stops, buses and passengers, the
+        state of the random streams and the id counters of each class.
+        """
+        log = self.log
+        self.log = self.event_manager.log = VoidLog()
+        try:
+            counters = {cls.__name__: getattr(cls, name) for cls, name in ID_COUNTERS}
+            return pickle.dumps({"sim": self, "counters": counters}, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            self.log = self.event_manager.log = log
+
+    @staticmethod
+    def restore(snapshot: bytes, log: Optional[Log] = None, seed: Optional[int] = None) -> "Sim":
+        """Recreates a sim from a snapshot, picking up at the time the snapshot was taken
+
+        Without a seed, the restored sim continues exactly like the original would have. With a seed, its random
+        streams are reseeded, so every fork of one snapshot can run an independent replication from the same warm
+        state. Events that were logged before the snapshot are not in the new log, so passengers who were already
+        waiting or riding show up in it without ever joining a queue.
+
+        Args:
+            snapshot: the output of `snapshot`
+            log: a log object, an InMemoryLog if not provided
+            seed: if given, the root seed for new random streams
+        """
+        state = pickle.loads(snapshot)
+        sim: Sim = state["sim"]
+        sim.log = sim.event_manager.log = log if log is not None else InMemoryLog()
+
+        # ids handed out in this process since the snapshot was taken are not reused either
+        for cls, name in ID_COUNTERS:
+            setattr(cls, name, max(getattr(cls, name), state["counters"][cls.__name__]))
+
+        if seed is not None:
+            sim.random.reseed(seed)
+        return sim
@@ -1,23 +1,286 @@
-from scipy import stats
-from collections import deque
-from math import cos, pi, floor
+from bisect import bisect_right
+from collections import deque, OrderedDict
+from typing import Iterator, List, Optional, Sequence, Tuple
+from math import cos, pi, floor, ceil
+
+import numpy as np
 
 from src.event_manager import EventManager
 from src.passenger import Passenger
-from src.actions import STOP_PASSENGER_JOIN, STOP_REPORT_QUEUE_LENGTH
+from src.actions import STOP_PASSENGER_JOIN, STOP_REPORT_QUEUE_LENGTH, STOP_ARRIVAL_WINDOW, PASSENGER_JOIN_QUEUE, \
+    PASSENGER_ABANDON_QUEUE
 
 # how frequently to sample the queue length
 QUEUE_LEN_REPORT_FREQUENCY = 10
 
+# passenger arrivals per minute at each hour of the day, see Stop.expected_arrival_interval
+ARRIVAL_RATES = tuple(1.2 + cos(pi * (hour - 7) / 6) for hour in range(24))
+
+# "event" dispatches one event per arriving passenger, "batch" draws all the arrivals of an ARRIVAL_WINDOW at once
+# and only creates the passengers when somebody looks at the queue, "lazy" draws arrivals like batch but keeps waiting
+# passengers as arrays and only creates the ones who leave the queue on a bus, "sparse" keeps passengers like lazy but
+# dispatches nothing at all, arrivals since the queue was last looked at are drawn when somebody looks at it again
+ARRIVAL_MODES = ("event", "batch", "lazy", "sparse")
+
+# the modes that keep waiting passengers as WaitingArrays
+ARRAY_MODES = ("lazy", "sparse")
+
+# hours in a day, the length of a demand profile
+HOURS = 24
+
+# length of the windows arrivals are drawn for in batch mode, in sim minutes. Windows end on multiples of this, which
+# must divide an hour so that the arrival rate is constant within a window
+ARRIVAL_WINDOW = 60
+
+
+class QueueArea:
+    __slots__ = ("clock", "length", "weighted_time")
+
+    def __init__(self, clock, length: int = 0) -> None:
+        """The exact area under the length of a queue over time, from the changes to it, starting now
+
+        The area up to time T is `length * T` minus the sum of `delta * time` over the changes, which doesn't depend on
+        the order the changes come in. Queues in batch, lazy and sparse mode add passengers after the fact with their
+        real arrival times, and are still counted exactly.
+
+        Args:
+            clock: anything with the current sim time as `time`, e.g. the event manager
+            length: the length of the queue now
+        """
+        self.clock = clock
+        self.length = length
+        self.weighted_time = length * clock.time
+
+    def change(self, time: float, delta: int) -> None:
+        self.weighted_time += delta * time
+        self.length += delta
+
+    def area(self, end: Optional[float] = None) -> float:
+        """The area under the queue length from when tracking started until `end`, now if not given"""
+        if end is None:
+            end = self.clock.time
+        return self.length * end - self.weighted_time
+
+
+class PassengerQueue:
+
+    def __init__(self) -> None:
+        """The line of passengers waiting at a stop
+
+        Mirrors the parts of the deque interface that the sim uses: passengers join with appendleft and the passenger
+        who has waited longest leaves with pop. Passengers are indexed by id in an OrderedDict, so removing a passenger
+        from the middle of the line is O(1) instead of O(n).
+        """
+        self._passengers: OrderedDict = OrderedDict()
+        # tracked once somebody asks for it, see Stop.track_queue_area
+        self.area: Optional[QueueArea] = None
+
+    def __len__(self) -> int:
+        return len(self._passengers)
+
+    def __iter__(self) -> Iterator[Passenger]:
+        """Iterates from the passenger who has waited longest to the newest arrival"""
+        return iter(self._passengers.values())
+
+    def __contains__(self, passenger: Passenger) -> bool:
+        return self._passengers.get(passenger.id) is passenger
+
+    def appendleft(self, passenger: Passenger) -> None:
+        """Adds a passenger to the back of the line, who may have arrived before now"""
+        self._passengers[passenger.id] = passenger
+        if self.area is not None:
+            self.area.change(passenger.initialization_time, 1)
+
+    def pop(self) -> Passenger:
+        """Removes and returns the passenger at the front of the line"""
+        if not self._passengers:
+            raise IndexError("pop from an empty PassengerQueue")
+        if self.area is not None:
+            self.area.change(self.area.clock.time, -1)
+        return self._passengers.popitem(last=False)[1]
+
+    def remove(self, passenger: Passenger) -> None:
+        """Removes a passenger from anywhere in the line, raises ValueError if they are not in it"""
+        if passenger not in self:
+            raise ValueError(f"{passenger} is not waiting")
+        del self._passengers[passenger.id]
+        if self.area is not None:
+            self.area.change(self.area.clock.time, -1)
+
+    def deadlines(self) -> Iterator[float]:
+        """The time each passenger gives up waiting, from the front of the line"""
+        return (passenger.deadline for passenger in self._passengers.values())
+
+    def take(self, positions: Sequence[int]) -> List[Passenger]:
+        """Removes and returns the passengers at increasing `positions` in line, counted from the front"""
+        wanted = set(positions)
+        taken = [passenger for k, passenger in zip(range(positions[-1] + 1), self._passengers.values()) if k in wanted]
+        for passenger in taken:
+            self.remove(passenger)
+        return taken
+
+
+class WaitingArrays:
+
+    def __init__(self, stop, capacity: int = 1024) -> None:
+        """The line of passengers waiting at a stop in lazy mode, stored as parallel arrays
+
+        Each waiting passenger costs an id, an arrival time, a patience deadline and a number of stops to travel, a few
+        dozen bytes instead of a Passenger object with a patience event. Passengers only become Passenger objects when
+        they are popped off the front of the line, and passengers who run out of patience are dropped in bulk by
+        `expire` without ever being created.
+
+        Args:
+            stop: the stop the passengers are waiting at
+            capacity: the initial number of passengers the arrays can hold, they grow as needed
+        """
+        self.stop = stop
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.arrival = np.empty(capacity, dtype=np.float64)
+        self.deadline = np.empty(capacity, dtype=np.float64)
+        self.stops_traveling = np.empty(capacity, dtype=np.int8)
+
+        # the waiting passengers are the ones in [_head, _tail), oldest first
+        self._head = 0
+        self._tail = 0
+
+        # tracked once somebody asks for it, see Stop.track_queue_area
+        self.area: Optional[QueueArea] = None
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+    def extend(self, first_id: int, arrival: np.ndarray, stops_traveling: np.ndarray) -> None:
+        """Adds passengers to the back of the line
+
+        Args:
+            first_id: the id of the first new passenger, the others have consecutive ids
+            arrival: sorted arrival times, all at or after the arrival of the newest passenger in line
+            stops_traveling: how many stops each new passenger rides
+        """
+        n = len(arrival)
+        if self._tail + n > len(self.ids):
+            self._make_room(n)
+
+        new = slice(self._tail, self._tail + n)
+        self.ids[new] = np.arange(first_id, first_id + n)
+        self.arrival[new] = arrival
+        self.deadline[new] = arrival + Passenger.PATIENCE
+        self.stops_traveling[new] = stops_traveling
+        self._tail += n
+
+        if self.area is not None:
+            self.area.weighted_time += float(arrival.sum())
+            self.area.length += n
+
+    def _make_room(self, n: int) -> None:
+        """Moves the line to the front of the arrays, growing them if `n` more passengers still wouldn't fit"""
+        size = len(self)
+        capacity = len(self.ids)
+        while size + n > capacity:
+            capacity *= 2
+
+        live = slice(self._head, self._tail)
+        for name in ("ids", "arrival", "deadline", "stops_traveling"):
+            old = getattr(self, name)
+            new = old if capacity == len(old) else np.empty(capacity, dtype=old.dtype)
+            new[:size] = old[live]
+            setattr(self, name, new)
+        self._head, self._tail = 0, size
+
+    def expire(self, time: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Drops every passenger whose patience ran out before `time`, returns their ids and arrival times
+
+        Everyone has the same patience, so deadlines grow along the line and the passengers who gave up are always at
+        the front of it.
+        """
+        n = int(np.searchsorted(self.deadline[self._head:self._tail], time, side="left"))
+        expired = slice(self._head, self._head + n)
+        self._head += n
+
+        if self.area is not None and n:
+            self.area.weighted_time -= float(self.deadline[expired].sum())
+            self.area.length -= n
+        return self.ids[expired], self.arrival[expired]
+
+    def pop(self) -> Passenger:
+        """Removes the passenger at the front of the line and creates them"""
+        if not len(self):
+            raise IndexError("pop from an empty WaitingArrays")
+        i = self._head
+        self._head += 1
+        if self.area is not None:
+            self.area.change(self.area.clock.time, -1)
+        return Passenger(self.stop.event_manager, self.stop, float(self.arrival[i]), id=int(self.ids[i]),
+                         stops_traveling=int(self.stops_traveling[i]))
+
+    def remove(self, passenger: Passenger) -> None:
+        """Passengers only exist once they have left the line, so this always raises ValueError"""
+        raise ValueError(f"{passenger} is not waiting")
+
+    def deadlines(self) -> Iterator[float]:
+        """The time each passenger gives up waiting, from the front of the line"""
+        return iter(self.deadline[self._head:self._tail].tolist())
+
+    def take(self, positions: Sequence[int]) -> List[Passenger]:
+        """Removes the passengers at increasing `positions` in line, counted from the front, and creates them
+
+        The passengers left behind in front of the last one taken keep their order, and are moved up against the rest
+        of the line.
+        """
+        positions = np.asarray(positions) + self._head
+        front = slice(self._head, positions[-1] + 1)
+        stay = np.ones(positions[-1] + 1 - self._head, dtype=bool)
+        stay[positions - self._head] = False
+
+        taken = [
+            Passenger(self.stop.event_manager, self.stop, float(self.arrival[i]), id=int(self.ids[i]),
+                      stops_traveling=int(self.stops_traveling[i]))
+            for i in positions.tolist()
+        ]
+        new_head = self._head + len(positions)
+        for name in ("ids", "arrival", "deadline", "stops_traveling"):
+            array = getattr(self, name)
+            array[new_head:front.stop] = array[front][stay]
+        self._head = new_head
+
+        if self.area is not None:
+            self.area.change(self.area.clock.time, -len(taken))
+        return taken
+
 
 class Stop:
     _stop_num = 0
 
-    def __init__(self, event_manager: EventManager, next_stop=None) -> None:
+    def __init__(self, event_manager: EventManager, next_stop=None, arrival_mode: str = "event",
+                 arrival_rates: Optional[Sequence[float]] = None) -> None:
+        """A bus stop where passengers queue up
+
+        Args:
+            event_manager: an instance of the event manager class
+            next_stop: the stop buses go to from here, for buses that don't follow a route of their own
+            arrival_mode: how passengers arrive, one of ARRIVAL_MODES
+            arrival_rates: passenger arrivals per minute at each hour of the day, ARRIVAL_RATES if not given
+        """
+        if arrival_mode not in ARRIVAL_MODES:
+            raise ValueError(f"arrival_mode must be one of {ARRIVAL_MODES}")
+
+        arrival_rates = ARRIVAL_RATES if arrival_rates is None else tuple(float(rate) for rate in arrival_rates)
+        if len(arrival_rates) != HOURS:
+            raise ValueError(f"arrival_rates must have one rate for each of the {HOURS} hours of the day")
+        if min(arrival_rates) < 0:
+            raise ValueError("arrival_rates must be nonnegative")
+        # event mode waits out one interarrival time after another, so it would never get past a quiet hour
+        if arrival_mode == "event" and min(arrival_rates) == 0:
+            raise ValueError("arrival_rates must be strictly positive in event mode")
 
         # parameters
+        self.arrival_mode = arrival_mode
+        self.arrival_rates = arrival_rates
+        self._rates = np.array(arrival_rates)
         self.event_manager = event_manager
         self.next = next_stop
+        self._rng = event_manager.random.stop
 
         # assigns a process-unique id to each Stop
         self.id = Stop._stop_num
@@ -26,7 +289,19 @@ class Stop:
         # state
         self.bus_loading = None
         self.bus_queue = deque()
-        self.passengers_waiting = deque()
+        # sparse mode is meant for networks with many stops, most of which are empty most of the time
+        if arrival_mode in ARRAY_MODES:
+            self._passengers_waiting = WaitingArrays(self, capacity=1024 if arrival_mode == "lazy" else 16)
+        else:
+            self._passengers_waiting = PassengerQueue()
+
+        # sorted arrival times drawn in batch and lazy mode, and how many of them have joined the queue
+        self._arrivals: List[float] = []
+        self._n_arrived = 0
+        self._last_arrival = 0
+        self._synced_at = None
+        # sparse mode: arrivals have been drawn up to this time
+        self._drawn_until = 0
 
     def __repr__(self):
         return f"<Stop id={self.id}>"
@@ -38,8 +313,6 @@ class Stop:
         """Circumstances permitting, load the next bus in line"""
         if not self.bus_loading and self.bus_queue:
             self.bus_loading = self.bus_queue.pop()
-
-        if self.bus_loading:
             self.bus_loading.disembark()
 
     def park(self, bus) -> None:
@@ -72,9 +345,144 @@ class Stop:
 
         This is a distorted cosine wave that simulates a "rush hour" every day in the hours around 7am and 7pm, when the
         time between successive arrivals gets very low.
+
+        The formula describes the default ARRIVAL_RATES, stops created with their own `arrival_rates` follow those
+        instead. A stop with no arrivals in the hour has an infinite interval.
+        """
+        rate = self.arrival_rates[floor(time / 60) % HOURS]
+        return 1/rate if rate else float("inf")
+
+    @property
+    def passengers_waiting(self) -> PassengerQueue:
+        """The passengers waiting at the stop, brought up to date with `sync` first"""
+        self.sync()
+        return self._passengers_waiting
+
+    def sync(self) -> None:
+        """Brings the queue up to date with the current time
+
+        In batch mode anyone who has arrived by now joins the queue. In lazy and sparse mode anyone who has run out of
+        patience by now is also dropped. In event mode the queue is always up to date.
+        """
+        if self.arrival_mode in ARRAY_MODES:
+            if self._synced_at != self.event_manager.time:
+                self._sync_waiting()
+        elif self._n_arrived < len(self._arrivals) and self._arrivals[self._n_arrived] <= self.event_manager.time:
+            self._materialize_arrivals()
+
+    @passengers_waiting.setter
+    def passengers_waiting(self, passengers) -> None:
+        self._passengers_waiting = passengers
+
+    def _next_arrival_window(self) -> None:
+        """Batch and lazy mode: draws every arrival from now to the end of the window, then schedules the next window
+
+        The arrival rate is constant within a window, so arrivals are a homogeneous Poisson process there: the number
+        of arrivals is Poisson and their times are uniform.
+        """
+        start = self.event_manager.time
+        end = (floor(start / ARRIVAL_WINDOW) + 1) * ARRIVAL_WINDOW
+        n = self._rng.poisson((end - start) / self.expected_arrival_interval(start))
+
+        self._arrivals = self._arrivals[self._n_arrived:] + sorted(self._rng.uniforms(start, end, n).tolist())
+        self._n_arrived = 0
+
+        self.event_manager.dispatch(self, STOP_ARRIVAL_WINDOW, end - start, self._next_arrival_window, n)
+
+    def _materialize_arrivals(self) -> None:
+        """Batch mode: creates the passengers who arrived since the queue was last looked at
+
+        Each arrival is logged as a STOP_PASSENGER_JOIN lasting from the previous arrival, with the queue length once
+        the passenger joined, like in event mode. Passengers who already ran out of patience never join the queue.
         """
-        time_in_hours = floor(time / 60) % 24
-        return 1/(1.2 + cos(pi * (time_in_hours - 7) / 6))
+        time = self.event_manager.time
+        arrivals = self._arrivals
+        while self._n_arrived < len(arrivals) and arrivals[self._n_arrived] <= time:
+            arrival_time = arrivals[self._n_arrived]
+            self._n_arrived += 1
+
+            passenger = Passenger(self.event_manager, self, arrival_time)
+            if passenger.deadline >= time:
+                self._passengers_waiting.appendleft(passenger)
+            elif self._passengers_waiting.area is not None:
+                # never in the queue object, but in the real queue until their patience ran out
+                self._passengers_waiting.area.change(arrival_time, 1)
+                self._passengers_waiting.area.change(passenger.deadline, -1)
+
+            self.event_manager.log_event(self, STOP_PASSENGER_JOIN, self._last_arrival, arrival_time,
+                                         cb_data=len(self._passengers_waiting))
+            self._last_arrival = arrival_time
+
+    def _draw_arrivals(self, start: float, end: float) -> np.ndarray:
+        """Sparse mode: draws every arrival in [start, end) at once, returns their times in order
+
+        The arrival rate is constant within each hour, so the number of arrivals is Poisson with the integrated rate as
+        its mean, and their times are uniform in the integrated rate. They are mapped back to sim time by inverting
+        the integrated rate, which is piecewise linear, so the cost doesn't depend on how long the stop sat idle.
+        """
+        if end <= start:
+            return np.empty(0)
+
+        edges = np.concatenate(([start], np.arange(floor(start / 60) + 1, ceil(end / 60)) * 60.0, [end]))
+        rates = self._rates[(edges[:-1] // 60).astype(np.int64) % HOURS]
+        expected = np.concatenate(([0.0], np.cumsum(rates * np.diff(edges))))
+
+        n = self._rng.poisson(expected[-1])
+        return np.interp(np.sort(self._rng.uniforms(0, expected[-1], n)), expected, edges)
+
+    def _sync_waiting(self) -> None:
+        """Lazy and sparse mode: brings the waiting arrays up to date with the current time
+
+        Everyone who arrived since the last sync joins the queue, then everyone who has run out of patience leaves it.
+        If the log keeps records, arrivals are logged like in batch mode and the passengers who gave up are logged as
+        joining and abandoning the queue, as if they had been created and their patience events had run.
+        """
+        time = self.event_manager.time
+        self._synced_at = time
+        waiting = self._passengers_waiting
+        logging = self.event_manager.logging
+
+        if self.arrival_mode == "sparse":
+            arrival = self._draw_arrivals(self._drawn_until, time)
+            self._drawn_until = time
+        else:
+            k = bisect_right(self._arrivals, time, self._n_arrived)
+            arrival = np.array(self._arrivals[self._n_arrived:k])
+            self._n_arrived = k
+
+        if len(arrival):
+            first_id = Passenger.reserve_ids(len(arrival))
+            waiting.extend(first_id, arrival, self.event_manager.random.passenger.randints(1, 7, len(arrival)))
+
+            if logging:
+                self._log_arrivals(arrival)
+
+        ids, arrival = waiting.expire(time)
+        if logging and len(ids):
+            passengers = [Passenger.unmaterialized(id) for id in ids.tolist()]
+            arrival = arrival.tolist()
+            # everyone joins before anyone leaves, so that the queue the log describes peaks where it should
+            for passenger, arrival_time in zip(passengers, arrival):
+                self.event_manager.log_event(passenger, PASSENGER_JOIN_QUEUE, arrival_time,
+                                             arrival_time + Passenger.PATIENCE, self.id)
+            for passenger, arrival_time in zip(passengers, arrival):
+                deadline = arrival_time + Passenger.PATIENCE
+                self.event_manager.log_event(passenger, PASSENGER_ABANDON_QUEUE, deadline, deadline)
+
+    def _log_arrivals(self, arrival: np.ndarray) -> None:
+        """Lazy and sparse mode: logs the newest arrivals as STOP_PASSENGER_JOINs with the queue length once each one joined"""
+        waiting = self._passengers_waiting
+        live = slice(waiting._head, waiting._tail)
+        first = len(waiting) - len(arrival)
+
+        # the queue once the k-th passenger in line joined holds everyone up to them whose patience had not run out
+        position = np.arange(first, len(waiting)) + 1
+        queue_lengths = position - np.searchsorted(waiting.deadline[live], arrival, side="left")
+
+        for arrival_time, queue_length in zip(arrival.tolist(), queue_lengths.tolist()):
+            self.event_manager.log_event(self, STOP_PASSENGER_JOIN, self._last_arrival, arrival_time,
+                                         cb_data=queue_length)
+            self._last_arrival = arrival_time
 
     def passenger_arrives(self) -> None:
         """Method to manager passenger arrivals
@@ -87,20 +495,32 @@ class Stop:
 
         # execution time varies by time of day
 
-        execution_time = stats.expon.rvs(scale=self.expected_arrival_interval(self.event_manager.time))
+        execution_time = self._rng.exponential(scale=self.expected_arrival_interval(self.event_manager.time))
 
-        def cb():
-            passenger = Passenger(self.event_manager, self)
-            self.passengers_waiting.appendleft(passenger)
-            self.passenger_arrives()
-            return len(self.passengers_waiting)
+        self.event_manager.dispatch(self, STOP_PASSENGER_JOIN, execution_time, self._passenger_joins)
+
+    def _passenger_joins(self) -> int:
+        """Called when a STOP_PASSENGER_JOIN action finishes, returns the queue length so it gets logged"""
+        passenger = Passenger(self.event_manager, self)
+        self.passengers_waiting.appendleft(passenger)
+        self.passenger_arrives()
+        return len(self.passengers_waiting)
+
+    def track_queue_area(self) -> QueueArea:
+        """Starts tracking the exact area under the queue length from now on, see QueueArea"""
+        waiting = self.passengers_waiting
+        if waiting.area is None:
+            waiting.area = QueueArea(self.event_manager, len(waiting))
+        return waiting.area
 
-        self.event_manager.dispatch(self, STOP_PASSENGER_JOIN, execution_time, cb)
+    @property
+    def queue_area(self) -> Optional[QueueArea]:
+        """The area under the queue length, if it is being tracked"""
+        return self._passengers_waiting.area
 
     def remove_passenger(self, passenger: Passenger):
         # error handling here to make mocking easier in tests
         try:
-            # O(n) to remove, but queue length should stay small
             self.passengers_waiting.remove(passenger)
         except ValueError:
             pass
@@ -108,6 +528,18 @@ class Stop:
     def report_queue_length(self):
         self.event_manager.dispatch(self, STOP_REPORT_QUEUE_LENGTH, QUEUE_LEN_REPORT_FREQUENCY, self.report_queue_length, len(self.passengers_waiting))
     
-    def start(self):
-        self.passenger_arrives()
-        self.report_queue_length()
+    def start(self, report: bool = True):
+        """Starts passengers arriving and, if `report`, queue length reports every QUEUE_LEN_REPORT_FREQUENCY minutes
+
+        Sparse stops dispatch no arrivals, so without reports they only do any work when a bus or a QueueSampler
+        looks at their queue.
+        """
+        if self.arrival_mode == "sparse":
+            self._last_arrival = self._drawn_until = self.event_manager.time
+        elif self.arrival_mode in ("batch", "lazy"):
+            self._last_arrival = self.event_manager.time
+            self._next_arrival_window()
+        else:
+            self.passenger_arrives()
+        if report:
+            self.report_queue_length()